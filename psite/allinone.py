@@ -249,7 +249,8 @@ def main(progname=None):
                     '--prune',str(args.prune),
                     '--random_seed',str(random_n),
                     '--map',map_dir,
-                    '--chain',tumor_chain]
+                    '--chain',tumor_chain,
+                    '--cores',str(args.cores)]
         if args.sex_chr:
             cmd_params.extend(['--sex_chr',args.sex_chr])
         if args.trunk_vars:
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# Author: Hechuan Yang
+# Created Time: 2026-10-17 11:05:21
+# File Name: columnar.py
+# Description: columnar binary outputs of phylovar
+#########################################################################
+
+import os
+import json
+import struct
+import numpy
+
+#The columns of each table (table,column,dtype,width). Each column is saved in the file table/column.npy,
+#which is a vector (width is None) or a matrix with one column for each sector/tipnode (width is sectors/tipnodes).
+#The rows of the tables snvs and genotypes are the same SNVs.
+COLUMNS=(('snvs','chrom','<u2',None),
+         ('snvs','pos','<i8',None),
+         ('snvs','form','<i1',None),
+         ('snvs','freq','<f8','sectors'),
+         ('snvs','rcount_alt','<i4','sectors'),
+         ('snvs','rcount_total','<i4','sectors'),
+         ('cnvs','chrom','<u2',None),
+         ('cnvs','start','<i8',None),
+         ('cnvs','end','<i8',None),
+         ('cnvs','parental','<i1',None),
+         ('cnvs','copy','<i2',None),
+         ('cnvs','carrier','<i8','sectors'),
+         ('cnv_profile','chrom','<u2',None),
+         ('cnv_profile','start','<i8',None),
+         ('cnv_profile','end','<i8',None),
+         ('cnv_profile','parental0_cn','<i8','sectors'),
+         ('cnv_profile','parental1_cn','<i8','sectors'),
+         ('cnv_profile','total_cn','<i8','sectors'),
+         ('genotypes','alt','<i2','tipnodes'),
+         ('genotypes','ref','<i2','tipnodes'))
+
+class NpyColumn:
+    '''
+    A .npy file, to which the rows of an array are appended as bytes. The shape in its header is updated when it's closed.
+    '''
+    HEADER_SIZE=128
+
+    def __init__(self,filename=None,dtype=None,width=None):
+        self.handle=open(filename,'wb')
+        self.dtype=numpy.dtype(dtype)
+        self.width=width
+        self.size=0
+        self.handle.write(self.header(rows=0))
+
+    def header(self,rows=None):
+        '''
+        The header of the .npy file (version 1.0), padded to HEADER_SIZE bytes, so the data is aligned for memory mapping.
+        '''
+        shape=(rows,) if self.width==None else (rows,self.width)
+        header="{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(self.dtype.str,shape)
+        header=header.ljust(self.HEADER_SIZE-11)+'\n'
+        return b'\x93NUMPY\x01\x00'+struct.pack('<H',len(header))+header.encode('latin1')
+
+    def write(self,data=None):
+        self.handle.write(data)
+        self.size+=len(data)
+
+    def close(self):
+        self.handle.seek(0)
+        self.handle.write(self.header(rows=self.size//(self.dtype.itemsize*(self.width or 1))))
+        self.handle.close()
+
+def open_columns(directory=None,chroms=None,sectors=None,tipnodes=None,genotypes=False):
+    '''
+    Create the columnar outputs in directory, and return {('columnar',table,column):NpyColumn,...}.
+    The names of the chromosomes (indexed by the column chrom), sectors and tipnodes are saved in columns.json.
+    The table genotypes is only created with genotypes.
+    '''
+    os.mkdir(directory,mode=0o755)
+    widths={'sectors':len(sectors),'tipnodes':len(tipnodes)}
+    columns={}
+    for table,column,dtype,width in COLUMNS:
+        if table=='genotypes' and not genotypes:
+            continue
+        os.makedirs(os.path.join(directory,table),mode=0o755,exist_ok=True)
+        columns[('columnar',table,column)]=NpyColumn(filename=os.path.join(directory,table,'{}.npy'.format(column)),
+                                                     dtype=dtype,width=widths.get(width))
+    with open(os.path.join(directory,'columns.json'),'w') as output:
+        json.dump({'chroms':chroms,'sectors':sectors,'tipnodes':tipnodes},output,indent=1)
+    return columns
+
+def write_columns(outputs=None,table=None,columns=None):
+    '''
+    Append the rows in columns ({column:values,...}) to the table, the outputs are the ones returned by open_columns
+    (or any binary files with the same keys).
+    '''
+    for name,dtype in [(column,dtype) for table_name,column,dtype,width in COLUMNS if table_name==table]:
+        outputs[('columnar',table,name)].write(numpy.ascontiguousarray(columns[name],dtype=dtype).tobytes())
+
+def load(directory=None,mmap_mode='r'):
+    '''
+    Load the columnar outputs of phylovar (--columnar) in directory, e.g.
+    data=psite.columnar.load('phylovar_columnar')
+    data['snvs']['freq'][:,data['sectors'].index('tumor')]
+    Return the content of columns.json plus {table:{column:array,...},...}. By default, the arrays are
+    memory-mapped (read only) without being copied into memory, use mmap_mode=None to read them into memory.
+    '''
+    with open(os.path.join(directory,'columns.json'),'r') as input_file:
+        data=json.load(input_file)
+    for table,column,dtype,width in COLUMNS:
+        filename=os.path.join(directory,table,'{}.npy'.format(column))
+        if os.path.exists(filename):
+            data.setdefault(table,{})[column]=numpy.load(filename,mmap_mode=mmap_mode)
+    return data
@@ -13,11 +13,19 @@ import re
 import argparse
 import numpy
 import logging
-import copy
 import yaml
 import time
+import shutil
+import tempfile
+import zlib
+import hashlib
+import json
+import pickle
+import multiprocessing
 import psite.trunk_vars
 import psite.tree
+import psite.writer
+import psite.columnar
 from psite.vcf2fa import check_sex
 
 #handle the error below
@@ -43,6 +51,13 @@ CFG_PARAMS={'snv_rate':float,
             'tstv':float,
             'length':int,
             }
+#the options shared by all replicates of --ensemble (the tree and the outputs derived from it),
+#and the outputs saved in the directory of each replicate
+ENSEMBLE_SHARED_ARGS=('tree','affiliation','clone','prune','trunk_length','NHX','map','nodes_ccf','log','loglevel')
+ENSEMBLE_OUTPUT_ARGS=('snv','cnv','nhx','NHX','nodes_vars','cnv_profile','cnv_rc','snv_genotype','ind_cnvs','chain','trace','snapshot','columnar')
+#the outputs can be written from a snapshot (see emit_snapshot), and the input files which should not change after it
+EMIT_OUTPUT_ARGS=('snv','cnv','nhx','NHX','nodes_vars','cnv_profile','cnv_rc','snv_genotype','ind_cnvs','chain','columnar')
+SNAPSHOT_INPUT_ARGS=('tree','affiliation','clone','trunk_vars','cnvl_dist')
 
 def random_int():
     '''
@@ -131,6 +146,7 @@ def cn_dist(copy_max=None,copy_parameter=None):
     w=1/sum([copy_parameter**x for x in range(copy_max)])
     scale=sum([w*copy_parameter**x for x in range(copy_max)])
     cn_dist_cfg['prob']=[(w*copy_parameter**x)/scale for x in range(copy_max)]
+    cn_dist_cfg['alias']=psite.tree.AliasTable(values=cn_dist_cfg['copy'],prob=cn_dist_cfg['prob'])
     return cn_dist_cfg
 
 def read_cnvl_dist(cfg_f=None):
@@ -164,6 +180,7 @@ def read_cnvl_dist(cfg_f=None):
             i+=1
         if sum_prob!=1:
             raise CnvDistFileError('The sum of all the probability in your CNV distribution file is not 1!')
+        cnvl_dist['alias']=psite.tree.AliasTable(values=cnvl_dist['bins'],prob=cnvl_dist['prob'])
         return cnvl_dist
 
 def tstv_dist(tstv=None):
@@ -179,6 +196,7 @@ def tstv_dist(tstv=None):
     tv2=1-ts-tv1
     tstv_dist_cfg['form']=[0,1,2]
     tstv_dist_cfg['prob']=[ts,tv1,tv2]
+    tstv_dist_cfg['alias']=psite.tree.AliasTable(values=tstv_dist_cfg['form'],prob=tstv_dist_cfg['prob'])
     return tstv_dist_cfg
 
 def check_config_file(config=None):
@@ -290,6 +308,12 @@ class CloneFileError(Exception):
 class CnvDistFileError(Exception):
     pass
 
+class EnsembleFileError(Exception):
+    pass
+
+class SnapshotError(Exception):
+    pass
+
 def read_clone(clone_f=None):
     '''
     Check the format of clone file and dump the data into the clones dictionary.
@@ -414,160 +438,551 @@ def read_affiliation(affiliation_f=None):
         sectors[sector]['members']=set(sectors[sector]['members'])
     return sectors
 
-#use kernprof -l -v script.py to profile
-# @profile
-def main(progname=None):
-    t0 = time.time()
-    prog=progname if progname else sys.argv[0]
-    parser=argparse.ArgumentParser(
-        description='Simulate SNVs/CNVs on a phylogenetic tree in newick format',
-        prog=prog)
-    group1=parser.add_argument_group('Input arguments')
-    group1.add_argument('-t','--tree',required=True,metavar='FILE',
-        help='a file containing !!!ONE!!! tree in newick format')
-    default=None
-    group1.add_argument('--trunk_vars',type=str,default=default,metavar='FILE',
-        help='a file containing truncal variants predefined by user [{}]'.format(default))
-    default=None
-    group1.add_argument('--config',type=str,default=default,metavar='FILE',
-        help='a YAML file which contains the configuration of somatic variant simulation. '+
-            '-n/-r/-R/-d/-l/-L/-c/-C/-p/--tstv/--length/--trunk_snv_rate/--trunk_cnv_rate will be ignored. [{}]'.format(default))
-    default=None
-    group1.add_argument('--affiliation',type=str,default=default,metavar='FILE',
-        help='a file containing sector affiliation of the cells in the sample [{}]'.format(default))
-    default=None
-    group1.add_argument('--cnvl_dist',type=str,default=default,metavar='FILE',
-        help="a file containing the distribution profile of CNVs' length [{}]".format(default))
-    default=None
-    group1.add_argument('--clone',type=str,default=default,metavar='FILE',
-        help="the tree file is a clone tree, and this file specifies the cells in each clone [{}]".format(default))
-    group2=parser.add_argument_group('Simulation arguments (can be set in config YAML)')
-    default='1'
-    group2.add_argument('-n','--name',type=str,default=default,metavar='STR',
-        help='the name of the sequence to be simulated [{}]'.format(default))
-    default=300
-    group2.add_argument('-r','--snv_rate',type=float,default=default,metavar='FLOAT',
-        help='the muation rate of SNVs [{}]'.format(default))
-    default=3
-    group2.add_argument('-R','--cnv_rate',type=float,default=default,metavar='FLOAT',
-        help='the muation rate of CNVs [{}]'.format(default))
-    default=None
-    group2.add_argument('--trunk_snv_rate',type=float,default=default,metavar='FLOAT',
-        help='the muation rate of SNVs on trunk. It will be the same as --snv_rate if not being specified [{}]'.format(default))
-    default=None
-    group2.add_argument('--trunk_cnv_rate',type=float,default=default,metavar='FLOAT',
-        help='the muation rate of CNVs on trunk. It will be the same as --cnv_rate if not being specified [{}]'.format(default))
-    default=0.5
-    group2.add_argument('-d','--del_prob',type=float,default=default,metavar='FLOAT',
-        help='the probability of being deletion for a CNV mutation [{}]'.format(default))
-    default=1.0
-    group2.add_argument('--tandem_prob',type=float,default=default,metavar='FLOAT',
-        help='the probability of being tandem repeat for an amplification mutation [{}]'.format(default))
-#https://en.wikipedia.org/wiki/Copy-number_variation
-    default=20000000
-    group2.add_argument('-l','--cnv_length_beta',type=int,default=default,metavar='INT',
-        help='the mean of CNVs length [{}]'.format(default))
-    default=40000000
-    group2.add_argument('-L','--cnv_length_max',type=int,default=default,metavar='INT',
-        help='the maximium of CNVs length [{}]'.format(default))
-    default=0.5
-    group2.add_argument('-c','--copy_parameter',type=float,default=default,metavar='FLOAT',
-        help="the p parameter of CNVs' copy number distribution [{}]".format(default))
-    default=5
-    group2.add_argument('-C','--copy_max',type=int,default=default,metavar='INT',
-        help='the maximium ADDITIONAL copy of a CNVs [{}]'.format(default))
-    default='01'
-    group2.add_argument('-p','--parental',type=str,default=default,metavar='STR',
-        help='the parental to simulate [{}]'.format(default))
-    default=2.0
-    group2.add_argument('--tstv',type=check_tstv,default=default,metavar='FLOAT',
-        help='the ratio of ts/tv of SNV [{}]'.format(default))
-    default=100000000
-    group2.add_argument('--length',type=int,default=default,metavar='INT',
-        help='the length of the sequence to simulate [{}]'.format(default))
-    group3=parser.add_argument_group('Other simulation arguments (can NOT be set in config YAML)')
-    default=0.05
-    group3.add_argument('-x','--prune',type=check_prune,default=default,metavar='FLOAT',
-        help='trim all the children of the nodes with less than this proportion of total leaves [{}]'.format(default))
-    default=None
-    group3.add_argument('-s','--sex_chr',type=check_sex,default=default,metavar='STR',
-        help='sex chromosomes of the genome (separated by comma) [{}]'.format(default))
-    default=None
-    group3.add_argument('--random_seed',type=check_seed,metavar='INT',
-        help='the seed for random number generator (an integer between 0 and 2**31-1) [{}]'.format(default))
-    default=0
-    group3.add_argument('--trunk_length',type=float,default=default,metavar='FLOAT',
-        help='the length of the trunk [{}]'.format(default))
-    default=0.6
-    group3.add_argument('--purity',type=check_purity,default=default,metavar='FLOAT',
-        help='the proportion of tumor cells in simulated tumor sample [{}]'.format(default))
-    default=None
-    group3.add_argument('--depth',type=check_depth,default=default,metavar='FLOAT',
-        help='the sequencing depth of the whole tumor sample for read count simulation [{}]'.format(default))
-#Actually, the depth here and the depth in the affiliation file is the not the mean depth of the whole genome.
-#It's impossible to get that without calculating the size of all the genomes in sample. 
-#Here we set all the diploid part of the genome with this depth. And the depth of other part will be caculated 
-#according this.
-    default=150
-    group3.add_argument('--rlen',type=int,default=default,metavar='INT',
-        help='the read length for simulating the read count for each segment of the genome [{}]'.format(default))
-    group4=parser.add_argument_group('Output arguments')
-    group4.add_argument('--just_prune',action='store_true',
-        help='just prune the tree and output the pruned tree and the map of tipnode:cells')
-    default='phylovar_snvs'
-    group4.add_argument('-S','--snv',type=str,default=default,metavar='DIR',
-        help='the output directory to save SNVs files [{}]'.format(default))
-    default='phylovar_cnvs'
-    group4.add_argument('-V','--cnv',type=str,default=default,metavar='DIR',
-        help='the output directory to save CNVs files [{}]'.format(default))
-    default='phylovar.log'
-    group4.add_argument('-g','--log',type=str,default=default,metavar='FILE',
-        help='the log file [{}]'.format(default))
-    default='INFO'
-    group4.add_argument('-G','--loglevel',type=str,default=default,choices=['DEBUG','INFO'],
-        help='the logging level [{}]'.format(default))
-    default=None
-    group4.add_argument('--nhx',type=str,default=default,metavar='FILE',
-        help='the output file in NHX format to save the pruned tree with all variants [{}]'.format(default))
-    default=None
-    group4.add_argument('--NHX',type=str,default=default,metavar='FILE',
-        help='the output file in NHX format to save the original tree with all variants [{}]'.format(default))
-    default=None
-    group4.add_argument('--nodes_vars',type=str,default=default,metavar='FILE',
-        help='the output file to save SNVs/CNVs on each node [{}]'.format(default))
-    default=None
-    group4.add_argument('--nodes_ccf',type=str,default=default,metavar='FILE',
-        help='the output file to save CCF (Cancer Cell Fraction) of each node in each sector [{}]'.format(default))
-    default=None
-    group4.add_argument('--cnv_profile',type=str,default=default,metavar='DIR',
-        help='the output directory to save the files of CNV profile of each sector [{}]'.format(default))
-    default=None
-    group4.add_argument('--cnv_rc',type=str,default=default,metavar='DIR',
-        help='the output directory to save the files of simulated CNV read depth of each sector [{}]'.format(default))
-    default=None
-    group4.add_argument('--snv_genotype',type=str,default=default,metavar='FILE',
-        help='the file to save SNV genotypes for each cell [{}]'.format(default))
-    default=None
-    group4.add_argument('--ind_cnvs',type=str,default=default,metavar='FILE',
-        help='the file to save CNVs for each cell individual [{}]'.format(default))
-#    default=None
-#    parser.add_argument('--haplotype_copy',type=str,default=default,metavar='FILE',
-#        help='the file to save haplotype copy for each SNV')
-#    default=None
-#    parser.add_argument('--expands',type=str,default=default,metavar='FILE',
-#        help='the basename of the file to output the snv and segment data for EXPANDS [{}]'.format(default))
-    default=None
-    group4.add_argument('--map',type=check_folder,default=default,metavar='DIR',
-        help='directory to output the map file for each sector, which contain the relationship between tip nodes and original samples [{}]'.format(default))
-    default=None
-    group4.add_argument('--chain',type=check_folder,default=default,metavar='DIR',
-        help='directory to output chain files for each sample [{}]'.format(default))
-    args=parser.parse_args()
-    if args.just_prune:
-        if args.nhx==None or args.map==None:
-            raise argparse.ArgumentTypeError("--nhx and --map must be specified when phylovar run with --just_prune.")
+def chroms_seed(seed=None,chroms=None,block=None):
+    '''
+    Return the seed (an array of 32 bit unsigned integers) of the random number generator for the chromosome chroms
+    (or its block-th block, see chroms_blocks). It is derived from the master seed and the name of the chromosome,
+    so the variants of a chromosome do not depend on the other chromosomes or on the order they are simulated in.
+    '''
+    spawn_key=(zlib.crc32(str(chroms).encode()),)
+    if block!=None:
+        spawn_key+=(block,)
+    seed_seq=numpy.random.SeedSequence(entropy=seed,spawn_key=spawn_key)
+    return seed_seq.generate_state(4)
+
+def chroms_blocks(length=None,block_length=None,trunk_cnvs=None):
+    '''
+    Split a chromosome into blocks (not shorter than block_length), which can be simulated independently.
+    Return the list of [start,end) of the blocks. A trunk CNV (with the targets of its new copies)
+    always falls in one block, as the boundaries inside it are moved to its end.
+    '''
+    if block_length==None or length<2*block_length:
+        return [(0,length)]
+    n=length//block_length
+    spans=[]
+    for cnvs in trunk_cnvs.values():
+        for cnv in cnvs:
+            targets=cnv.get('target',[])
+            spans.append((min([cnv['start']]+targets),max([cnv['end']]+[x+1 for x in targets])))
+    spans.sort()
+    boundaries=[0]
+    for i in range(1,n):
+        boundary=max(round(length*i/n),boundaries[-1]+block_length)
+        for span_start,span_end in spans:
+            if span_start<boundary<span_end:
+                boundary=span_end
+        if length-boundary<block_length:
+            break
+        boundaries.append(boundary)
+    boundaries.append(length)
+    return list(zip(boundaries[:-1],boundaries[1:]))
+
+def simulate_chroms(chroms=None,chroms_cfg=None,simulation=None,outputs=None,chain=None,start=0,end=None,block=None,snapshot=None):
+    '''
+    Simulate the variants of the chromosome chroms (or its block-th block [start,end)), and write them to the files in outputs:
+    {('snv',sector):file,('cnv',sector):file,('cnv_profile',sector):file,('cnv_rc',sector):file,
+     'snv_genotype':file,'ind_cnvs':file,'trace':file}
+    simulation is a dictionary of everything shared by all chromosomes (see simulate_sample).
+    If snapshot is not None, the simulated variants are saved in this file (see save_snapshot).
+    If simulation['emit'] is not None, the variants are loaded from the snapshot in that directory instead of simulated.
+    Return the VariantTable of this chromosome if it is required by --nhx/--NHX/--nodes_vars/--snapshot, otherwise None.
+    '''
+    args=simulation['args']
+    mytree=simulation['tree']
+    sectors=simulation['sectors']
+    sex_chrs=simulation['sex_chrs']
+    trunk_snvs=simulation['trunk_snvs'].get(chroms,{})
+    trunk_cnvs=simulation['trunk_cnvs'].get(chroms,{})
+    if end==None:
+        end=chroms_cfg['length']
+    if block!=None:
+        trunk_snvs={hap:[snv for snv in snvs if start<=snv['start']<end] for hap,snvs in trunk_snvs.items()}
+        trunk_cnvs={hap:[cnv for cnv in cnvs if start<=cnv['start']<end] for hap,cnvs in trunk_cnvs.items()}
+    cnvl_dist=simulation['cnvl_dist']
+    tipnode_list=simulation['tipnode_list']
+#I need the normal_dosage to adjust the frequency of snv under under different purity
+    for sector,info in sectors.items():
+        if chroms in sex_chrs and len(sex_chrs)==2:
+            n=1
+        else:
+            n=2
+        tumor_cells=len(info['members'])
+        total_cells=round(tumor_cells/info['purity'])
+        normal_cells=total_cells-tumor_cells
+        info['standard_total_dosage']=total_cells*n
+        info['normal_dosage']=normal_cells*n
+
+    if simulation['emit']!=None:
+        logging.info(' Load the simulation of chromosome %s from the snapshot',chroms)
+        state=load_snapshot(filename=snapshot_file(directory=simulation['emit'],chroms=chroms,block=block))
+        variants=state['variants']
+        if chain!=None:
+            for chain_file,records in state['chain'].items():
+                with open(os.path.join(chain,chain_file),'a') as output:
+                    output.write(records)
+    else:
+        numpy.random.seed(chroms_seed(seed=simulation['seed'],chroms=chroms,block=block))
+        trace=None
+        if 'trace' in outputs:
+            trace=psite.tree.MutationTrace(output=outputs['trace'])
+        variants=None
+        if args.nhx or args.NHX or args.nodes_vars or snapshot!=None:
+            variants=psite.tree.VariantTable()
+        if cnvl_dist==None:
+            check_cnv_length_cfg(chroms=chroms,cnv_length_beta=chroms_cfg['cnv_length_beta'],
+                cnv_length_max=chroms_cfg['cnv_length_max'],chr_length=chroms_cfg['length'])
+        cn_dist_cfg=cn_dist(copy_max=chroms_cfg['copy_max'],copy_parameter=chroms_cfg['copy_parameter'])
+        tstv_dist_cfg=tstv_dist(tstv=chroms_cfg['tstv'])
+        if block==None:
+            logging.info(' Start the simulation for chromosome: %s',chroms)
+        else:
+            logging.info(' Start the simulation for chromosome: %s (block %s: %s-%s)',chroms,block,start,end)
+#the chain files of this chromosome are kept for the snapshot, and then appended to the ones in chain
+        chroms_chain=chain
+        if snapshot!=None:
+            chroms_chain=tempfile.mkdtemp(prefix='chain_',dir=simulation['tmp_dir'])
+
+        (snv_genotypes,tipnode_cnvs,summary,
+            )=mytree.snvs_freq_cnvs_profile(
+                parental=chroms_cfg['parental'],
+                snv_rate=chroms_cfg['snv_rate'],
+                cnv_rate=chroms_cfg['cnv_rate'],
+                trunk_snv_rate=chroms_cfg['trunk_snv_rate'],
+                trunk_cnv_rate=chroms_cfg['trunk_cnv_rate'],
+                del_prob=chroms_cfg['del_prob'],
+                tandem_prob=chroms_cfg['tandem_prob'],
+                cnv_length_beta=chroms_cfg['cnv_length_beta'],
+                cnv_length_max=chroms_cfg['cnv_length_max'],
+                cn_dist_cfg=cn_dist_cfg,
+                tstv_dist_cfg=tstv_dist_cfg,
+                trunk_snvs=trunk_snvs,
+                trunk_cnvs=trunk_cnvs,
+                length=chroms_cfg['length'],
+                start=start,
+                end=end,
+                chain=chroms_chain,
+                chroms=chroms,
+                sectors=sectors,
+                wholeT=WHOLET,
+                cnvl_dist=cnvl_dist,
+                trace=trace,
+                variants=variants,
+            )
+        state={'summary':summary,'snv_genotypes':snv_genotypes,'tipnode_cnvs':tipnode_cnvs,
+               'variants':variants,'chain':{},'random_states':{}}
+        if snapshot!=None:
+            for chain_file in sorted(os.listdir(chroms_chain)):
+                with open(os.path.join(chroms_chain,chain_file),'r') as input_file:
+                    state['chain'][chain_file]=input_file.read()
+            if chain!=None:
+                merge_chain(directories=[chroms_chain],chain=chain)
+            shutil.rmtree(chroms_chain)
+    snv_genotypes=state['snv_genotypes']
+    tipnode_cnvs=state['tipnode_cnvs']
+    psite.tree.sectors_summary(sectors=sectors,summary=state['summary'],parental=chroms_cfg['parental'],start=start,end=end)
+    columnar=args.columnar!=None
+    if args.snv_genotype!=None:
+        for pos,mutation,alt_counts,ref_counts in snv_genotypes.blocks(tipnodes=tipnode_list):
+            outputs['snv_genotype'].write(snv_genotypes.format_block(chroms=chroms,pos=pos,mutation=mutation,
+                                                                     alt_counts=alt_counts,ref_counts=ref_counts))
+            if columnar:
+                psite.columnar.write_columns(outputs=outputs,table='genotypes',columns={'alt':alt_counts,'ref':ref_counts})
 
+#the lines of each output are formatted block by block from the columns (see psite.writer.format_lines)
+    if args.ind_cnvs!=None:
+        ind_cnvs=[(tipnode,cnv['parental'],chroms,cnv['start'],cnv['end'],'+{}'.format(cnv['copy']) if cnv['copy']>0 else str(cnv['copy']))
+                  for tipnode in tipnode_list for cnv in tipnode_cnvs[tipnode]]
+        outputs['ind_cnvs'].write(psite.writer.format_lines(list(zip(*ind_cnvs))))
+
+#        if args.haplotype_copy!=None:
+#            for snv in hap_local_copy_for_all_snvs:
+#                parental_copy_file.write('{}\t{}\n'.format(chroms,'\t'.join([str(x) for x in snv])))
+
+#the outputs emitted from a snapshot draw the same random numbers as the ones written after the simulation
+    sync_random_state(state=state,key='snv')
+    snvs_freq=[]
+    snvs_rcount=[]
+    for sector,info in sectors.items():
+        if ('snv',sector) not in outputs and not columnar:
+            continue
+        snvs=info['snvs_alt_total']
+        total=snvs['total']
+        freq=snvs['alt']/numpy.where(total==0,1,total)
+        columns=[chroms,snvs['pos'],snvs['pos']+1,snvs['mutation'],
+                 ['0' if dosage==0 else str(round(x,4)) for x,dosage in zip(freq.tolist(),total.tolist())]]
+#the read counts of the sectors without depth are -1 (only in the columnar outputs)
+        total_dp=b_allele_dp=numpy.full(len(total),-1,dtype=numpy.int64)
+        if info['depth']!=None:
+            expected_total_dp=info['depth']*total/info['standard_total_dosage']
+            total_dp,b_allele_dp=psite.tree.simulate_sequence_coverage(mean_coverage=expected_total_dp,baf=freq)
+            columns.append(['{}:{}'.format(b,t) for b,t in zip(b_allele_dp.tolist(),total_dp.tolist())])
+            columns.append([round(b/t,4) if t!=0 else '-' for b,t in zip(b_allele_dp.tolist(),total_dp.tolist())])
+        if ('snv',sector) in outputs:
+            outputs[('snv',sector)].write(psite.writer.format_lines(columns))
+        if columnar:
+            snvs_freq.append(numpy.where(total==0,0,freq))
+            snvs_rcount.append(numpy.column_stack([total_dp,b_allele_dp]))
+    for sector,info in sectors.items():
+        if ('cnv',sector) not in outputs:
+            continue
+        cnvs=[(chroms,cnv['start'],cnv['end'],cnv['parental'],'+{}'.format(cnv['copy']) if cnv['copy']>0 else str(cnv['copy']),cnv['leaves_count'])
+              for cnv in info['cnvs']]
+        outputs[('cnv',sector)].write(psite.writer.format_lines(list(zip(*cnvs))))
+
+#aneuploidy events [(parental,copy),...] of the whole chromosome
+    aneuploidy=[]
+    if chroms in sex_chrs and len(sex_chrs)==2: # haploid sex chromosomes
+        for sector,info in sectors.items():
+            for seg in info['cnv_profile']:
+#cnv_profile means the local copy of each segment across the cell population of the sample (normal+tumor)
+                seg[2]=seg[2]+info['normal_dosage']
+                seg[3]=seg[3]+0
+                seg[4]=seg[4]+info['normal_dosage']
+#output aneuploidy events on sex chromosomes if there is any
+        assert re.match('^0*$',chroms_cfg['parental']),\
+            "Check the parental settings of the sex chromosome {}. It's not right!".format(chroms)
+        aneuploidy.append((0,len(chroms_cfg['parental'])-1))
+
+    else:
+        for sector,info in sectors.items():
+            for seg in info['cnv_profile']:
+                seg[2]=seg[2]+round(info['normal_dosage']/2)
+                seg[3]=seg[3]+round(info['normal_dosage']/2)
+                seg[4]=seg[4]+info['normal_dosage']
+#output aneuploidy events on autosomes if there is any
+        assert re.match('^[01]*$',chroms_cfg['parental']),\
+            "Check the parental settings of the sex chromosome {}. It's not right!".format(chroms)
+        for parental in ['0','1']:
+            parental_count=len(re.findall(parental,chroms_cfg['parental']))
+            aneuploidy.append((parental,parental_count-1))
+#the aneuploidy events are output with the first block of the chromosome
+    aneuploidy=[(parental,copy) for parental,copy in aneuploidy if copy!=0 and start==0]
+    for sector,info in sectors.items():
+        if ('cnv',sector) in outputs:
+            events=[(chroms,0,chroms_cfg['length'],parental,'+{}'.format(copy) if copy>0 else str(copy),len(info['members']))
+                    for parental,copy in aneuploidy]
+            outputs[('cnv',sector)].write(psite.writer.format_lines(list(zip(*events))))
+
+    if args.cnv_profile!=None:
+        for sector,info in sectors.items():
+#cnv_profile means the local copy of each segment across the cell population of the sample (normal+tumor)
+            outputs[('cnv_profile',sector)].write(psite.writer.format_lines([chroms]+list(zip(*info['cnv_profile']))))
+
+    if columnar:
+        chroms_index=simulation['chroms_index'][chroms]
+        snvs=sectors[WHOLET]['snvs_alt_total']
+        psite.columnar.write_columns(outputs=outputs,table='snvs',columns={
+            'chrom':numpy.full(len(snvs['pos']),chroms_index),
+            'pos':snvs['pos'],
+            'form':snvs['mutation'],
+            'freq':numpy.column_stack(snvs_freq),
+            'rcount_alt':numpy.column_stack([rcount[:,1] for rcount in snvs_rcount]),
+            'rcount_total':numpy.column_stack([rcount[:,0] for rcount in snvs_rcount])})
+        cnvs=sectors[WHOLET]['cnvs']
+        psite.columnar.write_columns(outputs=outputs,table='cnvs',columns={
+            'chrom':numpy.full(len(cnvs)+len(aneuploidy),chroms_index),
+            'start':[cnv['start'] for cnv in cnvs]+[0]*len(aneuploidy),
+            'end':[cnv['end'] for cnv in cnvs]+[chroms_cfg['length']]*len(aneuploidy),
+            'parental':[int(cnv['parental']) for cnv in cnvs]+[int(parental) for parental,copy in aneuploidy],
+            'copy':[cnv['copy'] for cnv in cnvs]+[copy for parental,copy in aneuploidy],
+            'carrier':numpy.array([[cnv['leaves_count'] for cnv in info['cnvs']]+[len(info['members'])]*len(aneuploidy)
+                                   for info in sectors.values()],dtype=numpy.int64).T})
+#the segments of the CNV profile are the same in all sectors (the breakpoints of all CNVs)
+        profiles=[numpy.array(info['cnv_profile'],dtype=numpy.int64).reshape(len(info['cnv_profile']),5) for info in sectors.values()]
+        psite.columnar.write_columns(outputs=outputs,table='cnv_profile',columns={
+            'chrom':numpy.full(len(profiles[0]),chroms_index),
+            'start':profiles[0][:,0],
+            'end':profiles[0][:,1],
+            'parental0_cn':numpy.column_stack([profile[:,2] for profile in profiles]),
+            'parental1_cn':numpy.column_stack([profile[:,3] for profile in profiles]),
+            'total_cn':numpy.column_stack([profile[:,4] for profile in profiles])})
+
+    sync_random_state(state=state,key='cnv_rc')
+    if args.cnv_rc!=None:
+        read_length=args.rlen
+        for sector,info in sectors.items():
+            if info['depth']!=None:
+#the adjacent segments with the same copy numbers are merged, and the read counts of all the segments are sampled at once
+                segs=numpy.array(info['cnv_profile'],dtype=numpy.int64).reshape(len(info['cnv_profile']),5)
+                first=numpy.ones(len(segs),dtype=bool)
+                first[1:]=(segs[1:,0]!=segs[:-1,1])|(segs[1:,2:]!=segs[:-1,2:]).any(axis=1)
+                last=numpy.append(first[1:],True)
+                seg_start=segs[first,0]
+                seg_end=segs[last,1]
+                parental0_cn,parental1_cn,total_cn=segs[first,2:].T
+                total_rc,parental0_rc,parental1_rc=psite.tree.simulate_cnv_rc(
+                    mean_coverage=info['depth']*total_cn/info['standard_total_dosage'],
+                    parental0_cn=parental0_cn,
+                    parental1_cn=parental1_cn,
+                    seg_length=seg_end-seg_start,
+                    read_length=read_length)
+                outputs[('cnv_rc',sector)].write(psite.writer.format_lines([chroms,seg_start,seg_end,parental0_rc,parental1_rc,total_rc]))
+    if snapshot!=None:
+        save_snapshot(filename=snapshot,state=state)
+    return variants
+
+def sync_random_state(state=None,key=None):
+    '''
+    Restore the state of the random number generator saved as key in state['random_states'] (loaded from a snapshot),
+    or save the current one there (for the snapshot).
+    '''
+    if key in state['random_states']:
+        numpy.random.set_state(state['random_states'][key])
+    else:
+        state['random_states'][key]=numpy.random.get_state()
+
+def snapshot_file(directory=None,chroms=None,block=None):
+    '''
+    Return the file of the chromosome chroms (or its block-th block) in the snapshot directory.
+    '''
+    if block==None:
+        return os.path.join(directory,'{}.npz'.format(chroms))
+    return os.path.join(directory,'{}.{}.npz'.format(chroms,block))
+
+def save_snapshot(filename=None,state=None):
+    '''
+    Save the simulated variants of a chromosome (block) in a compressed npz file of plain arrays (no pickled objects):
+    the summary of the variants in all sectors, the genotypes of SNVs/CNVs in each tipnode, the variants on each node,
+    the chain files of the tipnodes and the states of the random number generator for the read counts.
+    '''
+    summary=state['summary']
+    cnvs=summary['cnvs']
+    arrays={'version':numpy.array(SNAPSHOT_VERSION),
+            'sectors':numpy.array(summary['sectors'],dtype=str),
+            'snv_pos':summary['pos'],
+            'snv_mutation':summary['mutation'],
+            'snv_alt_count':summary['alt_count'],
+            'cnv_start':numpy.array([cnv['start'] for cnv in cnvs],dtype=numpy.int64),
+            'cnv_end':numpy.array([cnv['end'] for cnv in cnvs],dtype=numpy.int64),
+            'cnv_parental':numpy.array([cnv['parental'] for cnv in cnvs],dtype=numpy.int64),
+            'cnv_copy':numpy.array([cnv['copy'] for cnv in cnvs],dtype=numpy.int64),
+            'cnv_counts':summary['cnv_counts']}
+    snv_genotypes=state['snv_genotypes']
+    for key,value in snv_genotypes.arrays().items():
+        arrays['genotypes_'+key]=value
+#the CNVs of each tipnode: (tipnode index in snv_genotypes.tipnodes,parental,start,end,copy)
+    ind_cnvs=[(i,int(cnv['parental']),cnv['start'],cnv['end'],cnv['copy'])
+              for i,tipnode in enumerate(snv_genotypes.tipnodes) for cnv in state['tipnode_cnvs'][tipnode]]
+    arrays['ind_cnvs']=numpy.array(ind_cnvs,dtype=numpy.int64).reshape(len(ind_cnvs),5)
+    for key,value in state['variants'].arrays().items():
+        arrays['variants_'+key]=value
+#the chain files are joined in one array of bytes
+    chain_files=sorted(state['chain'])
+    chain_data=[state['chain'][chain_file].encode() for chain_file in chain_files]
+    arrays['chain_files']=numpy.array(chain_files,dtype=str)
+    arrays['chain_offsets']=numpy.cumsum([0]+[len(data) for data in chain_data]).astype(numpy.int64)
+    arrays['chain_data']=numpy.frombuffer(b''.join(chain_data),dtype=numpy.uint8)
+    for key,(name,keys,pos,has_gauss,cached_gaussian) in state['random_states'].items():
+        arrays['random_{}_keys'.format(key)]=keys
+        arrays['random_{}_pos'.format(key)]=numpy.array([pos,has_gauss],dtype=numpy.int64)
+        arrays['random_{}_gaussian'.format(key)]=numpy.array(cached_gaussian)
+    with open(filename,'wb') as output:
+        numpy.savez_compressed(output,**arrays)
+
+def load_snapshot(filename=None):
+    '''
+    Load the simulated variants of a chromosome (block) saved by save_snapshot.
+    '''
+    try:
+        arrays=numpy.load(filename)
+    except FileNotFoundError:
+        raise SnapshotError("Can not find the simulation of the chromosome in the snapshot: {}".format(filename))
+    if int(arrays['version'])!=SNAPSHOT_VERSION:
+        raise SnapshotError("The snapshot {} is saved by another version of phylovar.".format(filename))
+    summary={'sectors':arrays['sectors'].tolist(),
+             'pos':arrays['snv_pos'],
+             'mutation':arrays['snv_mutation'],
+             'alt_count':arrays['snv_alt_count'],
+             'cnvs':[{'start':start,'end':end,'parental':str(parental),'copy':copy} for start,end,parental,copy in
+                     zip(*[arrays[key].tolist() for key in ('cnv_start','cnv_end','cnv_parental','cnv_copy')])],
+             'cnv_counts':arrays['cnv_counts']}
+    genotypes={key[len('genotypes_'):]:arrays[key] for key in arrays.files if key.startswith('genotypes_')}
+    snv_genotypes=psite.tree.SnvGenotypes(tipnodes=genotypes['tipnodes'].tolist(),ploidy=int(genotypes['ploidy']))
+    snv_genotypes.load_arrays(arrays=genotypes)
+    tipnode_cnvs={tipnode:[] for tipnode in snv_genotypes.tipnodes}
+    for i,parental,start,end,copy in arrays['ind_cnvs'].tolist():
+        tipnode_cnvs[snv_genotypes.tipnodes[i]].append({'start':start,'end':end,'copy':copy,'leaves_count':1,'parental':str(parental)})
+    variants=psite.tree.VariantTable()
+    variants.load_arrays(arrays={key[len('variants_'):]:arrays[key] for key in arrays.files if key.startswith('variants_')})
+    chain={}
+    chain_data=arrays['chain_data'].tobytes()
+    chain_offsets=arrays['chain_offsets'].tolist()
+    for i,chain_file in enumerate(arrays['chain_files'].tolist()):
+        chain[chain_file]=chain_data[chain_offsets[i]:chain_offsets[i+1]].decode()
+    random_states={}
+    for key in ('snv','cnv_rc'):
+        pos,has_gauss=arrays['random_{}_pos'.format(key)].tolist()
+        random_states[key]=('MT19937',arrays['random_{}_keys'.format(key)],pos,has_gauss,float(arrays['random_{}_gaussian'.format(key)]))
+    return {'summary':summary,'snv_genotypes':snv_genotypes,'tipnode_cnvs':tipnode_cnvs,
+            'variants':variants,'chain':chain,'random_states':random_states}
+
+#the simulation shared by all chromosomes in a worker process
+WORKER_SIMULATION=None
+#change it when the simulation changes, so the results cached by the previous versions will not be used
+CACHE_VERSION=2
+#change it when the format of snapshot (see save_snapshot) or the outputs emitted from it change
+SNAPSHOT_VERSION=2
+
+def init_worker(simulation=None):
+    global WORKER_SIMULATION
+    WORKER_SIMULATION=simulation
+
+def simulate_chroms_worker(chroms=None,chroms_cfg=None,start=0,end=None,block=None,cache_key=None):
+    '''
+    Run simulate_chroms in a worker process. The outputs are written to the files in a temporary directory,
+    which will be appended to the output files by merge_chroms_outputs in the order of chromosomes (and blocks).
+    With cache_key, the directory is kept in the cache (--cache), and a later run with the same key reuses it.
+    '''
+    simulation=WORKER_SIMULATION
+    if cache_key!=None:
+        cached=os.path.join(simulation['args'].cache,cache_key)
+        if os.path.isdir(cached):
+            logging.info(' Use the cached simulation of chromosome %s: %s',chroms,cached)
+            return cached_chroms_result(directory=cached,simulation=simulation)
+    directory=tempfile.mkdtemp(prefix='chroms_',dir=simulation['tmp_dir'])
+    paths={}
+    outputs={}
+    for i,key in enumerate(simulation['output_keys']):
+        paths[key]=os.path.join(directory,str(i))
+#the columns of --columnar are binary
+        outputs[key]=open(paths[key],'wb' if key[0]=='columnar' else 'w')
+    chain=None
+    if simulation['args'].chain!=None:
+        chain=os.path.join(directory,'chain')
+        os.mkdir(chain,mode=0o755)
+    snapshot=None
+    if simulation['args'].snapshot!=None:
+        snapshot=os.path.join(directory,'snapshot.npz')
+    try:
+        variants=simulate_chroms(chroms=chroms,chroms_cfg=chroms_cfg,simulation=simulation,outputs=outputs,chain=chain,
+                                 start=start,end=end,block=block,snapshot=snapshot)
+    finally:
+        for output in outputs.values():
+            output.close()
+    if cache_key!=None:
+        with open(os.path.join(directory,'variants.pickle'),'wb') as output:
+            pickle.dump(variants,output)
+        try:
+            os.rename(directory,cached)
+        except OSError:
+#the same simulation has been cached by another run
+            shutil.rmtree(directory)
+        return cached_chroms_result(directory=cached,simulation=simulation)
+    return {'directory':directory,'paths':paths,'chain':chain,'snapshot':snapshot,'variants':variants,'cached':False}
+
+def cached_chroms_result(directory=None,simulation=None):
+    '''
+    Return the outputs of a chromosome (block) saved in the cache by simulate_chroms_worker.
+    '''
+    paths={}
+    for i,key in enumerate(simulation['output_keys']):
+        paths[key]=os.path.join(directory,str(i))
+    chain=None
+    if simulation['args'].chain!=None:
+        chain=os.path.join(directory,'chain')
+    snapshot=None
+    if simulation['args'].snapshot!=None:
+        snapshot=os.path.join(directory,'snapshot.npz')
+    with open(os.path.join(directory,'variants.pickle'),'rb') as input_file:
+        variants=pickle.load(input_file)
+    return {'directory':directory,'paths':paths,'chain':chain,'snapshot':snapshot,'variants':variants,'cached':True}
+
+def file_digest(filename=None):
+    '''
+    Return the sha256 digest of the content of a file (None if there is no file).
+    '''
+    if filename==None:
+        return None
+    digest=hashlib.sha256()
+    with open(filename,'rb') as input_file:
+        for chunk in iter(lambda:input_file.read(1<<20),b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def simulation_digest(args=None,output_keys=None):
+    '''
+    Return the digest of everything shared by all chromosomes that affects their simulation and outputs:
+    the input files (tree, affiliation, clone, trunk variants and CNV length distribution),
+    the settings of the samples and the outputs required.
+    '''
+    inputs={'version':CACHE_VERSION,
+            'files':[file_digest(x) for x in (args.tree,args.affiliation,args.clone,args.trunk_vars,args.cnvl_dist)],
+            'args':[args.prune,args.trunk_length,args.purity,args.depth,args.rlen,args.sex_chr],
+            'outputs':[str(key) for key in output_keys],
+            'chain':args.chain!=None,
+            'variants':bool(args.nhx or args.NHX or args.nodes_vars),
+            'snapshot':args.snapshot!=None}
+    return hashlib.sha256(json.dumps(inputs,sort_keys=True).encode()).hexdigest()
+
+def chroms_cache_key(digest=None,chroms=None,chroms_cfg=None,start=None,end=None,block=None,seed=None):
+    '''
+    Return the key of a chromosome (block) in the cache, i.e. the hash of the simulation digest (see simulation_digest),
+    the configure of the chromosome, the region of the block and its seed (see chroms_seed).
+    '''
+    inputs={'simulation':digest,
+            'chroms':chroms,
+            'config':chroms_cfg,
+            'region':[start,end,block],
+            'seed':chroms_seed(seed=seed,chroms=chroms,block=block).tolist()}
+    return hashlib.sha256(json.dumps(inputs,sort_keys=True,default=str).encode()).hexdigest()
+
+def open_output(filename=None,bgzip=False,writer=None):
+    '''
+    Open a text output file (see psite.writer.OutputFile), which is compressed by bgzip (with the suffix .gz) if bgzip is True.
+    '''
+    if bgzip and not filename.endswith('.gz'):
+        filename+='.gz'
+    return psite.writer.OutputFile(filename=filename,bgzip=bgzip,writer=writer)
 
+def merge_chroms_outputs(results=None,outputs=None,chain=None,snapshots=None):
+    '''
+    Append the outputs of the blocks of a chromosome simulated by simulate_chroms_worker to the output files,
+    and copy their snapshots to the files in snapshots (if any).
+    '''
+    for i,result in enumerate(results):
+        for key,path in result['paths'].items():
+            with open(path,'rb' if key[0]=='columnar' else 'r') as input_file:
+                shutil.copyfileobj(input_file,outputs[key])
+        if snapshots!=None:
+            shutil.copyfile(result['snapshot'],snapshots[i])
+    if chain!=None:
+        merge_chain(directories=[result['chain'] for result in results],chain=chain)
+    for result in results:
+        if not result['cached']:
+            shutil.rmtree(result['directory'])
+
+def merge_chain(directories=None,chain=None):
+    '''
+    Append the chain files in directories (the blocks of a chromosome in order) to the chain files in chain.
+    The records of each haplotype in all blocks are joined under one header.
+    '''
+    for chain_file in sorted(os.listdir(directories[0])):
+        with open(os.path.join(chain,chain_file),'a') as output:
+            if len(directories)==1:
+                with open(os.path.join(directories[0],chain_file),'r') as input_file:
+                    shutil.copyfileobj(input_file,output)
+                continue
+            headers=[]
+            records={}
+            for directory in directories:
+                with open(os.path.join(directory,chain_file),'r') as input_file:
+                    for line in input_file:
+                        if line.startswith('>'):
+                            header=line
+                            if header not in records:
+                                headers.append(header)
+                                records[header]=[]
+                        else:
+                            records[header].append(line)
+            for header in headers:
+                output.write(header)
+                output.writelines(records[header])
+
+def chroms_config(args=None):
+    '''
+    Return the simulation settings of each chromosome from the command line and the configure YAML file (--config):
+    {'order':[chroms1,chroms2,...],chroms1:{parameter:value,...},...}
+    '''
 ###### figure out the simulation setting for each chroms
 #1. The setting in configure YAML file will override the setting in command line.
 #2. In the configure file, the setting for individual chr will override the setting of genome.
@@ -623,32 +1038,23 @@ def main(progname=None):
                     final_chroms_cfg[chroms_n][parameter]=chroms_cfg.get(parameter,config['genome'][parameter])
                 if 'parental' in chroms_cfg and len(chroms_cfg['parental'])>max_ploidy:
                     max_ploidy=len(chroms_cfg['parental'])
+    return final_chroms_cfg
 
-###### logging and random seed setting
-    logging.basicConfig(filename=args.log, filemode='w',
-        format='[%(asctime)s] %(levelname)s: %(message)s',
-        datefmt='%m-%d %H:%M:%S',level=args.loglevel)
-    argv_copy=sys.argv[:]
-    argv_copy.insert(1,'phylovar')
-    logging.info(' Command: %s',' '.join(argv_copy))
-    if args.random_seed==None:
-        seed=random_int()
-    else:
-        seed=args.random_seed
-    logging.info(' Random seed: %s',seed)
-    numpy.random.seed(seed)
-
+def prepare_tree(args=None):
+    '''
+    Build the tree from the newick file, prune it and collect the cells of each sector (and output --nodes_ccf).
+    Return a dictionary of the tree and everything derived from it, which can be shared by many simulations
+    on the same tree (see --ensemble).
+    '''
 ###### build tree from newick string
-    newick=''
-    with open(args.tree) as input:
-        for line in input:
-            newick+=line.rstrip()
-    mytree=psite.tree.newick2tree(newick)
+    mytree=psite.tree.newick_file2tree(args.tree,compact=True)
     if args.trunk_length:
         mytree.lens=args.trunk_length
 
-###### original_tree
-    original_tree=copy.deepcopy(mytree)
+###### original_tree, only needed for --NHX
+    original_tree=None
+    if args.NHX:
+        original_tree=mytree.new_copy(lens=mytree.lens)
 
     leaves_number=mytree.leaves_counting()
     leaves_names=mytree.leaves_naming()
@@ -692,46 +1098,52 @@ def main(progname=None):
     tipnode_leaves=mytree.tipnode_leaves
     tipnode_list=list(tipnode_leaves.keys())
     tipnode_list.sort()
+#the index of the tipnode (in tipnode_list) of each leaf
     leaf_tipnode={}
-    leaves_names=[]
-    for tipnode,leaves in tipnode_leaves.items():
-        leaves_names.extend(leaves)
-        for leaf in leaves:
-            leaf_tipnode[leaf]=tipnode
-    leaves_names.sort()
-    logging.info(' There are %s leaves on your input tree.',len(leaves_names))
+    for i,tipnode in enumerate(tipnode_list):
+        for leaf in tipnode_leaves[tipnode]:
+            leaf_tipnode[leaf]=i
+    logging.info(' There are %s leaves on your input tree.',len(leaf_tipnode))
     logging.info(' After pruning, there are %s tip nodes on the tree.',len(tipnode_list))
-
-#just prune tree and output the pruned tree and the map of tipnode:cells
-    if args.just_prune:
-        os.mkdir(args.map,mode=0o755)
-        for sector in sectors:
-            with open(os.path.join(args.map,'{}.tipnode.map'.format(sector)),'w') as tipnode_samples_map_f:
-                tipnode_samples_map_f.write('#tip_node\tcell_count\tcells\n')
-                for tip_node in tipnode_list:
-                    focal_members=sectors[sector]['members'].intersection(set(tipnode_leaves[tip_node]))
-                    if len(focal_members):
-                        tipnode_samples_map_f.write('{}\t{}\t'.format(tip_node,len(focal_members)))
-                        tipnode_samples_map_f.write(','.join(sorted(focal_members)))
-                        tipnode_samples_map_f.write('\n')
-        with open(args.nhx,'w') as tree_data_file:
-            tree_data_file.write('{};\n'.format(mytree.tree2nhx(with_lens=True)))
-        exit()
-
-###### output the map of tip_node(after pruning):leaf
+    return {'tree':mytree,
+            'original_tree':original_tree,
+            'leaves_number':leaves_number,
+            'sectors':sectors,
+            'tipnode_list':tipnode_list,
+            'leaf_tipnode':leaf_tipnode}
+
+def write_tipnode_maps(directory=None,sectors=None,tipnode_list=None,leaf_tipnode=None):
+    '''
+    Write the map file of each sector ({sector}.tipnode.map) in directory, i.e. the cells of the sector under each tipnode.
+    The cells of a sector are grouped by their tipnodes (leaf_tipnode, the index in tipnode_list) in one pass.
+    '''
+    os.mkdir(directory,mode=0o755)
+    for sector,info in sectors.items():
+        tipnode_cells=[[] for tipnode in tipnode_list]
+        for leaf in sorted(info['members']):
+            tipnode_cells[leaf_tipnode[leaf]].append(leaf)
+        with open(os.path.join(directory,'{}.tipnode.map'.format(sector)),'w') as tipnode_samples_map_f:
+            tipnode_samples_map_f.write('#tip_node\tcell_count\tcells\n')
+            tipnode_samples_map_f.write(''.join(['{}\t{}\t{}\n'.format(tip_node,len(cells),','.join(cells))
+                                                 for tip_node,cells in zip(tipnode_list,tipnode_cells) if cells]))
+
+def simulate_sample(args=None,final_chroms_cfg=None,tree_info=None,seed=None,emit=None):
+    '''
+    Simulate the variants of all chromosomes on the tree prepared by prepare_tree, and write all the outputs.
+    With emit (the directory of a snapshot), the variants are loaded from the snapshot instead (see emit_snapshot).
+    '''
+    mytree=tree_info['tree']
+    original_tree=tree_info['original_tree']
+    leaves_number=tree_info['leaves_number']
+    tipnode_list=tree_info['tipnode_list']
+#the sectors are updated by the simulation, and the whole tumor sample may have its own purity/depth (see --ensemble)
+    sectors={}
+    for sector,info in tree_info['sectors'].items():
+        sectors[sector]=info.copy()
+    sectors[WHOLET]['purity']=args.purity
+    sectors[WHOLET]['depth']=args.depth
     if args.chain!=None:
         os.mkdir(args.chain,mode=0o755)
-    if args.map!=None:
-        os.mkdir(args.map,mode=0o755)
-        for sector in sectors:
-            with open(os.path.join(args.map,'{}.tipnode.map'.format(sector)),'w') as tipnode_samples_map_f:
-                tipnode_samples_map_f.write('#tip_node\tcell_count\tcells\n')
-                for tip_node in tipnode_list:
-                    focal_members=sectors[sector]['members'].intersection(set(tipnode_leaves[tip_node]))
-                    if len(focal_members):
-                        tipnode_samples_map_f.write('{}\t{}\t'.format(tip_node,len(focal_members)))
-                        tipnode_samples_map_f.write(','.join(sorted(focal_members)))
-                        tipnode_samples_map_f.write('\n')
 
 ###### add trunk vars if supplied
     trunk_snvs={}
@@ -741,42 +1153,71 @@ def main(progname=None):
             args.trunk_vars,final_chroms_cfg,leaves_number,mytree)
 
 ###### open all required output file and output the headers 
-    sectors_snvs_dir=args.snv
-    os.mkdir(sectors_snvs_dir,mode=0o755)
-    sectors_cnvs_dir=args.cnv
-    os.mkdir(sectors_cnvs_dir,mode=0o755)
-    for sector,info in sectors.items():
-        info['snv_file']=open(os.path.join(sectors_snvs_dir,'{}.snv'.format(sector)),'w')
-        info['snv_file'].write('#chr\tstart\tend\tform\tfrequency')
-        if info['depth']!=None:
-            info['snv_file'].write('\trcount\trfreq\n')
-        else:
-            info['snv_file'].write('\n')
-        info['cnv_file']=open(os.path.join(sectors_cnvs_dir,'{}.cnv'.format(sector)),'w')
-        info['cnv_file'].write('#chr\tstart\tend\tparental\tcopy\tcarrier\n')
+#outputs: {('snv',sector):file,('cnv',sector):file,...}, see simulate_chroms
+#--snv/--cnv can only be skipped by emit_snapshot
+#the outputs are written by a background thread, unless the chromosomes are simulated in other processes (--cores)
+    writer=None
+    if args.cores==1:
+        writer=psite.writer.WriterThread()
+    outputs={}
+    if args.snv!=None:
+        sectors_snvs_dir=args.snv
+        os.mkdir(sectors_snvs_dir,mode=0o755)
+        for sector,info in sectors.items():
+            outputs[('snv',sector)]=open_output(filename=os.path.join(sectors_snvs_dir,'{}.snv'.format(sector)),bgzip=args.bgzip,writer=writer)
+            outputs[('snv',sector)].write('#chr\tstart\tend\tform\tfrequency')
+            if info['depth']!=None:
+                outputs[('snv',sector)].write('\trcount\trfreq\n')
+            else:
+                outputs[('snv',sector)].write('\n')
+    if args.cnv!=None:
+        sectors_cnvs_dir=args.cnv
+        os.mkdir(sectors_cnvs_dir,mode=0o755)
+        for sector,info in sectors.items():
+            outputs[('cnv',sector)]=open_output(filename=os.path.join(sectors_cnvs_dir,'{}.cnv'.format(sector)),bgzip=args.bgzip,writer=writer)
+            outputs[('cnv',sector)].write('#chr\tstart\tend\tparental\tcopy\tcarrier\n')
 
     if args.cnv_profile!=None:
         sectors_cnv_prof_dir=args.cnv_profile
         os.mkdir(sectors_cnv_prof_dir,mode=0o755)
         for sector,info in sectors.items():
-            info['cnv_profile_file']=open(os.path.join(sectors_cnv_prof_dir,'{}.cnv_prof'.format(sector)),'w')
-            info['cnv_profile_file'].write('#chr\tstart\tend\tparental0_cn\tparental1_cn\ttotal_cn\n')
+            outputs[('cnv_profile',sector)]=open_output(filename=os.path.join(sectors_cnv_prof_dir,'{}.cnv_prof'.format(sector)),
+                                                        bgzip=args.bgzip,writer=writer)
+            outputs[('cnv_profile',sector)].write('#chr\tstart\tend\tparental0_cn\tparental1_cn\ttotal_cn\n')
 
     if args.cnv_rc!=None:
         sectors_cnv_rc_dir=args.cnv_rc
         os.mkdir(sectors_cnv_rc_dir,mode=0o755)
         for sector,info in sectors.items():
             if info['depth']!=None:
-                info['cnv_rc_file']=open(os.path.join(sectors_cnv_rc_dir,'{}.cnv_rc'.format(sector)),'w')
-                info['cnv_rc_file'].write('#chr\tstart\tend\tparental0_rc\tparental1_rc\ttotal_rc\n')
+                outputs[('cnv_rc',sector)]=open_output(filename=os.path.join(sectors_cnv_rc_dir,'{}.cnv_rc'.format(sector)),
+                                                       bgzip=args.bgzip,writer=writer)
+                outputs[('cnv_rc',sector)].write('#chr\tstart\tend\tparental0_rc\tparental1_rc\ttotal_rc\n')
 
     if args.snv_genotype!=None:
-        genotype_file=open(args.snv_genotype,'w')
-        genotype_file.write('#chr\tstart\tend\tform\t{}\n'.format('\t'.join(tipnode_list)))
+        outputs['snv_genotype']=open_output(filename=args.snv_genotype,bgzip=args.bgzip,writer=writer)
+        outputs['snv_genotype'].write('#chr\tstart\tend\tform\t{}\n'.format('\t'.join(tipnode_list)))
 
     if args.ind_cnvs!=None:
-        ind_cnvs_file=open(args.ind_cnvs,'w')
-        ind_cnvs_file.write('#cell\tparental\tchr\tstart\tend\tcopy\n')
+        outputs['ind_cnvs']=open_output(filename=args.ind_cnvs,bgzip=args.bgzip,writer=writer)
+        outputs['ind_cnvs'].write('#cell\tparental\tchr\tstart\tend\tcopy\n')
+
+    if args.trace!=None:
+        outputs['trace']=open_output(filename=args.trace,writer=writer)
+
+    if args.columnar!=None:
+        outputs.update(psite.columnar.open_columns(directory=args.columnar,chroms=final_chroms_cfg['order'],sectors=list(sectors),
+                                                   tipnodes=tipnode_list,genotypes=args.snv_genotype!=None))
+
+#the snapshot keeps everything needed by emit_snapshot to write the outputs again
+    if args.snapshot!=None:
+        os.mkdir(args.snapshot,mode=0o755)
+        with open(os.path.join(args.snapshot,'snapshot.json'),'w') as output:
+            json.dump({'version':SNAPSHOT_VERSION,
+                       'args':vars(args),
+                       'seed':seed,
+                       'files':{arg:file_digest(getattr(args,arg)) for arg in SNAPSHOT_INPUT_ARGS},
+                       'chroms_cfg':final_chroms_cfg},output,indent=1,default=str)
 
 #    if args.haplotype_copy!=None:
 #        parental_copy_file=open(args.haplotype_copy,'w')
@@ -797,183 +1238,105 @@ def main(progname=None):
     sex_chrs=set()
     if args.sex_chr:
         sex_chrs=set(args.sex_chr.split(','))
-    all_nodes_vars={}
+    variants=None
+    if args.nhx or args.NHX or args.nodes_vars:
+        variants=psite.tree.VariantTable()
+    simulation={'args':args,
+                'tree':mytree,
+                'sectors':sectors,
+                'sex_chrs':sex_chrs,
+                'trunk_snvs':trunk_snvs,
+                'trunk_cnvs':trunk_cnvs,
+                'cnvl_dist':cnvl_dist,
+                'tipnode_list':tipnode_list,
+                'seed':seed,
+                'chroms_index':{chroms:i for i,chroms in enumerate(final_chroms_cfg['order'])},
+                'emit':emit,
+                'output_keys':list(outputs.keys())}
+#each chromosome (block) has its own random number generator (see chroms_seed),
+#so the outputs are the same no matter how many cores are used.
+    blocks={}
     for chroms in final_chroms_cfg['order']:
         chroms_cfg=final_chroms_cfg[chroms]
-        if cnvl_dist==None:
-            check_cnv_length_cfg(chroms=chroms,cnv_length_beta=chroms_cfg['cnv_length_beta'],
-                cnv_length_max=chroms_cfg['cnv_length_max'],chr_length=chroms_cfg['length'])
-        cn_dist_cfg=cn_dist(copy_max=chroms_cfg['copy_max'],copy_parameter=chroms_cfg['copy_parameter'])
-        tstv_dist_cfg=tstv_dist(tstv=chroms_cfg['tstv'])
-        logging.info(' Start the simulation for chromosome: %s',chroms)
-#I need the normal_dosage to adjust the frequency of snv under under different purity
-        for sector,info in sectors.items():
-            if chroms in sex_chrs and len(sex_chrs)==2:
-                n=1
-            else:
-                n=2
-            tumor_cells=len(info['members'])
-            total_cells=round(tumor_cells/info['purity'])
-            normal_cells=total_cells-tumor_cells
-            info['standard_total_dosage']=total_cells*n
-            info['normal_dosage']=normal_cells*n
-
-        (nodes_vars,tipnode_snv_alts,tipnode_snv_refs,tipnode_cnvs,
-            )=mytree.snvs_freq_cnvs_profile(
-                parental=chroms_cfg['parental'],
-                snv_rate=chroms_cfg['snv_rate'],
-                cnv_rate=chroms_cfg['cnv_rate'],
-                trunk_snv_rate=chroms_cfg['trunk_snv_rate'],
-                trunk_cnv_rate=chroms_cfg['trunk_cnv_rate'],
-                del_prob=chroms_cfg['del_prob'],
-                tandem_prob=chroms_cfg['tandem_prob'],
-                cnv_length_beta=chroms_cfg['cnv_length_beta'],
-                cnv_length_max=chroms_cfg['cnv_length_max'],
-                cn_dist_cfg=cn_dist_cfg,
-                tstv_dist_cfg=tstv_dist_cfg,
-                trunk_snvs=trunk_snvs.get(chroms,{}),
-                trunk_cnvs=trunk_cnvs.get(chroms,{}),
-                length=chroms_cfg['length'],
-                chain=args.chain,
-                chroms=chroms,
-                sectors=sectors,
-                wholeT=WHOLET,
-                cnvl_dist=cnvl_dist,
-            )
-        snvs_alt_total=sectors[WHOLET]['snvs_alt_total']
-        cnvs=sectors[WHOLET]['cnvs']
-        if args.nhx or args.NHX or args.nodes_vars:
-            all_nodes_vars=psite.tree.merge_two_dict_set(dict1=all_nodes_vars,dict2=nodes_vars)
-
-        if args.snv_genotype!=None:
-            for pos,mutation,alt,total in snvs_alt_total:
-                genotype_file.write('{}\t{}\t{}\t{}\t{}\n'.format(chroms,pos,pos+1,mutation,
-                    '\t'.join([str(tipnode_snv_alts[tipnode][pos])+':'+str(tipnode_snv_refs[tipnode][pos]) for tipnode in tipnode_list])))
-
-        if args.ind_cnvs!=None:
-            for tipnode in tipnode_list:
-                for cnv in tipnode_cnvs[tipnode]:
-                    cnv_copy='+{}'.format(cnv['copy']) if cnv['copy']>0 else str(cnv['copy'])
-                    ind_cnvs_file.write('{}\n'.format('\t'.join([str(x) for x in [tipnode,cnv['parental'],chroms,cnv['start'],cnv['end'],cnv_copy]])))
-
-#        if args.haplotype_copy!=None:
-#            for snv in hap_local_copy_for_all_snvs:
-#                parental_copy_file.write('{}\t{}\n'.format(chroms,'\t'.join([str(x) for x in snv])))
-
-        for sector,info in sectors.items():
-            for pos,mutation,alt,total in info['snvs_alt_total']:
-                if total==0:
-                    freq=0
-                else:
-                    freq=alt/total
-                info['snv_file'].write('{}\t{}\t{}\t{}\t{}'.format(chroms,pos,pos+1,mutation,round(freq,4)))
-                if info['depth']!=None:
-                    expected_total_dp=info['depth']*total/info['standard_total_dosage']
-                    total_dp,b_allele_dp=psite.tree.simulate_sequence_coverage(expected_total_dp,freq)
-                    if total_dp!=0:
-                        rfreq=round(b_allele_dp/total_dp,4)
-                    else:
-                        rfreq='-'
-                    info['snv_file'].write('\t{}:{}\t{}\n'.format(b_allele_dp,total_dp,rfreq))
-                else:
-                    info['snv_file'].write('\n')
-            for cnv in info['cnvs']:
-                cnv_copy='+{}'.format(cnv['copy']) if cnv['copy']>0 else str(cnv['copy'])
-                info['cnv_file'].write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(chroms,cnv['start'],cnv['end'],cnv['parental'],cnv_copy,cnv['leaves_count']))
-
-        if chroms in sex_chrs and len(sex_chrs)==2: # haploid sex chromosomes
-            for sector,info in sectors.items():
-                for seg in info['cnv_profile']:
-#cnv_profile means the local copy of each segment across the cell population of the sample (normal+tumor)
-                    seg[2]=seg[2]+info['normal_dosage']
-                    seg[3]=seg[3]+0
-                    seg[4]=seg[4]+info['normal_dosage']
-#output aneuploidy events on sex chromosomes if there is any
-                assert re.match('^0*$',chroms_cfg['parental']),\
-                    "Check the parental settings of the sex chromosome {}. It's not right!".format(chroms)
-                aneuploidy=len(chroms_cfg['parental'])-1
-                if aneuploidy!=0:
-                    aneuploidy='+{}'.format(aneuploidy) if aneuploidy>0 else str(aneuploidy)
-                    info['cnv_file'].write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(
-                        chroms,0,chroms_cfg['length'],0,aneuploidy,len(info['members'])))
-
+        blocks[chroms]=chroms_blocks(length=chroms_cfg['length'],block_length=args.block_length,
+                                     trunk_cnvs=trunk_cnvs.get(chroms,{}))
+        if len(blocks[chroms])>1 and cnvl_dist==None and chroms_cfg['cnv_length_max']>args.block_length:
+            raise argparse.ArgumentTypeError("{}: The value of cnv_length_max ".format(chroms)+
+                "({}) should NOT be larger than --block_length ({}).".format(chroms_cfg['cnv_length_max'],args.block_length))
+#the temporary directories of the simulations are moved into the cache, so they should be in the same file system
+    if args.cache!=None:
+        os.makedirs(args.cache,exist_ok=True)
+        simulation['tmp_dir']=tempfile.mkdtemp(prefix='phylovar_tmp_',dir=args.cache)
+        digest=simulation_digest(args=args,output_keys=simulation['output_keys'])
+    else:
+        simulation['tmp_dir']=tempfile.mkdtemp(prefix='phylovar_tmp_',dir=os.getcwd())
+    if args.cores==1 and args.cache==None:
+        for chroms in final_chroms_cfg['order']:
+#the chain files of the blocks are merged after all blocks of the chromosome are simulated
+            block_chains=[]
+            for block,(start,end) in enumerate(blocks[chroms]):
+                chain=args.chain
+                if len(blocks[chroms])==1:
+                    block=None
+                elif args.chain!=None:
+                    chain=tempfile.mkdtemp(prefix='chain_',dir=simulation['tmp_dir'])
+                    block_chains.append(chain)
+                snapshot=None
+                if args.snapshot!=None:
+                    snapshot=snapshot_file(directory=args.snapshot,chroms=chroms,block=block)
+                chroms_variants=simulate_chroms(chroms=chroms,chroms_cfg=final_chroms_cfg[chroms],simulation=simulation,
+                                                outputs=outputs,chain=chain,start=start,end=end,block=block,snapshot=snapshot)
+                if variants!=None:
+                    variants.update(chroms_variants)
+            if block_chains:
+                merge_chain(directories=block_chains,chain=args.chain)
+                for chain in block_chains:
+                    shutil.rmtree(chain)
+    else:
+#with one core (e.g. in a replicate of --ensemble), the chromosomes are simulated in this process
+        pool=None
+        if args.cores>1:
+            pool=multiprocessing.Pool(processes=args.cores,initializer=init_worker,initargs=(simulation,))
         else:
-            for sector,info in sectors.items():
-                for seg in info['cnv_profile']:
-                    seg[2]=seg[2]+round(info['normal_dosage']/2)
-                    seg[3]=seg[3]+round(info['normal_dosage']/2)
-                    seg[4]=seg[4]+info['normal_dosage']
-#output aneuploidy events on autosomes if there is any
-                assert re.match('^[01]*$',chroms_cfg['parental']),\
-                    "Check the parental settings of the sex chromosome {}. It's not right!".format(chroms)
-                for parental in ['0','1']:
-                    parental_count=len(re.findall(parental,chroms_cfg['parental']))
-                    aneuploidy=parental_count-1
-                    if aneuploidy!=0:
-                        aneuploidy='+{}'.format(aneuploidy) if aneuploidy>0 else str(aneuploidy)
-                        info['cnv_file'].write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(
-                            chroms,0,chroms_cfg['length'],parental,aneuploidy,len(info['members'])))
-
-        if args.cnv_profile!=None:
-            for sector,info in sectors.items():
-                for seg in info['cnv_profile']:
-#cnv_profile means the local copy of each segment across the cell population of the sample (normal+tumor)
-                    info['cnv_profile_file'].write('{}\n'.format('\t'.join([str(x) for x in [chroms]+seg])))
-
-        if args.cnv_rc!=None:
-            read_length=args.rlen
-            for sector,info in sectors.items():
-                if info['depth']!=None:
-                    temp=[]
-                    for seg in info['cnv_profile']:
-                        if temp:
-                            if seg[2]==temp[-1][2] and seg[3]==temp[-1][3] and seg[4]==temp[-1][4] and seg[0]==temp[-1][1]:
-                                temp[-1][1]=seg[1]
-                            else:
-                                temp.append(seg)
-                        else:
-                            temp.append(seg)
-                    for seg in temp:
-                        start,end,parental0_cn,parental1_cn,total_cn=seg
-                        expected_total_dp=info['depth']*total_cn/info['standard_total_dosage']
-                        total_rc,parental0_rc,parental1_rc=psite.tree.simulate_cnv_rc(
-                            mean_coverage=expected_total_dp,
-                            parental0_cn=parental0_cn,
-                            parental1_cn=parental1_cn,
-                            seg_length=end-start,
-                            read_length=read_length)
-                        info['cnv_rc_file'].write('{}\n'.format('\t'.join([str(x) for x in (chroms,start,end,parental0_rc,parental1_rc,total_rc)])))
-
-##output for expands
-#        if args.expands != None:
-#            for pos,mutation,freq in snvs_freq:
-#                total_dp,b_allele_dp=psite.tree.simulate_sequence_coverage(args.depth,freq)
-#                expands_snps_file.write('{}\t{}\t{}\t{}\n'.format(chroms,pos,b_allele_dp/total_dp,0))
-#
-##in the segment input for expands
-##CN_Estimate - the copy number estimated for each segment (average value across all subpopulations in the sample)
-#            for start,end,copy in cnv_profile:
-#                expands_segs_file.write('{}\t{}\t{}\t{}\n'.format(chroms,start,end,copy/leaves_number))
+            init_worker(simulation=simulation)
+        results=[]
+        for chroms in final_chroms_cfg['order']:
+            chroms_results=[]
+            for block,(start,end) in enumerate(blocks[chroms]):
+                if len(blocks[chroms])==1:
+                    block=None
+                kwds={'chroms':chroms,'chroms_cfg':final_chroms_cfg[chroms],'start':start,'end':end,'block':block}
+                if args.cache!=None:
+                    kwds['cache_key']=chroms_cache_key(digest=digest,chroms=chroms,chroms_cfg=final_chroms_cfg[chroms],
+                                                       start=start,end=end,block=block,seed=seed)
+                if pool!=None:
+                    chroms_results.append(pool.apply_async(simulate_chroms_worker,kwds=kwds))
+                else:
+                    chroms_results.append(simulate_chroms_worker(**kwds))
+            results.append(chroms_results)
+        if pool!=None:
+            pool.close()
+#merge the outputs in the order of chromosomes, as soon as each of them is ready
+        for chroms,chroms_results in zip(final_chroms_cfg['order'],results):
+            if pool!=None:
+                chroms_results=[result.get() for result in chroms_results]
+            snapshots=None
+            if args.snapshot!=None:
+                snapshots=[snapshot_file(directory=args.snapshot,chroms=chroms,block=None if len(blocks[chroms])==1 else block)
+                           for block in range(len(blocks[chroms]))]
+            merge_chroms_outputs(results=chroms_results,outputs=outputs,chain=args.chain,snapshots=snapshots)
+            if variants!=None:
+                for result in chroms_results:
+                    variants.update(result['variants'])
+        if pool!=None:
+            pool.join()
+    shutil.rmtree(simulation['tmp_dir'])
 
 ###### close all opened files
-    for sector,info in sectors.items():
-        info['snv_file'].close()
-        info['cnv_file'].close()
-
-    if args.cnv_profile!=None:
-        for sector,info in sectors.items():
-            info['cnv_profile_file'].close()
-
-    if args.cnv_rc!=None:
-        for sector,info in sectors.items():
-            if info['depth']!=None:
-                info['cnv_rc_file'].close()
-
-    if args.snv_genotype!=None:
-        genotype_file.close()
-
-    if args.ind_cnvs!=None:
-        ind_cnvs_file.close()
+    for output in outputs.values():
+        output.close()
+    if writer!=None:
+        writer.close()
 
 #    if args.haplotype_copy!=None:
 #        parental_copy_file.close()
@@ -983,47 +1346,460 @@ def main(progname=None):
 #        expands_segs_file.close()
 
     if args.nhx or args.NHX:
-        nodes_nSNV={}
-        nodes_nAMP={}
-        nodes_nDEL={}
-        for node,variants in all_nodes_vars.items():
-            nSNV,nAMP,nDEL=0,0,0
-            for var in variants:
-                form=var.split('#')[4]
-                if form.startswith('+'):
-                    nAMP+=1
-                elif form.startswith('-'):
-                    nDEL+=1
-                else:
-                    nSNV+=1
-            nodes_nSNV[node]=nSNV
-            nodes_nAMP[node]=nAMP
-            nodes_nDEL[node]=nDEL
-
-        if args.nhx:
-            mytree.attach_info(attr='vars',info=all_nodes_vars)
-            mytree.attach_info(attr='nSNV',info=nodes_nSNV,null=0)
-            mytree.attach_info(attr='nAMP',info=nodes_nAMP,null=0)
-            mytree.attach_info(attr='nDEL',info=nodes_nDEL,null=0)
-            with open(args.nhx,'w') as tree_data_file:
-                tree_data_file.write('{};\n'.format(mytree.tree2nhx(with_lens=True,attrs=['nodeid','vars','nSNV','nAMP','nDEL'])))
-        if args.NHX:
-            original_tree.attach_info(attr='vars',info=all_nodes_vars)
-            original_tree.attach_info(attr='nSNV',info=nodes_nSNV,null=0)
-            original_tree.attach_info(attr='nAMP',info=nodes_nAMP,null=0)
-            original_tree.attach_info(attr='nDEL',info=nodes_nDEL,null=0)
-            with open(args.NHX,'w') as tree_data_file:
-                tree_data_file.write('{};\n'.format(original_tree.tree2nhx(with_lens=True,attrs=['nodeid','vars','nSNV','nAMP','nDEL'])))
+        nodes_counts=variants.counts()
+#the variants of the nodes with more than --nhx_max_vars variants are referred to by
+#the range of their line numbers in --nodes_vars (the header is line 1), instead of being listed
+        nodes_vars_rows={}
+        if args.nhx_max_vars!=None:
+            for node,(first,last) in variants.nodes_rows().items():
+                if last-first+1>args.nhx_max_vars:
+                    nodes_vars_rows[node]='{}-{}'.format(first+2,last+2)
+        all_nodes_vars=variants.nodes_vars(skip=nodes_vars_rows)
+        for filename,tree in ((args.nhx,mytree),(args.NHX,original_tree)):
+            if filename:
+                tree.attach_info(attr='vars',info=all_nodes_vars)
+                tree.attach_info(attr='vars_rows',info=nodes_vars_rows)
+                tree.attach_info(attr='nSNV',info=nodes_counts['SNV'],null=0)
+                tree.attach_info(attr='nAMP',info=nodes_counts['AMP'],null=0)
+                tree.attach_info(attr='nDEL',info=nodes_counts['DEL'],null=0)
+                with open(filename,'w') as tree_data_file:
+                    tree.write_nhx(output=tree_data_file,with_lens=True,attrs=['nodeid','vars','vars_rows','nSNV','nAMP','nDEL'])
+                    tree_data_file.write(';\n')
 
 #output SNVs/CNVs on each node
     if args.nodes_vars:
         with open(args.nodes_vars,'w') as nodes_vars_file:
             nodes_vars_file.write('#node\tchr\thap\tstart\tend\tvar\n')
-            for node in sorted(all_nodes_vars.keys(),key=lambda x: int(x[4:])):
-                vars_list=[x.split('#') for x in all_nodes_vars[node]]
-                vars_list=sorted(vars_list,key=lambda x:(x[0],int(x[2]),int(x[3])))
-                for var in vars_list:
-                    nodes_vars_file.write('{}\t{}\n'.format(node,'\t'.join(var)))
+            variants.write(output=nodes_vars_file)
+
+def read_ensemble(ensemble_f=None):
+    '''
+    Check the format of ensemble file and return the list of replicates [(name,seed,options),...].
+    There should be 2 or 3 columns in the ensemble file.
+    1. the name of the replicate (also the name of its output directory)
+    2. random seed
+    3. the options of phylovar different from the command line for this replicate (optional),
+       e.g. --config high_rate.yaml --purity 0.6
+    '''
+    replicates=[]
+    names=set()
+    with open(ensemble_f) as input:
+        for line in input:
+            if line.startswith('#') or line.strip()=='':
+                continue
+            cols=line.split(maxsplit=2)
+            if len(cols)<2:
+                raise EnsembleFileError("There should be at least 2 columns in your ensemble file:\n{}".format(line))
+            name=cols[0]
+            if name in names:
+                raise EnsembleFileError("Found two replicates named {} in your ensemble file.".format(name))
+            names.add(name)
+            try:
+                seed=check_seed(cols[1])
+            except (ValueError,argparse.ArgumentTypeError):
+                raise EnsembleFileError("The random seed of the replicate below is invalid:\n{}".format(line))
+            options=[]
+            if len(cols)==3:
+                options=cols[2].split()
+            replicates.append((name,seed,options))
+    return replicates
+
+def replicate_args(parser=None,args=None,name=None,seed=None,options=None):
+    '''
+    Return the arguments of a replicate of the ensemble: the command line plus the options of the replicate,
+    with its own random seed and all the outputs in its own directory.
+    '''
+    original_args=parser.parse_args(sys.argv[1:])
+    rep_args=parser.parse_args(sys.argv[1:]+options)
+    for arg in ENSEMBLE_SHARED_ARGS:
+        if getattr(rep_args,arg)!=getattr(original_args,arg):
+            raise EnsembleFileError("The option --{} is shared by all replicates, ".format(arg)+
+                "it can not be changed for the replicate {}.".format(name))
+    rep_args.random_seed=seed
+#the replicates are simulated in parallel, and each of them uses one core
+    rep_args.cores=1
+    for arg in ENSEMBLE_OUTPUT_ARGS:
+        if getattr(rep_args,arg)!=None:
+            setattr(rep_args,arg,os.path.join(args.ensemble_dir,name,getattr(rep_args,arg)))
+    return rep_args
+
+#the tree shared by all replicates in a worker process
+WORKER_TREE_INFO=None
+
+def init_ensemble_worker(tree_info=None):
+    global WORKER_TREE_INFO
+    WORKER_TREE_INFO=tree_info
+
+def run_replicate(name=None,args=None,tree_info=None):
+    '''
+    Simulate a replicate of the ensemble on the tree prepared by prepare_tree.
+    '''
+    if tree_info==None:
+        tree_info=WORKER_TREE_INFO
+    logging.info(' Start the simulation for replicate: %s (random seed: %s)',name,args.random_seed)
+    os.mkdir(os.path.join(args.ensemble_dir,name),mode=0o755)
+    numpy.random.seed(args.random_seed)
+    final_chroms_cfg=chroms_config(args=args)
+    simulate_sample(args=args,final_chroms_cfg=final_chroms_cfg,tree_info=tree_info,seed=args.random_seed)
+
+def run_ensemble(parser=None,args=None,tree_info=None):
+    '''
+    Simulate all replicates in the ensemble file (--ensemble) on the same tree, --cores of them at a time.
+    '''
+    replicates=[]
+    for name,seed,options in read_ensemble(args.ensemble):
+        replicates.append((name,replicate_args(parser=parser,args=args,name=name,seed=seed,options=options)))
+    logging.info(' There are %s replicates in the ensemble.',len(replicates))
+    if args.cores==1:
+        for name,rep_args in replicates:
+            run_replicate(name=name,args=rep_args,tree_info=tree_info)
+    else:
+        pool=multiprocessing.Pool(processes=args.cores,initializer=init_ensemble_worker,initargs=(tree_info,))
+        results=[]
+        for name,rep_args in replicates:
+            results.append(pool.apply_async(run_replicate,kwds={'name':name,'args':rep_args}))
+        pool.close()
+        pool.join()
+        for result in results:
+            result.get()
+
+def emit_snapshot(progname=None):
+    '''
+    Write any outputs of a simulation from its snapshot (--snapshot) without simulating it again.
+    '''
+    t0 = time.time()
+    parser=argparse.ArgumentParser(
+        description='Write the outputs of phylovar from the snapshot of a simulation',
+        prog=progname)
+    group1=parser.add_argument_group('Input arguments')
+    group1.add_argument('--snapshot',type=str,required=True,metavar='DIR',
+        help='the snapshot directory saved by phylovar --snapshot')
+    group2=parser.add_argument_group('Output arguments (only the ones specified are written)')
+    default=None
+    group2.add_argument('-S','--snv',type=str,default=default,metavar='DIR',
+        help='the output directory to save SNVs files [{}]'.format(default))
+    default=None
+    group2.add_argument('-V','--cnv',type=str,default=default,metavar='DIR',
+        help='the output directory to save CNVs files [{}]'.format(default))
+    default=None
+    group2.add_argument('--nhx',type=str,default=default,metavar='FILE',
+        help='the output file in NHX format to save the pruned tree with all variants [{}]'.format(default))
+    default=None
+    group2.add_argument('--NHX',type=str,default=default,metavar='FILE',
+        help='the output file in NHX format to save the original tree with all variants [{}]'.format(default))
+    default=None
+    group2.add_argument('--nodes_vars',type=str,default=default,metavar='FILE',
+        help='the output file to save SNVs/CNVs on each node [{}]'.format(default))
+    default=None
+    group2.add_argument('--nhx_max_vars',type=int,default=default,metavar='INT',
+        help='the maximum number of variants listed on each node of --nhx/--NHX, the variants of a node with more variants '+
+            'are referred to by the range of their lines in --nodes_vars [{}]'.format(default))
+    default=None
+    group2.add_argument('--cnv_profile',type=str,default=default,metavar='DIR',
+        help='the output directory to save the files of CNV profile of each sector [{}]'.format(default))
+    default=None
+    group2.add_argument('--cnv_rc',type=str,default=default,metavar='DIR',
+        help='the output directory to save the files of simulated CNV read depth of each sector [{}]'.format(default))
+    default=None
+    group2.add_argument('--snv_genotype',type=str,default=default,metavar='FILE',
+        help='the file to save SNV genotypes for each cell [{}]'.format(default))
+    default=None
+    group2.add_argument('--ind_cnvs',type=str,default=default,metavar='FILE',
+        help='the file to save CNVs for each cell individual [{}]'.format(default))
+    default=None
+    group2.add_argument('--chain',type=check_folder,default=default,metavar='DIR',
+        help='directory to output chain files for each sample [{}]'.format(default))
+    default=None
+    group2.add_argument('--columnar',type=str,default=default,metavar='DIR',
+        help='directory to save the SNVs, CNVs, CNV profile (and SNV genotypes with --snv_genotype) of all sectors '+
+            'in columnar binary format (.npy), see psite.columnar.load [{}]'.format(default))
+    group2.add_argument('--bgzip',action='store_true',
+        help='compress the SNV/CNV files, --cnv_profile, --cnv_rc, --snv_genotype and --ind_cnvs by bgzip (with the suffix .gz)')
+    default='phylovar_emit.log'
+    group2.add_argument('-g','--log',type=str,default=default,metavar='FILE',
+        help='the log file [{}]'.format(default))
+    default='INFO'
+    group2.add_argument('-G','--loglevel',type=str,default=default,choices=['DEBUG','INFO'],
+        help='the logging level [{}]'.format(default))
+    default=1
+    group2.add_argument('--cores',type=int,default=default,metavar='INT',
+        help='number of cores used to write the chromosomes in parallel [{}]'.format(default))
+    args=parser.parse_args()
+    if all(getattr(args,arg)==None for arg in EMIT_OUTPUT_ARGS):
+        raise argparse.ArgumentTypeError("At least one of the outputs should be specified.")
+    if args.nhx_max_vars!=None and args.nodes_vars==None:
+        raise argparse.ArgumentTypeError("--nodes_vars must be specified with --nhx_max_vars.")
+
+    logging.basicConfig(filename=args.log, filemode='w',
+        format='[%(asctime)s] %(levelname)s: %(message)s',
+        datefmt='%m-%d %H:%M:%S',level=args.loglevel)
+    argv_copy=sys.argv[:]
+    argv_copy[1:1]=['phylovar','emit']
+    logging.info(' Command: %s',' '.join(argv_copy))
+    try:
+        with open(os.path.join(args.snapshot,'snapshot.json'),'r') as input_file:
+            snapshot=json.load(input_file)
+    except FileNotFoundError:
+        raise SnapshotError("Can not find the snapshot in the directory: {}".format(args.snapshot))
+    if snapshot['version']!=SNAPSHOT_VERSION:
+        raise SnapshotError("The snapshot {} is saved by another version of phylovar.".format(args.snapshot))
+#the tree and the sectors are built again from the input files of the simulation
+    sim_args=argparse.Namespace(**snapshot['args'])
+    for arg in SNAPSHOT_INPUT_ARGS:
+        if file_digest(getattr(sim_args,arg))!=snapshot['files'][arg]:
+            raise SnapshotError("The file {} (--{}) has been changed since the snapshot was saved.".format(getattr(sim_args,arg),arg))
+    for arg in EMIT_OUTPUT_ARGS:
+        setattr(sim_args,arg,getattr(args,arg))
+    for arg in ('nodes_ccf','trace','cache','snapshot'):
+        setattr(sim_args,arg,None)
+    sim_args.cores=args.cores
+    sim_args.bgzip=args.bgzip
+    sim_args.nhx_max_vars=args.nhx_max_vars
+    logging.info(' Random seed of the simulation: %s',snapshot['seed'])
+    tree_info=prepare_tree(args=sim_args)
+    simulate_sample(args=sim_args,final_chroms_cfg=snapshot['chroms_cfg'],tree_info=tree_info,seed=snapshot['seed'],emit=args.snapshot)
+    t1 = time.time()
+    print ("Total time running {}: {} seconds".format
+      (progname, str(t1-t0)))
+
+#use kernprof -l -v script.py to profile
+# @profile
+def main(progname=None):
+    t0 = time.time()
+    prog=progname if progname else sys.argv[0]
+#psite.py phylovar emit: write the outputs from a snapshot
+    if len(sys.argv)>1 and sys.argv[1]=='emit':
+        del sys.argv[1]
+        emit_snapshot(progname='{} emit'.format(prog))
+        return
+    parser=argparse.ArgumentParser(
+        description='Simulate SNVs/CNVs on a phylogenetic tree in newick format',
+        prog=prog)
+    group1=parser.add_argument_group('Input arguments')
+    group1.add_argument('-t','--tree',required=True,metavar='FILE',
+        help='a (gzipped) file containing !!!ONE!!! tree in newick format')
+    default=None
+    group1.add_argument('--trunk_vars',type=str,default=default,metavar='FILE',
+        help='a file containing truncal variants predefined by user [{}]'.format(default))
+    default=None
+    group1.add_argument('--config',type=str,default=default,metavar='FILE',
+        help='a YAML file which contains the configuration of somatic variant simulation. '+
+            '-n/-r/-R/-d/-l/-L/-c/-C/-p/--tstv/--length/--trunk_snv_rate/--trunk_cnv_rate will be ignored. [{}]'.format(default))
+    default=None
+    group1.add_argument('--affiliation',type=str,default=default,metavar='FILE',
+        help='a file containing sector affiliation of the cells in the sample [{}]'.format(default))
+    default=None
+    group1.add_argument('--cnvl_dist',type=str,default=default,metavar='FILE',
+        help="a file containing the distribution profile of CNVs' length [{}]".format(default))
+    default=None
+    group1.add_argument('--clone',type=str,default=default,metavar='FILE',
+        help="the tree file is a clone tree, and this file specifies the cells in each clone [{}]".format(default))
+    default=None
+    group1.add_argument('--ensemble',type=str,default=default,metavar='FILE',
+        help="a file listing the replicates (name, random seed and options) to simulate on the same tree [{}]".format(default))
+    group2=parser.add_argument_group('Simulation arguments (can be set in config YAML)')
+    default='1'
+    group2.add_argument('-n','--name',type=str,default=default,metavar='STR',
+        help='the name of the sequence to be simulated [{}]'.format(default))
+    default=300
+    group2.add_argument('-r','--snv_rate',type=float,default=default,metavar='FLOAT',
+        help='the muation rate of SNVs [{}]'.format(default))
+    default=3
+    group2.add_argument('-R','--cnv_rate',type=float,default=default,metavar='FLOAT',
+        help='the muation rate of CNVs [{}]'.format(default))
+    default=None
+    group2.add_argument('--trunk_snv_rate',type=float,default=default,metavar='FLOAT',
+        help='the muation rate of SNVs on trunk. It will be the same as --snv_rate if not being specified [{}]'.format(default))
+    default=None
+    group2.add_argument('--trunk_cnv_rate',type=float,default=default,metavar='FLOAT',
+        help='the muation rate of CNVs on trunk. It will be the same as --cnv_rate if not being specified [{}]'.format(default))
+    default=0.5
+    group2.add_argument('-d','--del_prob',type=float,default=default,metavar='FLOAT',
+        help='the probability of being deletion for a CNV mutation [{}]'.format(default))
+    default=1.0
+    group2.add_argument('--tandem_prob',type=float,default=default,metavar='FLOAT',
+        help='the probability of being tandem repeat for an amplification mutation [{}]'.format(default))
+#https://en.wikipedia.org/wiki/Copy-number_variation
+    default=20000000
+    group2.add_argument('-l','--cnv_length_beta',type=int,default=default,metavar='INT',
+        help='the mean of CNVs length [{}]'.format(default))
+    default=40000000
+    group2.add_argument('-L','--cnv_length_max',type=int,default=default,metavar='INT',
+        help='the maximium of CNVs length [{}]'.format(default))
+    default=0.5
+    group2.add_argument('-c','--copy_parameter',type=float,default=default,metavar='FLOAT',
+        help="the p parameter of CNVs' copy number distribution [{}]".format(default))
+    default=5
+    group2.add_argument('-C','--copy_max',type=int,default=default,metavar='INT',
+        help='the maximium ADDITIONAL copy of a CNVs [{}]'.format(default))
+    default='01'
+    group2.add_argument('-p','--parental',type=str,default=default,metavar='STR',
+        help='the parental to simulate [{}]'.format(default))
+    default=2.0
+    group2.add_argument('--tstv',type=check_tstv,default=default,metavar='FLOAT',
+        help='the ratio of ts/tv of SNV [{}]'.format(default))
+    default=100000000
+    group2.add_argument('--length',type=int,default=default,metavar='INT',
+        help='the length of the sequence to simulate [{}]'.format(default))
+    group3=parser.add_argument_group('Other simulation arguments (can NOT be set in config YAML)')
+    default=0.05
+    group3.add_argument('-x','--prune',type=check_prune,default=default,metavar='FLOAT',
+        help='trim all the children of the nodes with less than this proportion of total leaves [{}]'.format(default))
+    default=None
+    group3.add_argument('-s','--sex_chr',type=check_sex,default=default,metavar='STR',
+        help='sex chromosomes of the genome (separated by comma) [{}]'.format(default))
+    default=None
+    group3.add_argument('--random_seed',type=check_seed,metavar='INT',
+        help='the seed for random number generator (an integer between 0 and 2**31-1) [{}]'.format(default))
+    default=0
+    group3.add_argument('--trunk_length',type=float,default=default,metavar='FLOAT',
+        help='the length of the trunk [{}]'.format(default))
+    default=0.6
+    group3.add_argument('--purity',type=check_purity,default=default,metavar='FLOAT',
+        help='the proportion of tumor cells in simulated tumor sample [{}]'.format(default))
+    default=None
+    group3.add_argument('--depth',type=check_depth,default=default,metavar='FLOAT',
+        help='the sequencing depth of the whole tumor sample for read count simulation [{}]'.format(default))
+#Actually, the depth here and the depth in the affiliation file is the not the mean depth of the whole genome.
+#It's impossible to get that without calculating the size of all the genomes in sample. 
+#Here we set all the diploid part of the genome with this depth. And the depth of other part will be caculated 
+#according this.
+    default=150
+    group3.add_argument('--rlen',type=int,default=default,metavar='INT',
+        help='the read length for simulating the read count for each segment of the genome [{}]'.format(default))
+    default=1
+    group3.add_argument('--cores',type=int,default=default,metavar='INT',
+        help='number of cores used to simulate the chromosomes in parallel [{}]'.format(default))
+    default=None
+    group3.add_argument('--block_length',type=int,default=default,metavar='INT',
+        help='split each chromosome into blocks (not shorter than this length), which are simulated independently [{}]'.format(default))
+    group4=parser.add_argument_group('Output arguments')
+    group4.add_argument('--just_prune',action='store_true',
+        help='just prune the tree and output the pruned tree and the map of tipnode:cells')
+    default='phylovar_snvs'
+    group4.add_argument('-S','--snv',type=str,default=default,metavar='DIR',
+        help='the output directory to save SNVs files [{}]'.format(default))
+    default='phylovar_cnvs'
+    group4.add_argument('-V','--cnv',type=str,default=default,metavar='DIR',
+        help='the output directory to save CNVs files [{}]'.format(default))
+    default='phylovar.log'
+    group4.add_argument('-g','--log',type=str,default=default,metavar='FILE',
+        help='the log file [{}]'.format(default))
+    default='INFO'
+    group4.add_argument('-G','--loglevel',type=str,default=default,choices=['DEBUG','INFO'],
+        help='the logging level [{}]'.format(default))
+    default=None
+    group4.add_argument('--nhx',type=str,default=default,metavar='FILE',
+        help='the output file in NHX format to save the pruned tree with all variants [{}]'.format(default))
+    default=None
+    group4.add_argument('--NHX',type=str,default=default,metavar='FILE',
+        help='the output file in NHX format to save the original tree with all variants [{}]'.format(default))
+    default=None
+    group4.add_argument('--nodes_vars',type=str,default=default,metavar='FILE',
+        help='the output file to save SNVs/CNVs on each node [{}]'.format(default))
+    default=None
+    group4.add_argument('--nhx_max_vars',type=int,default=default,metavar='INT',
+        help='the maximum number of variants listed on each node of --nhx/--NHX, the variants of a node with more variants '+
+            'are referred to by the range of their lines in --nodes_vars [{}]'.format(default))
+    default=None
+    group4.add_argument('--nodes_ccf',type=str,default=default,metavar='FILE',
+        help='the output file to save CCF (Cancer Cell Fraction) of each node in each sector [{}]'.format(default))
+    default=None
+    group4.add_argument('--cnv_profile',type=str,default=default,metavar='DIR',
+        help='the output directory to save the files of CNV profile of each sector [{}]'.format(default))
+    default=None
+    group4.add_argument('--cnv_rc',type=str,default=default,metavar='DIR',
+        help='the output directory to save the files of simulated CNV read depth of each sector [{}]'.format(default))
+    default=None
+    group4.add_argument('--snv_genotype',type=str,default=default,metavar='FILE',
+        help='the file to save SNV genotypes for each cell [{}]'.format(default))
+    default=None
+    group4.add_argument('--ind_cnvs',type=str,default=default,metavar='FILE',
+        help='the file to save CNVs for each cell individual [{}]'.format(default))
+#    default=None
+#    parser.add_argument('--haplotype_copy',type=str,default=default,metavar='FILE',
+#        help='the file to save haplotype copy for each SNV')
+#    default=None
+#    parser.add_argument('--expands',type=str,default=default,metavar='FILE',
+#        help='the basename of the file to output the snv and segment data for EXPANDS [{}]'.format(default))
+    default=None
+    group4.add_argument('--map',type=check_folder,default=default,metavar='DIR',
+        help='directory to output the map file for each sector, which contain the relationship between tip nodes and original samples [{}]'.format(default))
+    default=None
+    group4.add_argument('--chain',type=check_folder,default=default,metavar='DIR',
+        help='directory to output chain files for each sample [{}]'.format(default))
+    default='phylovar_ensemble'
+    group4.add_argument('--ensemble_dir',type=str,default=default,metavar='DIR',
+        help='the output directory of --ensemble, the outputs of each replicate are saved in a folder named by the replicate [{}]'.format(default))
+    default=None
+    group4.add_argument('--cache',type=str,default=default,metavar='DIR',
+        help='directory to cache the simulation of each chromosome, which will be reused by the runs with the same settings [{}]'.format(default))
+    default=None
+    group4.add_argument('--trace',type=str,default=default,metavar='FILE',
+        help='the file to save every simulated mutation event (one JSON object per line) [{}]'.format(default))
+    default=None
+    group4.add_argument('--columnar',type=str,default=default,metavar='DIR',
+        help='directory to save the SNVs, CNVs, CNV profile (and SNV genotypes with --snv_genotype) of all sectors '+
+            'in columnar binary format (.npy), see psite.columnar.load [{}]'.format(default))
+    group4.add_argument('--bgzip',action='store_true',
+        help='compress the SNV/CNV files, --cnv_profile, --cnv_rc, --snv_genotype and --ind_cnvs by bgzip (with the suffix .gz)')
+    default=None
+    group4.add_argument('--snapshot',type=str,default=default,metavar='DIR',
+        help='directory to save the simulated variants of each chromosome, from which the outputs can be written again by "{} emit" [{}]'.format(prog,default))
+    args=parser.parse_args()
+    if args.block_length!=None and args.block_length<=0:
+        raise argparse.ArgumentTypeError("--block_length should be a positive integer.")
+    if args.just_prune:
+        if args.nhx==None or args.map==None:
+            raise argparse.ArgumentTypeError("--nhx and --map must be specified when phylovar run with --just_prune.")
+    if args.nhx_max_vars!=None and args.nodes_vars==None:
+        raise argparse.ArgumentTypeError("--nodes_vars must be specified with --nhx_max_vars.")
+
+
+    final_chroms_cfg=chroms_config(args=args)
+
+###### logging and random seed setting
+    logging.basicConfig(filename=args.log, filemode='w',
+        format='[%(asctime)s] %(levelname)s: %(message)s',
+        datefmt='%m-%d %H:%M:%S',level=args.loglevel)
+    argv_copy=sys.argv[:]
+    argv_copy.insert(1,'phylovar')
+    logging.info(' Command: %s',' '.join(argv_copy))
+    if args.random_seed==None:
+        seed=random_int()
+    else:
+        seed=args.random_seed
+    logging.info(' Random seed: %s',seed)
+    numpy.random.seed(seed)
+
+    if args.ensemble!=None:
+#the outputs only depend on the tree are shared by all replicates of the ensemble
+        os.mkdir(args.ensemble_dir,mode=0o755)
+        if args.map!=None:
+            args.map=os.path.join(args.ensemble_dir,args.map)
+        if args.nodes_ccf!=None:
+            args.nodes_ccf=os.path.join(args.ensemble_dir,args.nodes_ccf)
+    tree_info=prepare_tree(args=args)
+    mytree=tree_info['tree']
+    sectors=tree_info['sectors']
+    tipnode_list=tree_info['tipnode_list']
+
+#just prune tree and output the pruned tree and the map of tipnode:cells
+    if args.just_prune:
+        write_tipnode_maps(directory=args.map,sectors=sectors,tipnode_list=tipnode_list,leaf_tipnode=tree_info['leaf_tipnode'])
+        with open(args.nhx,'w') as tree_data_file:
+            mytree.write_nhx(output=tree_data_file,with_lens=True)
+            tree_data_file.write(';\n')
+        exit()
+
+###### output the map of tip_node(after pruning):leaf
+    if args.map!=None:
+        write_tipnode_maps(directory=args.map,sectors=sectors,tipnode_list=tipnode_list,leaf_tipnode=tree_info['leaf_tipnode'])
+
+    if args.ensemble!=None:
+        run_ensemble(parser=parser,args=args,tree_info=tree_info)
+    else:
+        simulate_sample(args=args,final_chroms_cfg=final_chroms_cfg,tree_info=tree_info,seed=seed)
     t1 = time.time()
     print ("Total time running {}: {} seconds".format
       (prog, str(t1-t0)))
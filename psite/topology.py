@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+import copy
+import numpy
+import psite.tree
+
+#The attributes set in psite.tree.Tree.__init__, which every node has, and their default values.
+NODE_DEFAULTS={'snvs':None,'accumulated_snvs':None,'cnvs':None,'accumulated_cnvs':None,'C':'0.0.0','accumulated_dels':None,'accumulated_cnvs_sorted':0}
+
+class Topology:
+    '''
+    The topology of a binary tree stored in numpy arrays, which is much more compact than a tree of
+    psite.tree.Tree objects. The nodes are indexed in the DFS (pre)order, so all the nodes under node i
+    are in the range [i,end[i]), and all the cells under node i are cells[cell_lo[i]:cell_hi[i]].
+    For node i:
+        parent[i]/left[i]/right[i]: the index of its ancestor/children (-1 if there is none)
+        lens[i]:  the length of its top branch (nan if there is none)
+        ids[i]:   the X in its nodeid 'nodeX'
+        names[i]: its name (None for inner nodes)
+        sim[i]:   whether to simulate variants on its top branch
+    After pruning, sector_counts[i][j] is the number of cells of sector sector_names[j] under node i,
+    and sector_cells[j] is the sorted positions of the cells of sector sector_names[j] in cells.
+    The other attributes of the nodes (e.g. snvs/cnvs) are saved in the lists in the dictionary attrs.
+    An overlay (see overlay()) shares all the arrays with its base Topology, and only has its own attrs,
+    which are dictionaries {node_index:value}. The tree of an overlay can be the subtree under root_index,
+    and then the length of the top branch of its root is root_lens instead of lens[root_index].
+    '''
+    def __init__(self,parent=None,left=None,right=None,lens=None,ids=None,names=None,end=None,
+                 sim=None,cells=None,cell_lo=None,cell_hi=None,sector_names=None,sector_counts=None,sector_cells=None):
+        self.parent=numpy.asarray(parent,dtype=numpy.int64)
+        self.left=numpy.asarray(left,dtype=numpy.int64)
+        self.right=numpy.asarray(right,dtype=numpy.int64)
+        self.lens=numpy.asarray(lens,dtype=numpy.float64)
+        self.ids=numpy.asarray(ids,dtype=numpy.int64)
+        self.names=names
+        self.end=numpy.asarray(end,dtype=numpy.int64)
+        self.size=len(self.parent)
+        if sim is None:
+            self.sim=numpy.ones(self.size,dtype=bool)
+        else:
+            self.sim=numpy.asarray(sim,dtype=bool)
+        self.is_leaf=(self.left<0)&(self.right<0)
+        self.leaves=numpy.flatnonzero(self.is_leaf)
+#the leaves under node i are leaves[leaf_lo[i]:leaf_hi[i]]
+        leaf_rank=numpy.concatenate(([0],numpy.cumsum(self.is_leaf)))
+        self.leaf_lo=leaf_rank[:-1]
+        self.leaf_hi=leaf_rank[self.end]
+        if cells is None:
+            self.cells=[self.names[i] for i in self.leaves]
+            self.cell_lo=self.leaf_lo
+            self.cell_hi=self.leaf_hi
+        else:
+            self.cells=cells
+            self.cell_lo=numpy.asarray(cell_lo,dtype=numpy.int64)
+            self.cell_hi=numpy.asarray(cell_hi,dtype=numpy.int64)
+        self.sector_names=sector_names
+        self.sector_counts=sector_counts
+        self.sector_cells=sector_cells
+        self.attrs={}
+        self.base=None
+        self.post=None
+        self.root_index=0
+        self.root_lens=None
+
+    def root(self):
+        return Node(topology=self,index=self.root_index)
+
+    def nodeid(self,i):
+        return 'node{}'.format(self.ids[i])
+
+    def get_attr(self,attr=None,i=None):
+        values=self.attrs.get(attr)
+        if values is not None and (self.base is None or i in values):
+            return values[i]
+        elif self.base is not None:
+            return self.base.get_attr(attr=attr,i=i)
+        elif attr in NODE_DEFAULTS:
+            return NODE_DEFAULTS[attr]
+        else:
+            raise AttributeError(attr)
+
+    def set_attr(self,attr=None,i=None,value=None):
+        if attr not in self.attrs:
+            if self.base is None:
+                self.attrs[attr]=[NODE_DEFAULTS.get(attr)]*self.size
+            else:
+                self.attrs[attr]={}
+        self.attrs[attr][i]=value
+
+    def overlay(self,root=None,lens=None):
+        '''
+        Return a Topology sharing the tree structure (all the arrays) with this one, but with its own attrs.
+        The attributes set on the overlay do not change this Topology, and the attributes not set on
+        the overlay are read from this Topology. It is used to simulate the variants of each haplotype
+        on the same tree without copying the tree.
+        With root, the tree of the overlay is the subtree under node root, and lens is the length of its
+        top branch. It is used for the new copies of amplifications, so the memory of a copy is in
+        proportion to the variants on it instead of the size of the subtree.
+        '''
+        overlay=copy.copy(self)
+        overlay.attrs={}
+        overlay.base=self
+        if root!=None:
+            overlay.root_index=root
+            overlay.root_lens=numpy.nan if lens==None else lens
+        return overlay
+
+    def postorder(self):
+        '''
+        Return (order,rank): order is the indexes of all the nodes in postorder, and rank[i] is the position
+        of node i in order. The nodes under node i are order[rank[i]-(end[i]-i)+1:rank[i]+1].
+        '''
+        if self.base is not None:
+            return self.base.postorder()
+        if self.post is None:
+#depth[i] is the number of ancestors of node i, i.e. the number of intervals (j,end[j]) covering i
+            diff=numpy.zeros(self.size+1,dtype=numpy.int64)
+            numpy.add.at(diff,numpy.arange(1,self.size+1),1)
+            numpy.add.at(diff,self.end,-1)
+            depth=numpy.cumsum(diff[:-1])
+#in postorder, node i comes after the i nodes before it in preorder except its ancestors, and after its descendants
+            rank=numpy.arange(self.size)-depth+(self.end-numpy.arange(self.size))-1
+            order=numpy.empty(self.size,dtype=numpy.int64)
+            order[rank]=numpy.arange(self.size)
+            self.post=(order,rank)
+        return self.post
+
+    def leaves_count(self):
+        '''
+        The number of cells under each node.
+        '''
+        return self.cell_hi-self.cell_lo
+
+    def expand_clone(self,clones=None):
+        '''
+        Put the cells of each clone in the DICTIONARY (clones) onto each leaf named after the clone.
+        '''
+        cells=[]
+        leaf_cells_count=[]
+        for i in self.leaves:
+            leaf_cells=self.cells[self.cell_lo[i]:self.cell_hi[i]]
+            leaf_cells=clones.get(self.names[i],leaf_cells)
+            cells.extend(leaf_cells)
+            leaf_cells_count.append(len(leaf_cells))
+        cell_rank=numpy.concatenate(([0],numpy.cumsum(leaf_cells_count,dtype=numpy.int64)))
+        self.cells=cells
+        self.cell_lo=cell_rank[self.leaf_lo]
+        self.cell_hi=cell_rank[self.leaf_hi]
+
+    def prune(self,sectors=None):
+        '''
+        Return the pruned Topology and a dictionary of the cells under its tipnodes {tipnode1:[cell1,cell2,...],...}.
+        The rules of pruning are the same as psite.tree.Tree.collect_leaves_and_trim:
+        1) An inner node is kept as an inner node only if one of its children has NO LESS than the prune_n
+           cells of one sector. Otherwise, it will be pruned into a tipnode.
+        2) A tipnode is marked with sim=False, if its cells are less than the cutoffs of ALL sectors.
+        3) Each tipnode is renamed with its nodeid.
+        '''
+        sector_names=list(sectors)
+        cutoffs=numpy.array([sectors[sector]['prune_n'] for sector in sector_names])
+        cell_index={cell:k for k,cell in enumerate(self.cells)}
+        sector_cells=[]
+        sector_counts=numpy.zeros((self.size,len(sector_names)),dtype=numpy.int64)
+        for j,sector in enumerate(sector_names):
+            positions=[cell_index[cell] for cell in sectors[sector]['members'] if cell in cell_index]
+            positions=numpy.unique(numpy.array(positions,dtype=numpy.int64))
+            sector_cells.append(positions)
+#the cells under each node are continuous in DFS order, so the count of each node is a difference of the prefix counts
+            sector_counts[:,j]=numpy.searchsorted(positions,self.cell_hi)-numpy.searchsorted(positions,self.cell_lo)
+        big=(sector_counts>=cutoffs).any(axis=1)
+        expand=numpy.zeros(self.size,dtype=bool)
+        has_left=self.left>=0
+        has_right=self.right>=0
+        expand[has_left]|=big[self.left[has_left]]
+        expand[has_right]|=big[self.right[has_right]]
+#drop all nodes under the nodes which are not expanded
+        collapsed=numpy.flatnonzero(~expand)
+        depth=numpy.zeros(self.size+1,dtype=numpy.int64)
+        numpy.add.at(depth,collapsed+1,1)
+        numpy.subtract.at(depth,self.end[collapsed],1)
+        keep=numpy.cumsum(depth[:-1])==0
+        kept=numpy.flatnonzero(keep)
+        new_index=numpy.cumsum(keep)-1
+        kept_rank=numpy.concatenate(([0],numpy.cumsum(keep)))
+        tips=~expand[kept]
+        left=numpy.where(tips|(self.left[kept]<0),-1,new_index[self.left[kept]])
+        right=numpy.where(tips|(self.right[kept]<0),-1,new_index[self.right[kept]])
+        parent=numpy.where(self.parent[kept]<0,-1,new_index[self.parent[kept]])
+        names=[self.names[i] for i in kept]
+        tipnode_leaves={}
+        for k in numpy.flatnonzero(tips):
+            i=kept[k]
+            names[k]=self.nodeid(i)
+            tipnode_leaves[names[k]]=self.cells[self.cell_lo[i]:self.cell_hi[i]]
+        pruned=Topology(parent=parent,left=left,right=right,lens=self.lens[kept],ids=self.ids[kept],names=names,
+                        end=kept_rank[self.end[kept]],sim=numpy.where(tips,big[kept],True),
+                        cells=self.cells,cell_lo=self.cell_lo[kept],cell_hi=self.cell_hi[kept],
+                        sector_names=sector_names,sector_counts=sector_counts[kept],sector_cells=sector_cells)
+        for attr,values in self.attrs.items():
+            pruned.attrs[attr]=[values[i] for i in kept]
+        return pruned,tipnode_leaves
+
+class Node(psite.tree.Tree):
+    '''
+    A thin view of one node in a Topology. It works as a psite.tree.Tree, but all the information
+    of the node is saved in the Topology, so the view itself only holds the topology and the index.
+    '''
+    __slots__=('topology','index')
+
+    def __init__(self,topology=None,index=0):
+        object.__setattr__(self,'topology',topology)
+        object.__setattr__(self,'index',index)
+
+    def __getattr__(self,attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return self.topology.get_attr(attr=attr,i=self.index)
+
+    def __setattr__(self,attr,value):
+        if attr in Node.__slots__ or isinstance(getattr(Node,attr,None),property):
+            object.__setattr__(self,attr,value)
+        else:
+            self.topology.set_attr(attr=attr,i=self.index,value=value)
+
+    def __eq__(self,other):
+        if isinstance(other,Node):
+            return self.topology is other.topology and self.index==other.index
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.topology),self.index))
+
+    @property
+    def left(self):
+        i=self.topology.left[self.index]
+        return Node(topology=self.topology,index=i) if i>=0 else None
+
+    @property
+    def right(self):
+        i=self.topology.right[self.index]
+        return Node(topology=self.topology,index=i) if i>=0 else None
+
+    @property
+    def top(self):
+        if self.index==self.topology.root_index:
+            return None
+        i=self.topology.parent[self.index]
+        return Node(topology=self.topology,index=i) if i>=0 else None
+
+    @property
+    def lens(self):
+        topology=self.topology
+        if self.index==topology.root_index and topology.root_lens is not None:
+            lens=topology.root_lens
+        else:
+            lens=topology.lens[self.index]
+        return None if numpy.isnan(lens) else float(lens)
+
+    @lens.setter
+    def lens(self,value):
+        topology=self.topology
+        if self.index==topology.root_index and topology.root_lens is not None:
+            topology.root_lens=numpy.nan if value==None else value
+        else:
+            topology.lens[self.index]=numpy.nan if value==None else value
+
+    @property
+    def name(self):
+        return self.topology.names[self.index]
+
+    @name.setter
+    def name(self,value):
+        self.topology.names[self.index]=value
+
+    @property
+    def nodeid(self):
+        return self.topology.nodeid(self.index)
+
+    @property
+    def sim(self):
+        return bool(self.topology.sim[self.index])
+
+    @sim.setter
+    def sim(self,value):
+        self.topology.sim[self.index]=value
+
+    @property
+    def sectors(self):
+        if self.topology.sector_names is None:
+            raise AttributeError('sectors')
+        counts=self.topology.sector_counts[self.index]
+        return {sector:int(counts[j]) for j,sector in enumerate(self.topology.sector_names)}
+
+    def sectors_counts(self,sector_names=None):
+        if sector_names==self.topology.sector_names:
+            return self.topology.sector_counts[self.index]
+        return psite.tree.Tree.sectors_counts(self,sector_names=sector_names)
+
+    @property
+    def leaves_count(self):
+        return int(self.topology.cell_hi[self.index]-self.topology.cell_lo[self.index])
+
+    @property
+    def leaves_names(self):
+        return self.topology.cells[self.topology.cell_lo[self.index]:self.topology.cell_hi[self.index]]
+
+    @property
+    def tipnodes(self):
+        topology=self.topology
+        return [topology.nodeid(i) for i in topology.leaves[topology.leaf_lo[self.index]:topology.leaf_hi[self.index]]]
+
+    def tipnodes_range(self,tipnode_index=None):
+        return int(self.topology.leaf_lo[self.index]),int(self.topology.leaf_hi[self.index])
+
+    def preorder(self):
+        return [Node(topology=self.topology,index=i) for i in range(self.index,self.topology.end[self.index])]
+
+    def postorder(self):
+        order,rank=self.topology.postorder()
+        last=rank[self.index]
+        first=last-(self.topology.end[self.index]-self.index)+1
+        return [Node(topology=self.topology,index=i) for i in order[first:last+1]]
+
+    def new_copy(self,lens=None):
+        return Node(topology=self.topology.overlay(root=self.index,lens=lens),index=self.index)
+
+    def haplotype_tree(self):
+        return Node(topology=self.topology.overlay(),index=self.index)
+
+    def leaves_counting(self):
+        return self.leaves_count
+
+    def leaves_naming(self):
+        return self.leaves_names
+
+    def collect_tipnodes(self):
+        return self.tipnodes
+
+    def expand_clone(self,clones=None):
+        self.topology.expand_clone(clones=clones)
+
+    def updated_leaves_name_count(self):
+        return self.leaves_names,self.leaves_count
+
+    def collect_sectors_nodes(self,sectors=None):
+        topology=self.topology
+        if topology.sector_names is None:
+            return psite.tree.Tree.collect_sectors_nodes(self,sectors=sectors)
+        span=slice(self.index,topology.end[self.index])
+        for j,sector in enumerate(topology.sector_names):
+            if sector in sectors:
+                nodes=numpy.flatnonzero(topology.sector_counts[span,j]>0)+self.index
+                if len(nodes):
+                    sectors[sector].setdefault('nodes',set()).update(topology.nodeid(i) for i in nodes)
+
+    def prune(self,sectors=None):
+        '''
+        Prune the Topology, and then this node will be the root of the pruned Topology.
+        After this method, the root node will have an attribute tipnode_leaves,
+        which is a dictionary in the form of {tipnode1:[leaf1,leaf2,...],tipnode2:[leaf3,...],...}
+        '''
+        if hasattr(self,'tipnode_leaves'):
+            raise psite.tree.TreePruneError('Can not prune a tree which is pruned before!')
+        topology,tipnode_leaves=self.topology.prune(sectors=sectors)
+        object.__setattr__(self,'topology',topology)
+        object.__setattr__(self,'index',0)
+        self.tipnode_leaves=tipnode_leaves
+
+class TopologyBuilder:
+    '''
+    Build a Topology node by node, in the order the nodes appear in a newick string.
+    It has the same interface as psite.tree.TreeBuilder.
+    '''
+    def __init__(self):
+        self.parent=[]
+        self.left=[]
+        self.right=[]
+        self.lens=[]
+        self.names=[]
+        self.end=[]
+        self.current=-1
+
+    def add(self,name=None):
+        '''
+        Add a new child to the current node and move to it.
+        '''
+        i=len(self.parent)
+        if self.current>=0:
+            if self.left[self.current]==-1:
+                self.left[self.current]=i
+            elif self.right[self.current]==-1:
+                self.right[self.current]=i
+            else:
+                raise psite.tree.ShouldNotBeHereError
+        self.parent.append(self.current)
+        self.left.append(-1)
+        self.right.append(-1)
+        self.lens.append(numpy.nan)
+        self.names.append(name)
+        self.end.append(-1)
+        self.current=i
+
+    def up(self):
+        '''
+        Move back to the ancestor of the current node. All the nodes under the current node have been added.
+        '''
+        self.end[self.current]=len(self.parent)
+        self.current=self.parent[self.current]
+
+    def set_lens(self,lens=None):
+        self.lens[self.current]=lens
+
+    def finish(self):
+        size=len(self.parent)
+        end=[size if x==-1 else x for x in self.end]
+        topology=Topology(parent=self.parent,left=self.left,right=self.right,lens=self.lens,
+                          ids=range(1,size+1),names=self.names,end=end)
+        return topology.root()
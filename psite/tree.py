@@ -1,14 +1,19 @@
 #!/usr/bin/env python3
 
 import re
+import bisect
 import pickle
 import numpy
 import copy
 import logging
 import os
+import gzip
+import itertools
+import json
+import io
+import psite.writer
 
 class Tree:
-    snv_pos=set()
     def __init__(self,name=None,lens=None,left=None,right=None,top=None,snvs=None,accumulated_snvs=None,cnvs=None,accumulated_cnvs=None,C='0.0.0',nodeid=None,sim=True):
         self.name=name
         self.lens=lens
@@ -21,6 +26,12 @@ class Tree:
 #it's a list of dictionary and each dictionary contains those keys {type,start,end,copy,leaves_count,pre_snvs,new_copies} of each cnv that occured on its top branch
         self.cnvs=cnvs                         
         self.accumulated_cnvs=accumulated_cnvs 
+#accumulated_snvs is sorted by (start,end), and accumulated_dels is the Intervals of the
+#deletions on the lineage, so the variants in a region can be found by binary search.
+#accumulated_cnvs is sorted by (start,end) before each new cnv, and the new cnvs are appended to it,
+#its first accumulated_cnvs_sorted cnvs are the sorted ones.
+        self.accumulated_dels=None
+        self.accumulated_cnvs_sorted=0
         self.C=C
         self.nodeid=nodeid
         self.sim=sim
@@ -42,16 +53,94 @@ class Tree:
             raise ShouldNotBeHereError
         return self
 
+    def new_copy(self,lens=None):
+        '''
+        Build a new copy of the subtree under this node for an amplification.
+        The root of the new copy has the same name/nodeid as this node, but its branch length is lens.
+        '''
+        segment=Tree(name=self.name,lens=lens,nodeid=self.nodeid,sim=self.sim)
+        if hasattr(self,'sectors'):
+            segment.sectors=self.sectors
+        if self.left != None:
+            segment.left=copy.deepcopy(self.left)
+            segment.left.top=segment
+        if self.right != None:
+            segment.right=copy.deepcopy(self.right)
+            segment.right.top=segment
+        return segment
+
+    def preorder(self):
+        '''
+        Return a list of all the nodes under this node (included) in preorder: node, left subtree, right subtree.
+        The traversal is iterative, so the depth of the tree is not limited by the recursion limit of python.
+        '''
+        nodes=[]
+        stack=[self]
+        while stack:
+            node=stack.pop()
+            nodes.append(node)
+            if node.right!=None:
+                stack.append(node.right)
+            if node.left!=None:
+                stack.append(node.left)
+        return nodes
+
+    def postorder(self):
+        '''
+        Return a list of all the nodes under this node (included) in postorder: left subtree, right subtree, node.
+        '''
+        nodes=[]
+        stack=[self]
+        while stack:
+            node=stack.pop()
+            nodes.append(node)
+            if node.left!=None:
+                stack.append(node.left)
+            if node.right!=None:
+                stack.append(node.right)
+        nodes.reverse()
+        return nodes
+
     #@profile
+    def haplotype_tree(self):
+        '''
+        Return a copy of this tree to simulate the variants of one haplotype on it.
+        '''
+        return copy.deepcopy(self)
+
     def add_snv_cnv(self,start=None,end=None,inherent_snvs=None,inherent_cnvs=None,
                     snv_rate=None,cnv_rate=None,trunk_snv_rate=None,trunk_cnv_rate=None,
                     del_prob=None,tandem_prob=None,cnv_length_beta=None,
-                    cnv_length_max=None,cn_dist_cfg=None,tstv_dist_cfg=None,cnvl_dist=None,parental=None):
+                    cnv_length_max=None,cn_dist_cfg=None,tstv_dist_cfg=None,cnvl_dist=None,parental=None,snv_positions=None,trace=None):
         '''
         Randomly put SNVs and CNVs on a phylogenetic tree.
         For amplifications, we will build a new tree for every new copy and use this method to add SNVs/CNVs on the new tree.
         NOTE: 1. For both SNV and CNV, the position is 0 based.
               2. For each CNVs, its start is inclusive, but its end is not: [start, end).
+              3. snv_positions (SnvPositions) holds the positions already taken by SNVs in this chromosome.
+              4. If trace (MutationTrace) is not None, every new SNV/CNV is written to it.
+        '''
+        if snv_positions==None:
+            snv_positions=SnvPositions()
+        for node in self.preorder():
+            node.add_snv_cnv_on_branch(start=start,end=end,inherent_snvs=inherent_snvs,inherent_cnvs=inherent_cnvs,
+                                       snv_rate=snv_rate,cnv_rate=cnv_rate,
+                                       trunk_snv_rate=trunk_snv_rate,trunk_cnv_rate=trunk_cnv_rate,
+                                       del_prob=del_prob,tandem_prob=tandem_prob,
+                                       cnv_length_beta=cnv_length_beta,cnv_length_max=cnv_length_max,
+                                       cn_dist_cfg=cn_dist_cfg,tstv_dist_cfg=tstv_dist_cfg,cnvl_dist=cnvl_dist,parental=parental,
+                                       snv_positions=snv_positions,trace=trace)
+#only root node have inherent_snvs and inherent_cnvs
+            inherent_snvs=[]
+            inherent_cnvs=[]
+
+    def add_snv_cnv_on_branch(self,start=None,end=None,inherent_snvs=None,inherent_cnvs=None,
+                              snv_rate=None,cnv_rate=None,trunk_snv_rate=None,trunk_cnv_rate=None,
+                              del_prob=None,tandem_prob=None,cnv_length_beta=None,
+                              cnv_length_max=None,cn_dist_cfg=None,tstv_dist_cfg=None,cnvl_dist=None,parental=None,snv_positions=None,trace=None):
+        '''
+        Randomly put SNVs and CNVs on the top branch of this node.
+        The top node of this node should have been processed before this node.
         '''
 #rescale mutation rate according the length of the sequence
         if inherent_snvs==None:
@@ -59,24 +148,37 @@ class Tree:
         if inherent_cnvs==None:
             inherent_cnvs=[]
         length=end-start
-        logging.debug('%s with length: %s',self.nodeid,self.lens)
-        logging.debug('Structure: %s',self.tree2nhx())
+#the arguments of some debug messages are expensive (e.g. tree2nhx), only build them when they will be logged
+        debug=logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
+            logging.debug('%s with length: %s',self.nodeid,self.lens)
+            logging.debug('Structure: %s',self.tree2nhx())
         self.snvs=[]
         self.cnvs=[]
         self.accumulated_snvs=[]
         self.accumulated_cnvs=[]
+        self.accumulated_cnvs_sorted=0
+        self.accumulated_dels=Intervals()
         if self.top == None: 
 #root node, may have inherent_snvs
             self.snvs=inherent_snvs[:]
             self.cnvs=inherent_cnvs[:]
-            self.accumulated_snvs=inherent_snvs[:]
+            self.accumulated_snvs=sorted(inherent_snvs,key=lambda snv:(snv['start'],snv['end']))
             self.accumulated_cnvs=inherent_cnvs[:]
+            for cnv in inherent_cnvs:
+                if cnv['type']=='DEL':
+                    self.accumulated_dels.add(start=cnv['start'],end=cnv['end'])
         else:
 #non-root node inherits snvs/cnvs from its top nodes 
             if self.top.accumulated_snvs != None:
                 self.accumulated_snvs=self.top.accumulated_snvs[:] 
             if self.top.accumulated_cnvs != None:
                 self.accumulated_cnvs=self.top.accumulated_cnvs[:]
+                self.accumulated_cnvs_sorted=self.top.accumulated_cnvs_sorted
+            if self.top.accumulated_dels != None:
+                self.accumulated_dels=self.top.accumulated_dels.copy()
+#the ids of the snvs in self.snvs, to tell the new snvs from the pre_snvs in a deletion
+        branch_snvs_id=set(id(snv) for snv in self.snvs)
 #rescale with the length
         if self.nodeid=='node1':
             mutation_rate=trunk_snv_rate+trunk_cnv_rate
@@ -90,101 +192,84 @@ class Tree:
                 snv_prob=trunk_snv_rate/(trunk_snv_rate+trunk_cnv_rate)
             else:
                 snv_prob=snv_rate/(snv_rate+cnv_rate)
-            mutation_waiting_times=waiting_times(span=self.lens,rate=mutation_rate)
-            for waiting_t in mutation_waiting_times:
-                if numpy.random.uniform()<snv_prob:
+            events=branch_events(span=self.lens,rate=mutation_rate,snv_prob=snv_prob,start=start,end=end,
+                                 del_prob=del_prob,tandem_prob=tandem_prob,cnv_length_beta=cnv_length_beta,
+                                 cnv_length_max=cnv_length_max,cn_dist_cfg=cn_dist_cfg,tstv_dist_cfg=tstv_dist_cfg,
+                                 cnvl_dist=cnvl_dist)
+            leaves_count=self.leaves_counting()
+            snv_i=0
+            cnv_i=0
+            for waiting_t,is_snv in zip(events['time'],events['is_snv']):
+                if is_snv:
 #snv
 #make sure at most one SNV mutated on each position.
-                    pos=numpy.random.randint(start,end)
-                    hit=0
-                    while pos in Tree.snv_pos:
-                        hit+=1
-                        if hit>10:
-                            raise TooManyHitsOnSamePosError
-                        pos=numpy.random.randint(start,end)
-                    new_snv=True
-                    if self.accumulated_cnvs:
-                        for del_start,del_end in [[cnv['start'],cnv['end']] for cnv in self.accumulated_cnvs if cnv['type']=='DEL']:
-                            if del_start<=pos<del_end:
-                                new_snv=False
-                                break
-                    if new_snv:
-                        Tree.snv_pos.add(pos)
+                    pos=events['snv_pos'][snv_i]
+                    mutation=events['snv_form'][snv_i]
+                    snv_i+=1
+                    if pos in snv_positions:
+                        pos=snv_positions.draw(start=start,end=end)
+                    if not self.accumulated_dels.covers(pos):
+                        snv_positions.add(pos=pos)
                         snv={'type':'SNV',
                              'parental':parental,
                              'start':pos,
                              'end':pos+1,
-                             'mutation':numpy.random.choice(tstv_dist_cfg['form'],p=tstv_dist_cfg['prob'])}
+                             'mutation':mutation}
                         self.snvs.append(snv)
-                        self.accumulated_snvs.append(snv)
-                        logging.debug('New SNV: %s',pos)
-                        logging.debug('The length of the branch new SNV locates at: %s',self.lens)
-                        logging.debug('Structure: %s',self.tree2nhx())
+                        branch_snvs_id.add(id(snv))
+                        insort_var(variants=self.accumulated_snvs,var=snv)
+                        if trace!=None:
+                            trace.write(seg=[start,end],node=self.nodeid,time=waiting_t,
+                                        type='SNV',start=pos,end=pos+1,var=mutation)
+                        if debug:
+                            logging.debug('New SNV: %s',pos)
+                            logging.debug('The length of the branch new SNV locates at: %s',self.lens)
+                            logging.debug('Structure: %s',self.tree2nhx())
                 else:
 #cnvs
 #if the new cnv overlap with accumulated_dels, compare it with the accumulated dels 
 #and only keep those new regions.
-                    larger_than_host=0
-                    cnv_length=get_cnv_length(cnvl_dist=cnvl_dist,cnvl_beta=cnv_length_beta,cnvl_max=cnv_length_max)
-                    while cnv_length>=end-start:
-                        larger_than_host+=1
-                        if larger_than_host>10:
-                            break
-                        else:
-                            cnv_length=get_cnv_length(cnvl_dist=cnvl_dist,cnvl_beta=cnv_length_beta,cnvl_max=cnv_length_max)
-                    if larger_than_host>10:
+                    cnv_start=events['cnv_start'][cnv_i]
+                    cnv_end=events['cnv_end'][cnv_i]
+                    is_del=events['cnv_del'][cnv_i]
+                    cnv_copy=events['cnv_copy'][cnv_i]
+                    targets=events['cnv_target'][cnv_i]
+                    cnv_i+=1
+#the cnv is longer than the host sequence
+                    if cnv_start<0:
                         continue
-                    cnv_start=numpy.random.randint(start,end-cnv_length)
-                    cnv_end=cnv_start+cnv_length
-                    leaves_count=self.leaves_counting()
-                    new_cnvs=[[cnv_start,cnv_end]]
-                    logging.debug('New CNV: %s',str(new_cnvs))
-                    logging.debug('Previous deletions: %s',str([[cnv['start'],cnv['end']] for cnv in self.accumulated_cnvs if cnv['type']=='DEL']))
-#We need to modify new_cnvs in place. Let's sort cnvs in accumulated_cnvs first.
-#After the sorting, all deletions in accumulated_cnvs should be ordered and without overlapping regions.
-#Without this, there will be problems.
-                    self.accumulated_cnvs.sort(key=lambda cnv: (cnv['start'],cnv['end']))
-                    for cnv in new_cnvs: 
-                        for del_start,del_end in [[cnv['start'],cnv['end']] for cnv in self.accumulated_cnvs if cnv['type']=='DEL']:
-                            if cnv[0]<del_start:
-                                if del_start<=cnv[1]<=del_end:
-                                    cnv[1]=del_start
-                                elif cnv[1]>del_end:
-                                    new_cnvs.append([del_end,cnv[1]])
-                                    cnv[1]=del_start
-                                else:
-#cnv_end < current_del_start, that means cnv_end is less than start points of all left dels
-                                    break
-                            elif del_start<=cnv[0]<=del_end:
-                                if del_start<=cnv[1]<=del_end:
-                                    new_cnvs.remove(cnv)
-                                    break
-                                elif cnv[1]>del_end:
-                                    cnv[0]=del_end
-                                else:
-                                    raise ShouldNotBeHereError
-                    logging.debug('New CNVs after adjusting to previous deletions: %s',str(new_cnvs))
-                    if len(new_cnvs)==0 or len(new_cnvs[0])==0:
+#the order of the cnvs with the same target in the chain files follows accumulated_cnvs
+                    self.accumulated_cnvs_sorted=insort_tail(variants=self.accumulated_cnvs,sorted_count=self.accumulated_cnvs_sorted)
+                    if debug:
+                        logging.debug('New CNV: %s',[[cnv_start,cnv_end]])
+                        logging.debug('Previous deletions: %s',self.accumulated_dels)
+#only keep the regions of the new cnv which are not in previous deletions
+                    new_cnvs=self.accumulated_dels.subtract(start=cnv_start,end=cnv_end)
+                    if debug:
+                        logging.debug('New CNVs after adjusting to previous deletions: %s',new_cnvs)
+                    if not new_cnvs:
                         continue
 ########################################################################################################################
-                    if numpy.random.uniform()<del_prob:
+                    if is_del:
 #the new cnv is a deletion
-                        logging.debug('New CNVs are deletions.')
-                        logging.debug('%s accumulated_snvs: %s.',self.nodeid,str([x['start'] for x in self.accumulated_snvs]))
-                        logging.debug('%s snvs: %s.',self.nodeid,str([x['start'] for x in self.snvs]))
+                        if debug:
+                            logging.debug('New CNVs are deletions.')
+                            logging.debug('%s accumulated_snvs: %s.',self.nodeid,[x['start'] for x in self.accumulated_snvs])
+                            logging.debug('%s snvs: %s.',self.nodeid,[x['start'] for x in self.snvs])
                         for del_start,del_end in new_cnvs:
 #output pre_snvs to self.cnvs, so it can be used to correct the count of snvs 
-                            pre_snvs=[]
-#We need to use a copy of self.accumulated_snvs for the 'for loop'.
-#Without that, modify this list in place will cause some element bypassed.
-                            for snv in self.accumulated_snvs[:]:
-                                if del_start<=snv['start']<del_end:
-                                    self.accumulated_snvs.remove(snv)
-                                    if snv in self.snvs:
-                                        self.snvs.remove(snv)
-                                    else:
-                                        pre_snvs.append(snv)
-                            logging.debug('pre_snvs in new DELs regions: %s.',str(pre_snvs))
+                            lo=bisect_var(variants=self.accumulated_snvs,pos=del_start)
+                            hi=bisect_var(variants=self.accumulated_snvs,pos=del_end)
+                            deleted_snvs=self.accumulated_snvs[lo:hi]
+                            del self.accumulated_snvs[lo:hi]
+#the deleted snvs occured on this branch are just removed, the others are pre_snvs
+                            pre_snvs=[snv for snv in deleted_snvs if id(snv) not in branch_snvs_id]
+                            if len(pre_snvs)<len(deleted_snvs):
+                                deleted_snvs_id=set(id(snv) for snv in deleted_snvs)
+                                self.snvs=[snv for snv in self.snvs if id(snv) not in deleted_snvs_id]
+                                branch_snvs_id-=deleted_snvs_id
+                            if debug:
+                                logging.debug('pre_snvs in new DELs regions: %s.',pre_snvs)
                             cnv={'type':'DEL',
                                  'parental':parental,
                                  'seg':[start,end],
@@ -196,30 +281,23 @@ class Tree:
                                  'new_copies':[]}
                             self.cnvs.append(cnv)
                             self.accumulated_cnvs.append(cnv)
+                            self.accumulated_dels.add(start=del_start,end=del_end)
+                            if trace!=None:
+                                trace.write(seg=[start,end],node=self.nodeid,time=waiting_t,
+                                            type='DEL',start=del_start,end=del_end,var=-1)
                     else:
 #the new cnv is an amplification
                         logging.debug('New CNVs are amplifications.')
-                        cnv_copy=numpy.random.choice(cn_dist_cfg['copy'],p=cn_dist_cfg['prob'])
                         for amp_start,amp_end in new_cnvs:
                             amp_length=amp_end-amp_start
 #collect the old snvs on cnvs. Those snvs are the snvs on the ancestor lineage leading to segment, and locate in the segment.
-                            pre_snvs=[]
-                            for snv in self.accumulated_snvs:
-                                if amp_start<=snv['start']<amp_end:
-                                    pre_snvs.append(snv)
+                            lo=bisect_var(variants=self.accumulated_snvs,pos=amp_start)
+                            hi=bisect_var(variants=self.accumulated_snvs,pos=amp_end)
+                            pre_snvs=self.accumulated_snvs[lo:hi]
 #collect the new copies of cnvs
                             new_copies=[]
                             for i in range(cnv_copy):
-                                segment=Tree(name=self.name,lens=self.lens-waiting_t,nodeid=self.nodeid,sim=self.sim)
-                                if hasattr(self,'sectors'):
-                                    segment.sectors=self.sectors
-                                if self.left != None:
-                                    segment.left=copy.deepcopy(self.left)
-                                    segment.left.top=segment
-                                if self.right != None:
-                                    segment.right=copy.deepcopy(self.right)
-                                    segment.right.top=segment
-                                new_copies.append(segment)
+                                new_copies.append(self.new_copy(lens=self.lens-waiting_t))
                             cnv={'type':'AMP',
                                  'parental':parental,
                                  'seg':[start,end],
@@ -231,12 +309,15 @@ class Tree:
                                  'pre_snvs':{},
                                  'new_copies':new_copies}
                             for i in range(cnv_copy): cnv['pre_snvs'][i+1]=pre_snvs
-                            if tandem_prob==1 or numpy.random.uniform()<tandem_prob:
+                            if targets==None:
                                 for i in range(cnv_copy): cnv['target'].append(cnv['start'])
                             else:
-                                cnv['target'].extend(numpy.random.randint(start,end,size=cnv['copy']))
+                                cnv['target'].extend(targets)
                             self.cnvs.append(cnv)
                             self.accumulated_cnvs.append(cnv)
+                            if trace!=None:
+                                trace.write(seg=[start,end],node=self.nodeid,time=waiting_t,
+                                            type='AMP',start=amp_start,end=amp_end,var=cnv_copy,target=cnv['target'])
         for cnv in self.cnvs:
             if cnv['copy']>0: 
                 scale=(cnv['end']-cnv['start'])/(end-start)
@@ -249,126 +330,110 @@ class Tree:
                                         trunk_snv_rate=trunk_snv_rate*scale,trunk_cnv_rate=trunk_cnv_rate*scale,
                                         del_prob=del_prob,tandem_prob=tandem_prob,
                                         cnv_length_beta=cnv_length_beta,cnv_length_max=cnv_length_max,
-                                        cn_dist_cfg=cn_dist_cfg,tstv_dist_cfg=tstv_dist_cfg,cnvl_dist=cnvl_dist,parental=parental)
-#only root node have inherent_snvs and inherent_cnvs
-        if self.left != None:
-            self.left.add_snv_cnv(start=start,end=end,inherent_snvs=[],inherent_cnvs=[],
-                                  snv_rate=snv_rate,cnv_rate=cnv_rate,
-                                  trunk_snv_rate=trunk_snv_rate,trunk_cnv_rate=trunk_cnv_rate,
-                                  del_prob=del_prob,tandem_prob=tandem_prob,
-                                  cnv_length_beta=cnv_length_beta,cnv_length_max=cnv_length_max,
-                                  cn_dist_cfg=cn_dist_cfg,tstv_dist_cfg=tstv_dist_cfg,cnvl_dist=cnvl_dist,parental=parental)
-        if self.right != None:
-            self.right.add_snv_cnv(start=start,end=end,inherent_snvs=[],inherent_cnvs=[],
-                                   snv_rate=snv_rate,cnv_rate=cnv_rate,
-                                   trunk_snv_rate=trunk_snv_rate,trunk_cnv_rate=trunk_cnv_rate,
-                                   del_prob=del_prob,tandem_prob=tandem_prob,
-                                   cnv_length_beta=cnv_length_beta,cnv_length_max=cnv_length_max,
-                                   cn_dist_cfg=cn_dist_cfg,tstv_dist_cfg=tstv_dist_cfg,cnvl_dist=cnvl_dist,parental=parental)
+                                        cn_dist_cfg=cn_dist_cfg,tstv_dist_cfg=tstv_dist_cfg,cnvl_dist=cnvl_dist,parental=parental,
+                                        snv_positions=snv_positions,trace=trace)
 
-    def all_cnvs_collect(self,sector=None):
+    def sectors_counts(self,sector_names=None):
         '''
-        Return a list of all cnvs on the tree.
+        Return the numbers of cells of the sectors (in the order of sector_names) under this node as an array.
         '''
-        all_cnvs=[]
-        if self.cnvs:
-            all_cnvs=[]
-            for cnv in self.cnvs:
-                cnv_cp=cnv.copy()
-                cnv_cp['node']=self.nodeid
-                cnv_cp['leaves_count']=self.sectors[sector]
-                all_cnvs.append(cnv_cp)
-            for cnv in self.cnvs:
-                if cnv['copy']>0:
-                    for cp in cnv['new_copies']:
-                        all_cnvs.extend(cp.all_cnvs_collect(sector=sector))
-        if self.left != None:
-            all_cnvs.extend(self.left.all_cnvs_collect(sector=sector))
-        if self.right != None:
-            all_cnvs.extend(self.right.all_cnvs_collect(sector=sector))
-        return all_cnvs
+        return numpy.array([self.sectors[sector] for sector in sector_names],dtype=numpy.int64)
 
-    def all_snvs_summary(self,sector=None):
+    def sectors_vars_summary(self,sector_names=None,alt_counts=None):
         '''
-        It will return a dictionary of all SNVs on the tree. 
-        {pos:{'mutation':xxx,'alt_count':xxx,'node':xxx},...}
-        We will summary the allele count of all snvs on the main tree and all
-        subtrees (new copy of cnv).
-        There are three kinds of snvs: 
-        1) on the main tree 
+        Summarize the variants of all sectors in one traversal of the main tree and all subtrees (new copy of cnv).
+        The allele counts of the SNVs in each sector are added to alt_counts (AltCounts).
+        There are three kinds of snvs:
+        1) on the main tree
         2) on the subtree (pre_snvs and new snvs)
         3) in deletions (pre_snvs)
+        Return all cnvs on the tree (in preorder, each node followed by the cnvs on its new copies)
+        and an array (cnvs x sectors) of the number of cells carrying each cnv in each sector.
         '''
-        all_alt_count={}
-        if self.snvs:
-            for snv in self.snvs:
-                all_alt_count[snv['start']]={'mutation':snv['mutation'],'alt_count':self.sectors[sector],'node':self.nodeid}
-        if self.cnvs:
-            for cnv in self.cnvs:
-                if cnv['copy']>0: #amplification
-                    for cp in cnv['new_copies']:
-                        all_alt_count=merge_two_all_alt_count(all_alt_count,cp.all_snvs_summary(sector=sector))
-                else:  #deletion
-                    pre_snvs_dict={}
-                    for snv in cnv['pre_snvs'][0]:
-                        pre_snvs_dict[snv['start']]={'mutation':snv['mutation'],'alt_count':-self.sectors[sector],'node':self.nodeid}
-                    all_alt_count=merge_two_all_alt_count(all_alt_count,pre_snvs_dict)
-        if self.left!=None:
-            all_alt_count=merge_two_all_alt_count(all_alt_count,self.left.all_snvs_summary(sector=sector))
-        if self.right!=None:
-            all_alt_count=merge_two_all_alt_count(all_alt_count,self.right.all_snvs_summary(sector=sector))
-        return all_alt_count
-
-    def nodes_vars_collect(self,chroms=None,parental=None):
-        '''
-        It will return a dictionary of all nodes in the tree. 
-        {node1:{var1,var2,...},node2:{var3,var4,...},...}
+        if alt_counts==None:
+            alt_counts=AltCounts()
+        all_cnvs=[]
+        cnv_counts=[]
+        walks=[iter(self.preorder())]
+        while walks:
+            node=next(walks[-1],None)
+            if node==None:
+                walks.pop()
+                continue
+            if not node.snvs and not node.cnvs:
+                continue
+            counts=node.sectors_counts(sector_names=sector_names)
+            if node.snvs:
+                alt_counts.add(snvs=node.snvs,alt_count=counts)
+            if node.cnvs:
+                copies=[]
+                for cnv in node.cnvs:
+                    cnv_cp=cnv.copy()
+                    cnv_cp['node']=node.nodeid
+                    all_cnvs.append(cnv_cp)
+                    cnv_counts.append(counts)
+                    if cnv['copy']>0: #amplification
+                        copies.extend(cnv['new_copies'])
+                    else:  #deletion
+                        alt_counts.add(snvs=cnv['pre_snvs'][0],alt_count=-counts)
+#the new copies are walked before the rest of this tree
+                if copies:
+                    walks.append(itertools.chain.from_iterable(cp.preorder() for cp in copies))
+        cnv_counts=numpy.array(cnv_counts,dtype=numpy.int64).reshape(len(all_cnvs),len(sector_names))
+        return all_cnvs,cnv_counts
+
+    def nodes_vars_collect(self,variants=None,chroms=None,parental=None):
         '''
-        nodes_vars={}
-        nodes_vars[self.nodeid]=set()
-        if self.snvs:
-            for snv in self.snvs:
-                var='#'.join([str(x) for x in [chroms,parental,snv['start'],snv['end'],snv['mutation']]])
-                nodes_vars[self.nodeid].add(var)
-        if self.cnvs:
-            for cnv in self.cnvs:
-                var='#'.join([str(x) for x in [chroms,parental,cnv['start'],cnv['end']]])
-                if cnv['copy']>0:
-                    var+='#+'+str(cnv['copy'])
-                else:
-                    var+='#'+str(cnv['copy'])
-                nodes_vars[self.nodeid].add(var)
-                if cnv['copy']>0: #amplification
-                    for i in range(len(cnv['new_copies'])):
-                        cp=cnv['new_copies'][i]
-                        tmp=cp.nodes_vars_collect(chroms=chroms,parental=parental)
-#For each new copy of amplification, its self.snvs contains previous snvs.
-#Those snvs do not locate on the current node, let's remove them.
-                        if tmp.get(self.nodeid) and cnv['pre_snvs'][i+1]:
-                            for snv in cnv['pre_snvs'][i+1]:
-                                if self.top and snv in self.top.accumulated_snvs:
-                                    var='#'.join([str(x) for x in [chroms,parental,snv['start'],snv['end'],snv['mutation']]])
-                                    tmp[self.nodeid].discard(var)
-                        nodes_vars=merge_two_dict_set(nodes_vars,tmp)
-        if self.left!=None:
-            nodes_vars=merge_two_dict_set(nodes_vars,self.left.nodes_vars_collect(chroms=chroms,parental=parental))
-        if self.right!=None:
-            nodes_vars=merge_two_dict_set(nodes_vars,self.right.nodes_vars_collect(chroms=chroms,parental=parental))
-        return nodes_vars
+        Add the SNVs/CNVs on each node of the tree and all subtrees (new copy of cnv) to variants (VariantTable).
+        '''
+        if variants==None:
+            variants=VariantTable()
+#For each new copy of amplification, its root node contains previous snvs (excluded_snvs).
+#Those snvs do not locate on the node, so they are skipped.
+        trees=[(self,None,set())]
+        while trees:
+            tree,root_nodeid,excluded_snvs=trees.pop()
+            for node in tree.preorder():
+                if not node.snvs and not node.cnvs:
+                    continue
+                if node.nodeid!=root_nodeid:
+                    excluded_snvs=set()
+                if node.snvs:
+                    for snv in node.snvs:
+                        if id(snv) not in excluded_snvs:
+                            variants.add(node=node.nodeid,chroms=chroms,hap=parental,start=snv['start'],
+                                         end=snv['end'],var_type='SNV',var=snv['mutation'])
+                if node.cnvs:
+                    for cnv in node.cnvs:
+                        if cnv['copy']>0: #amplification
+                            variants.add(node=node.nodeid,chroms=chroms,hap=parental,start=cnv['start'],
+                                         end=cnv['end'],var_type='AMP',var=cnv['copy'])
+                            top_snvs=set()
+                            if node.top and node.top.accumulated_snvs:
+                                top_snvs=set(id(snv) for snv in node.top.accumulated_snvs)
+                            for i in range(len(cnv['new_copies'])):
+                                copy_excluded_snvs=set(id(snv) for snv in cnv['pre_snvs'][i+1] if id(snv) in top_snvs)
+                                trees.append((cnv['new_copies'][i],node.nodeid,copy_excluded_snvs|excluded_snvs))
+                        else: #deletion
+                            variants.add(node=node.nodeid,chroms=chroms,hap=parental,start=cnv['start'],
+                                         end=cnv['end'],var_type='DEL',var=cnv['copy'])
+        return variants
 
     def leaves_counting(self):
         '''
         After this method, all nodes will have the attribute of leaves count.
         '''
         if not hasattr(self,'leaves_count') or self.leaves_count == None:
-            if self.left==None and self.right==None:
-                self.leaves_count=1
-            else:
-                self.leaves_count=0
-                if self.left!=None:
-                    self.leaves_count+=self.left.leaves_counting()
-                if self.right!=None:
-                    self.leaves_count+=self.right.leaves_counting()
+            for node in self.postorder():
+                if not hasattr(node,'leaves_count') or node.leaves_count == None:
+                    if node.left==None and node.right==None:
+                        node.leaves_count=1
+                    else:
+                        node.leaves_count=0
+                        if node.left!=None:
+                            node.leaves_count+=node.left.leaves_count
+                        if node.right!=None:
+                            node.leaves_count+=node.right.leaves_count
         return self.leaves_count
 
     def leaves_naming(self):
@@ -376,55 +441,57 @@ class Tree:
         After this method, ALL nodes will have the attribute leaves_names.
         '''
         if not hasattr(self,'leaves_names') or self.leaves_names == None:
-            if self.left==None and self.right==None:
-                self.leaves_names=[self.name]
-            else:
-                self.leaves_names=[]
-                if self.left!=None:
-                    self.leaves_names.extend(self.left.leaves_naming())
-                if self.right!=None:
-                    self.leaves_names.extend(self.right.leaves_naming())
+            for node in self.postorder():
+                if not hasattr(node,'leaves_names') or node.leaves_names == None:
+                    if node.left==None and node.right==None:
+                        node.leaves_names=[node.name]
+                    else:
+                        node.leaves_names=[]
+                        if node.left!=None:
+                            node.leaves_names.extend(node.left.leaves_names)
+                        if node.right!=None:
+                            node.leaves_names.extend(node.right.leaves_names)
         return self.leaves_names
-    
+
     def collect_tipnodes(self):
         '''
         After this method, ALL nodes will have the attribute tipnodes.
         '''
         if not hasattr(self,'tipnodes') or self.tipnodes == None:
-            if self.left==None and self.right==None:
-                self.tipnodes=[self.nodeid]
-            else:
-                self.tipnodes=[]
-                if self.left!=None:
-                    self.tipnodes.extend(self.left.collect_tipnodes())
-                if self.right!=None:
-                    self.tipnodes.extend(self.right.collect_tipnodes())
+            for node in self.postorder():
+                if not hasattr(node,'tipnodes') or node.tipnodes == None:
+                    if node.left==None and node.right==None:
+                        node.tipnodes=[node.nodeid]
+                    else:
+                        node.tipnodes=[]
+                        if node.left!=None:
+                            node.tipnodes.extend(node.left.tipnodes)
+                        if node.right!=None:
+                            node.tipnodes.extend(node.right.tipnodes)
         return self.tipnodes
-    
+
     def expand_clone(self,clones=None):
         '''
         Put the cells of each clone in the DICTIONARY (clone) onto each tipenode.
         '''
-        if self.name in clones:
-            self.leaves_names=clones[self.name]
-        if self.left!=None:
-            self.left.expand_clone(clones=clones)
-        if self.right!=None:
-            self.right.expand_clone(clones=clones)
+        for node in self.preorder():
+            if node.name in clones:
+                node.leaves_names=clones[node.name]
 
     def updated_leaves_name_count(self):
         '''
         After expand clone, we need to update the leaves names and count.
         '''
-        if self.left==None and self.right==None:
-            self.leaves_count=len(self.leaves_names)
-        else:
-            self.leaves_names=[]
-            if self.left!=None:
-                self.leaves_names.extend(self.left.updated_leaves_name_count()[0])
-            if self.right!=None:
-                self.leaves_names.extend(self.right.updated_leaves_name_count()[0])
-            self.leaves_count=len(self.leaves_names)
+        for node in self.postorder():
+            if node.left==None and node.right==None:
+                node.leaves_count=len(node.leaves_names)
+            else:
+                node.leaves_names=[]
+                if node.left!=None:
+                    node.leaves_names.extend(node.left.leaves_names)
+                if node.right!=None:
+                    node.leaves_names.extend(node.right.leaves_names)
+                node.leaves_count=len(node.leaves_names)
         return self.leaves_names,self.leaves_count
 
     def attach_info(self,attr=None,info=None,null=None):
@@ -434,11 +501,8 @@ class Tree:
         '''
         if info==None:
             info={}
-        setattr(self,attr,info.get(self.nodeid,null))
-        if self.left!=None:
-            self.left.attach_info(attr,info,null)
-        if self.right!=None:
-            self.right.attach_info(attr,info,null)
+        for node in self.preorder():
+            setattr(node,attr,info.get(node.nodeid,null))
 
     def collect_leaves_and_trim(self,tipnode_leaves=None,sectors=None):
         '''
@@ -455,72 +519,58 @@ class Tree:
          ...
         }
         '''
-        if not hasattr(self,'sectors'):
-            self.sectors={}
-        self.sim=False
-        if self.left==None and self.right==None:
-            tipnode_leaves[self.nodeid]=self.leaves_naming()
-            self.name=self.nodeid
-            for sector in sectors:
-                cells=sectors[sector]['members']
-                cutoff=sectors[sector]['prune_n']
-                focal_cells=cells.intersection(self.leaves_names)
-                self.sectors[sector]=len(focal_cells)
-                if self.sim==False and len(focal_cells)>=cutoff:
-                    self.sim=True
-        else:
+        stack=[self]
+        while stack:
+            node=stack.pop()
+            if not hasattr(node,'sectors'):
+                node.sectors={}
+            expand=False
             for sector in sectors:
                 cells=sectors[sector]['members']
                 cutoff=sectors[sector]['prune_n']
-                focal_cells=cells.intersection(self.leaves_naming())
-                self.sectors[sector]=len(focal_cells)
-                if self.sim==False and (len(cells.intersection(self.left.leaves_names))>=cutoff or len(cells.intersection(self.right.leaves_names))>=cutoff):
-                    self.left.collect_leaves_and_trim(tipnode_leaves=tipnode_leaves,sectors=sectors)
-                    self.right.collect_leaves_and_trim(tipnode_leaves=tipnode_leaves,sectors=sectors)
-                    self.sim=True
-            if self.sim==False:
-                self.left=None
-                self.right=None
-                tipnode_leaves[self.nodeid]=self.leaves_naming()
-                self.name=self.nodeid
+                node.sectors[sector]=len(cells.intersection(node.leaves_naming()))
+                if not expand and node.left!=None and node.right!=None and \
+                    (len(cells.intersection(node.left.leaves_names))>=cutoff or len(cells.intersection(node.right.leaves_names))>=cutoff):
+                    expand=True
+            if expand:
+                node.sim=True
+                stack.append(node.right)
+                stack.append(node.left)
+            else:
+                node.left=None
+                node.right=None
+                tipnode_leaves[node.nodeid]=node.leaves_naming()
+                node.name=node.nodeid
+                node.sim=False
                 for sector in sectors:
-                    cells=sectors[sector]['members']
-                    cutoff=sectors[sector]['prune_n']
-                    focal_cells=cells.intersection(self.leaves_names)
-                    self.sectors[sector]=len(focal_cells)
-                    if self.sim==False and len(focal_cells)>=cutoff:
-                        self.sim=True
+                    if node.sectors[sector]>=sectors[sector]['prune_n']:
+                        node.sim=True
+                        break
 
     def nodes_ccf(self,sectors_size=None,nodes_ccf=None):
         '''
         NOTE: For a Tree object, you should run the prune() method on it before running this method.
         Calculate the CCF (cancer cell fraction) of each node in each sector.
         '''
-        nodes_ccf[self.nodeid]={}
-        for sector in sectors_size:
-            ncells=self.sectors[sector]
-            nodes_ccf[self.nodeid][sector]=ncells/sectors_size[sector]
-        if self.left!=None:
-            self.left.nodes_ccf(sectors_size=sectors_size,nodes_ccf=nodes_ccf)
-        if self.right!=None:
-            self.right.nodes_ccf(sectors_size=sectors_size,nodes_ccf=nodes_ccf)
+        for node in self.preorder():
+            nodes_ccf[node.nodeid]={}
+            for sector in sectors_size:
+                ncells=node.sectors[sector]
+                nodes_ccf[node.nodeid][sector]=ncells/sectors_size[sector]
 
     def collect_sectors_nodes(self,sectors=None):
         '''
         Collect the nodes that are visible to each sector.
         After this method, the sectors will have a item 'nodes':{node1,node2,...}.
         '''
-        for sector in sectors:
-            cells=sectors[sector]['members']
-            if cells.intersection(self.leaves_naming()):
-                try:
-                    sectors[sector]['nodes'].add(self.nodeid)
-                except KeyError:
-                    sectors[sector]['nodes']={self.nodeid}
-        if self.left!=None:
-            self.left.collect_sectors_nodes(sectors=sectors)
-        if self.right!=None:
-            self.right.collect_sectors_nodes(sectors=sectors)
+        for node in self.preorder():
+            for sector in sectors:
+                cells=sectors[sector]['members']
+                if cells.intersection(node.leaves_naming()):
+                    try:
+                        sectors[sector]['nodes'].add(node.nodeid)
+                    except KeyError:
+                        sectors[sector]['nodes']={node.nodeid}
 
     def prune(self,sectors=None):
         '''
@@ -538,37 +588,38 @@ class Tree:
     #@profile
     def genotyping(self,genotypes=None):
         '''
-        Collect the genotypes on every SNV site for each tipnode.
-        And modify the dictionary (genotypes) directly.
-        The dictionary's data structure is:
-        {tipnode1:{pos1:genotype,pos2:genotype...},tipnode2:{pos1:genotype,pos2:genotype...},...}
-        The genotype here means the count of alternative alleles of each SNV.
+        Add the changes of the genotypes made on each node of the tree and all subtrees (new copy of cnv)
+        to genotypes (SnvGenotypes), i.e. the change of the count of alternative alleles of each SNV and
+        the change of the copy number made by each CNV, in all the tipnodes under the node.
         '''
-        #logging.debug('snv_genotyping: %s',self.nodeid)
         if genotypes==None:
-            genotypes={}
-        if self.snvs:
-            for tipnode in self.collect_tipnodes():
-                if tipnode not in genotypes:
-                    genotypes[tipnode]={}
-                for pos in [snv['start'] for snv in self.snvs]:
-                    if pos in genotypes[tipnode]:
-                        genotypes[tipnode][pos]+=1
-                    else:
-                        genotypes[tipnode][pos]=1
-        if self.cnvs:
-            for cnv in self.cnvs:
-                if cnv['copy']>0: #amplification
-                    for cp in cnv['new_copies']:
-                        cp.genotyping(genotypes)
-                else:  #deletion
-                    for pos in [snv['start'] for snv in cnv['pre_snvs'][0]]:
-                        for tipnode in self.collect_tipnodes():
-                            genotypes[tipnode][pos]-=1
-        if self.left!=None:
-            self.left.genotyping(genotypes)
-        if self.right!=None:
-            self.right.genotyping(genotypes)
+            genotypes=SnvGenotypes(tipnodes=self.collect_tipnodes())
+        trees=[self]
+        while trees:
+            tree=trees.pop()
+            for node in tree.preorder():
+                if not node.snvs and not node.cnvs:
+                    continue
+                lo,hi=node.tipnodes_range(tipnode_index=genotypes.tipnode_index)
+                if node.snvs:
+                    genotypes.add_snvs(snvs=node.snvs,lo=lo,hi=hi,delta=1)
+                if node.cnvs:
+                    for cnv in node.cnvs:
+                        genotypes.add_cnv(cnv=cnv,lo=lo,hi=hi)
+                        if cnv['copy']>0: #amplification
+                            trees.extend(cnv['new_copies'])
+                        else:  #deletion
+                            genotypes.add_snvs(snvs=cnv['pre_snvs'][0],lo=lo,hi=hi,delta=-1)
+        return genotypes
+
+    def tipnodes_range(self,tipnode_index=None):
+        '''
+        The tipnodes under a node are next to each other in DFS order.
+        Return [lo,hi), the range of the indexes (tipnode_index) of the tipnodes under this node.
+        '''
+        tipnodes=self.collect_tipnodes()
+        lo=tipnode_index[tipnodes[0]]
+        return lo,lo+len(tipnodes)
 
     #@profile
     def cnv_genotyping(self,genotypes=None,parental=None):
@@ -578,20 +629,17 @@ class Tree:
         #logging.debug('cnv_genotyping: %s',self.nodeid)
         if genotypes==None:
             genotypes={}
-        if self.cnvs:
-            for cnv in self.cnvs:
-                for tipnode in self.collect_tipnodes():
-                    if tipnode not in genotypes:
-                        genotypes[tipnode]=[]
+        for node in self.preorder():
+            if node.cnvs:
+                for cnv in node.cnvs:
+                    for tipnode in node.collect_tipnodes():
+                        if tipnode not in genotypes:
+                            genotypes[tipnode]=[]
 #set leaves_count=1 here, as a tipnode is a representative of each one of the leaves under it
-                    genotypes[tipnode].append({'start':cnv['start'],'end':cnv['end'],'copy':cnv['copy'],'leaves_count':1,'parental':parental})
-                if cnv['copy']>0: #amplification
-                    for cp in cnv['new_copies']:
-                        cp.cnv_genotyping(genotypes=genotypes,parental=parental)
-        if self.left!=None:
-            self.left.cnv_genotyping(genotypes=genotypes,parental=parental)
-        if self.right!=None:
-            self.right.cnv_genotyping(genotypes=genotypes,parental=parental)
+                        genotypes[tipnode].append({'start':cnv['start'],'end':cnv['end'],'copy':cnv['copy'],'leaves_count':1,'parental':parental})
+                    if cnv['copy']>0: #amplification
+                        for cp in cnv['new_copies']:
+                            cp.cnv_genotyping(genotypes=genotypes,parental=parental)
 
 #######################################
 #In order to build haplotype for each tipnode efficiently, I will
@@ -615,46 +663,40 @@ class Tree:
         '''
         if tip_vars==None:
             tip_vars={}
-        if self.left!=None:
-            self.left.tipnode_accumulated_vars(start=start,end=end,tip_vars=tip_vars)
-        if self.right!=None:
-            self.right.tipnode_accumulated_vars(start=start,end=end,tip_vars=tip_vars)
-        if self.left==None and self.right==None:
-            if tip_vars=={}:
-                tip_vars['start']=start
-                tip_vars['end']=end
-                tip_vars['vars']={}
-            tip_vars['vars'][self.nodeid]=[]
-            for snv in self.accumulated_snvs:
-                snv['target']=snv['start']
-                tip_vars['vars'][self.nodeid].append(snv)
-            for cnv in self.accumulated_cnvs:
-                if cnv['type']=='AMP':
-                    for i in range(cnv['copy']):
-                        amp=cnv.copy()
-                        amp['index']=i
-                        amp['target']=cnv['target'][i]
-                        tip_vars['vars'][self.nodeid].append(amp)
-                else:
-                    cnv['target']=cnv['start']
-                    tip_vars['vars'][self.nodeid].append(cnv)
-            tip_vars['vars'][self.nodeid].sort(key=lambda var:(var['target'],var['type']))
+        for node in self.preorder():
+            if node.left==None and node.right==None:
+                if tip_vars=={}:
+                    tip_vars['start']=start
+                    tip_vars['end']=end
+                    tip_vars['vars']={}
+                tip_vars['vars'][node.nodeid]=[]
+                for snv in node.accumulated_snvs:
+                    snv['target']=snv['start']
+                    tip_vars['vars'][node.nodeid].append(snv)
+                for cnv in node.accumulated_cnvs:
+                    if cnv['type']=='AMP':
+                        for i in range(cnv['copy']):
+                            amp=cnv.copy()
+                            amp['index']=i
+                            amp['target']=cnv['target'][i]
+                            tip_vars['vars'][node.nodeid].append(amp)
+                    else:
+                        cnv['target']=cnv['start']
+                        tip_vars['vars'][node.nodeid].append(cnv)
+                tip_vars['vars'][node.nodeid].sort(key=lambda var:(var['target'],var['type']))
         return tip_vars
-    
+
     def add_haps2cnv(self):
         '''
         In this method, I will add haplotypes to each CNV on the tree.
         '''
-        for cnv in self.cnvs:
-            if cnv['type']=='AMP':
-                cnv['haplotypes']=[]
-                for copy in cnv['new_copies']:
-                    copy.add_haps2cnv()
-                    cnv['haplotypes'].append(copy.tipnode_accumulated_vars(start=cnv['start'],end=cnv['end']))
-        if self.left!=None:
-            self.left.add_haps2cnv()
-        if self.right!=None:
-            self.right.add_haps2cnv()
+        for node in self.preorder():
+            for cnv in node.cnvs:
+                if cnv['type']=='AMP':
+                    cnv['haplotypes']=[]
+                    for copy in cnv['new_copies']:
+                        copy.add_haps2cnv()
+                        cnv['haplotypes'].append(copy.tipnode_accumulated_vars(start=cnv['start'],end=cnv['end']))
 
     def construct_tipnode_hap(self,start=None,end=None):
         '''
@@ -671,141 +713,129 @@ class Tree:
     def snvs_freq_cnvs_profile(self,parental=None,snv_rate=None,cnv_rate=None,trunk_snv_rate=None,
                                trunk_cnv_rate=None,del_prob=None,tandem_prob=None,
                                cnv_length_beta=None,cnv_length_max=None,cn_dist_cfg=None,tstv_dist_cfg=None,
-                               trunk_snvs=None,trunk_cnvs=None,length=None,
-                               chain=None,chroms=None,sectors=None,wholeT=None,cnvl_dist=None):
+                               trunk_snvs=None,trunk_cnvs=None,length=None,start=0,end=None,
+                               chain=None,chroms=None,sectors=None,wholeT=None,cnvl_dist=None,trace=None,variants=None):
         '''
         Produce the true frequency of SNVs in the samples.
         It's a warpper for generating SNVs/CNVs on a tree and summarize their frequency.
+        Return the genotypes of SNVs (SnvGenotypes) and CNVs ({tipnode:[cnv,...]}) in each tipnode, and the
+        summary of the variants in all sectors, from which the variants of each sector are built by sectors_summary:
+        {'sectors':[sector,...],'pos':positions,'mutation':mutations,'alt_count':alt_counts (SNVs x sectors),
+         'cnvs':[cnv,...],'cnv_counts':the number of cells carrying each cnv (CNVs x sectors)}
+        Only the region [start,end) of the chromosome (the whole chromosome by default) is simulated,
+        the rates are for the whole chromosome of the length.
+        If variants (VariantTable) is not None, the SNVs/CNVs on each node are added to it.
         '''
-        all_cnvs={}
-        nodes_vars={}
-        all_snvs_alt_counts={}
-#tipnode_snv_alts is a hash of hash, {tipnode1:{pos1:genotype,pos2:genotype...},tipnode2:{pos1:genotype,pos2:genotype...},...}
-        tipnode_snv_alts={}
+        if end==None:
+            end=length
+        scale=(end-start)/length
+        sector_names=list(sectors)
+        all_cnvs=[]
+        all_cnv_counts=[]
+        all_snvs_alt_counts=AltCounts()
+#snv_genotypes collects the genotypes of all SNVs in each tipnode of all haplotypes
+        snv_genotypes=SnvGenotypes(tipnodes=self.collect_tipnodes(),ploidy=len(parental))
         tipnode_cnvs={}
-        tipnode_cnvs_pos_changes={}
         ploidy=len(parental)
 
         background=self.leaves_counting()*ploidy
-        logging.debug('Your tree is: %s',self.tree2nhx())
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Your tree is: %s',self.tree2nhx())
 #I used haps_cnvs to calculate the count number of each parental copies before.
 #We do not need this feature anymore.
 #        haps_cnvs=[]
 #In order to avoid two SNVs occuring at the same position, I stored all the SNVs
-#of each chromosome (multiple haplotype) to the set Tree.snv_pos.
-        Tree.snv_pos=set()
-        for snvs in trunk_snvs.values():
-            Tree.snv_pos.update([snv['start'] for snv in snvs])
+#of each chromosome (multiple haplotype) in snv_positions.
+        snv_positions=SnvPositions(positions=[snv['start'] for snvs in trunk_snvs.values() for snv in snvs])
 #collect all snvs and cnvs
         for i in range(ploidy):
             logging.info(' Simulate haplotype %s (total: %s)',i+1,ploidy)
-            hap_tree=copy.deepcopy(self)
+            hap_tree=self.haplotype_tree()
             hap_trunk_snvs=trunk_snvs.get(i,[])
             hap_trunk_cnvs=trunk_cnvs.get(i,[])
-            hap_tree.add_snv_cnv(start=0,end=length,inherent_snvs=hap_trunk_snvs,
-                inherent_cnvs=hap_trunk_cnvs,snv_rate=snv_rate,cnv_rate=cnv_rate,
-                trunk_snv_rate=trunk_snv_rate,trunk_cnv_rate=trunk_cnv_rate,
+            if trace!=None:
+                trace.context(chroms=chroms,hap=i)
+            hap_tree.add_snv_cnv(start=start,end=end,inherent_snvs=hap_trunk_snvs,
+                inherent_cnvs=hap_trunk_cnvs,snv_rate=snv_rate*scale,cnv_rate=cnv_rate*scale,
+                trunk_snv_rate=trunk_snv_rate*scale,trunk_cnv_rate=trunk_cnv_rate*scale,
                 del_prob=del_prob,tandem_prob=tandem_prob,cnv_length_beta=cnv_length_beta,
                 cnv_length_max=cnv_length_max,cn_dist_cfg=cn_dist_cfg,
-                tstv_dist_cfg=tstv_dist_cfg,cnvl_dist=cnvl_dist,parental=parental[i])
+                tstv_dist_cfg=tstv_dist_cfg,cnvl_dist=cnvl_dist,parental=parental[i],
+                snv_positions=snv_positions,trace=trace)
 
-#Update the dictionary all_snvs_alt_counts here
+#Add the alt counts of this haplotype to all_snvs_alt_counts, they are summed up after all haplotypes.
 #There will not be two snps occure on the same position of different haplotype,
 #except they are specified by users in trunk_vars 
-            hap_trunk_snvs_pos=[snv['start'] for snv in hap_trunk_snvs]
-            for sector in sectors.keys():
-                if sector not in all_snvs_alt_counts:
-                    all_snvs_alt_counts[sector]={}
-                for pos,info in hap_tree.all_snvs_summary(sector=sector).items():
-                    if pos in all_snvs_alt_counts[sector]:
-                        if pos in hap_trunk_snvs_pos:
-                            all_snvs_alt_counts[sector][pos]['alt_count']+=info['alt_count']
-                        else:
-                            raise ShouldNotBeHereError
-                    else:
-                        all_snvs_alt_counts[sector][pos]=info
+            haplotype_cnvs,haplotype_cnv_counts=hap_tree.sectors_vars_summary(sector_names=sector_names,alt_counts=all_snvs_alt_counts)
+            all_cnvs.extend(haplotype_cnvs)
+            all_cnv_counts.append(haplotype_cnv_counts)
 
-                if sector not in all_cnvs:
-                    all_cnvs[sector]=[]
-                haplotype_cnvs=hap_tree.all_cnvs_collect(sector=sector)
-                all_cnvs[sector].extend(haplotype_cnvs)
-
-            nodes_vars=merge_two_dict_set(nodes_vars,hap_tree.nodes_vars_collect(chroms=chroms,parental=parental[i]))
-            hap_tree.genotyping(genotypes=tipnode_snv_alts)
+            if variants!=None:
+                hap_tree.nodes_vars_collect(variants=variants,chroms=chroms,parental=parental[i])
+            hap_tree.genotyping(genotypes=snv_genotypes)
             hap_tree.cnv_genotyping(genotypes=tipnode_cnvs,parental=parental[i])
             if chain!=None:
-                tipnode_hap=hap_tree.construct_tipnode_hap(start=0,end=length)
+                tipnode_hap=hap_tree.construct_tipnode_hap(start=start,end=end)
                 logging.debug('Haplotypes: %s',tipnode_hap)
                 output_tipnode_hap(tipnode_hap=tipnode_hap,directory=chain,chroms=chroms,haplotype=i,parental=parental[i])
 
-        all_snvs_pos=sorted(all_snvs_alt_counts[wholeT].keys())
-
-#output true freq for multi-sectoring data
-        for sector,info in sectors.items():
-            sector_cnvs=all_cnvs[sector]
-            sector_snvs_alt_counts=all_snvs_alt_counts[sector]
-
-            sector_snvs_pos=sorted(sector_snvs_alt_counts.keys())
-
-            sector_background=[0,0]
-            for hap in parental:
-                sector_background[int(hap)]+=len(info['members'])
-            sector_cnvs_pos_changes=cnvs2pos_changes(cnvs=sector_cnvs,length=length,background=sector_background)
-            sector_cnv_profile=pos_changes2region_profile(sector_cnvs_pos_changes)
-            sector_normal_dosage=info['normal_dosage']
-            sector_local_tumor_dosage=0
-            sector_snvs_alt_total=[]
-            for pos in sector_snvs_pos:
-                while pos>=sector_cnvs_pos_changes[0][0]:
-                    sector_local_tumor_dosage+=sum(sector_cnvs_pos_changes.pop(0)[1:])
-                sector_snvs_alt_total.append([pos,
-                    sector_snvs_alt_counts[pos]['mutation'],
-                    sector_snvs_alt_counts[pos]['alt_count'],
-                    sector_normal_dosage+sector_local_tumor_dosage])
-            info['snvs_alt_total']=sector_snvs_alt_total
-            info['cnvs']=sector_cnvs
-            info['cnv_profile']=sector_cnv_profile
-
-#calculate the number of reference alleles of each SNV for each tipnode
-        tipnode_snv_refs={}
+        summary=all_snvs_alt_counts.summary(sectors_number=len(sector_names))
+        summary['sectors']=sector_names
+        summary['cnvs']=all_cnvs
+        summary['cnv_counts']=numpy.concatenate(all_cnv_counts)
+
+        snv_genotypes.finish(pos=summary['pos'].tolist(),mutation=summary['mutation'].tolist())
         for tipnode in self.collect_tipnodes():
             if tipnode not in tipnode_cnvs:
                 tipnode_cnvs[tipnode]=[]
             tipnode_cnvs[tipnode].sort(key=lambda cnv:(cnv['start'],cnv['end']))
-            tipnode_background=[0,0]
-            for hap in parental:
-                tipnode_background[int(hap)]+=1
-            tipnode_cnvs_pos_changes[tipnode]=cnvs2pos_changes(cnvs=tipnode_cnvs[tipnode],length=length,background=tipnode_background)
-            if tipnode in tipnode_snv_alts:
-                for pos in all_snvs_pos:
-                    if pos not in tipnode_snv_alts[tipnode]:
-                        tipnode_snv_alts[tipnode][pos]=0
-            else:
-                tipnode_snv_alts[tipnode]={}
-                for pos in all_snvs_pos:
-                    tipnode_snv_alts[tipnode][pos]=0
-            local_ploidy=0
-            tipnode_snv_refs[tipnode]={}
-            for pos in all_snvs_pos:
-                while pos>=tipnode_cnvs_pos_changes[tipnode][0][0]:
-                    local_ploidy+=sum(tipnode_cnvs_pos_changes[tipnode].pop(0)[1:])
-                tipnode_snv_refs[tipnode][pos]=local_ploidy-tipnode_snv_alts[tipnode][pos]
-        return nodes_vars,tipnode_snv_alts,tipnode_snv_refs,tipnode_cnvs
+        return snv_genotypes,tipnode_cnvs,summary
 
     def tree2nhx(self,with_lens=False,attrs=None):
         '''
         Convert tree structure to string in Newick/NHX format.
         '''
-        newick_str=''
+        output=io.StringIO()
+        self.write_nhx(output=output,with_lens=with_lens,attrs=attrs)
+        return output.getvalue()
 
-        if self.left!=None:
-            newick_str+='(' + self.left.tree2nhx(with_lens=with_lens,attrs=attrs)
-        if self.name==None:
-            newick_str+=','
-        else:
-            newick_str+=self.name
-        if self.right!=None:
-            newick_str+=self.right.tree2nhx(with_lens=with_lens,attrs=attrs) + ')'
+    def write_nhx(self,output=None,with_lens=False,attrs=None,buffer_size=1<<20):
+        '''
+        Write the tree in Newick/NHX format (without the ending ';') to the file handle output.
+        The pieces are written in chunks of about buffer_size characters, so the string of the whole tree is never built.
+        '''
+        pieces=[]
+        size=0
+        stack=[self]
+        while stack:
+            item=stack.pop()
+            if isinstance(item,str):
+                pieces.append(item)
+                size+=len(item)
+                if size>=buffer_size:
+                    output.write(''.join(pieces))
+                    pieces=[]
+                    size=0
+                continue
+#push the pieces of this node in reverse order: '(' left name/',' right ')' lens and attrs
+            stack.append(item.nhx_label(with_lens=with_lens,attrs=attrs))
+            if item.right!=None:
+                stack.append(')')
+                stack.append(item.right)
+            if item.name==None:
+                stack.append(',')
+            else:
+                stack.append(item.name)
+            if item.left!=None:
+                stack.append(item.left)
+                stack.append('(')
+        output.write(''.join(pieces))
+
+    def nhx_label(self,with_lens=False,attrs=None):
+        '''
+        Return the branch length and NHX attributes of this node in Newick/NHX format.
+        '''
+        newick_str=''
         if self.lens!=None and with_lens:
             newick_str+= ':' + str(self.lens)
         if attrs!=None:
@@ -815,7 +845,8 @@ class Tree:
                     if isinstance(getattr(self, attribute),list):
                         newick_str+=':{}=LIST{{{}}}'.format(attribute,'@'.join([str(x) for x in getattr(self, attribute)]))
                     elif isinstance(getattr(self, attribute),set):
-                        newick_str+=':{}=SET{{{}}}'.format(attribute,'@'.join([str(x) for x in getattr(self, attribute)]))
+#the elements of a set are sorted, so the output does not depend on the hashing of strings
+                        newick_str+=':{}=SET{{{}}}'.format(attribute,'@'.join(sorted([str(x) for x in getattr(self, attribute)])))
                     elif isinstance(getattr(self, attribute),dict):
                         tmp=getattr(self, attribute)
                         newick_str+=':{}=DICT{{{}}}'.format(attribute,'@'.join(['{}>{}'.format(x,tmp[x]) for x in tmp]))
@@ -828,108 +859,167 @@ class Tree:
         '''
         Set the color of the nodes with certain SNVs as 255.0.0.
         '''
-        if self.left != None:
-            self.left.highlight_snvs(snvs)
-        if self.right != None:
-            self.right.highlight_snvs(snvs)
-        if self.new_snvs !=None and self.new_snvs.intersection(snvs):
-            self.C='255.0.0'
-            logging.debug('Highlight node %s (with leaves %s) because of variants:\n%s',
-                self.nodeid,self.leaves_counting(),self.new_snvs.intersection(snvs))
-
-def waiting_times(span=None,rate=None):
-    elapse=0.0
-    waiting_times=[]
-    if rate>0:
-        while elapse<span:
-            elapse+=numpy.random.exponential(1/rate)
-            if elapse<span:
-                waiting_times.append(elapse)
-    return waiting_times
-
-def get_cnv_length(cnvl_dist=None,cnvl_beta=None,cnvl_max=None):
-    cnvl=None
+        for node in self.postorder():
+            if node.new_snvs !=None and node.new_snvs.intersection(snvs):
+                node.C='255.0.0'
+                logging.debug('Highlight node %s (with leaves %s) because of variants:\n%s',
+                    node.nodeid,node.leaves_counting(),node.new_snvs.intersection(snvs))
+
+class AliasTable:
+    '''
+    The alias table (Walker's alias method) of a categorical distribution, from which
+    any number of samples can be drawn with two numpy calls.
+    '''
+    def __init__(self,values=None,prob=None):
+        n=len(prob)
+        self.values=numpy.asarray(values)
+        self.prob=numpy.ones(n)
+        self.alias=numpy.arange(n)
+        scaled=[x*n/sum(prob) for x in prob]
+        small=[i for i in range(n) if scaled[i]<1]
+        large=[i for i in range(n) if scaled[i]>=1]
+        while small and large:
+            i=small.pop()
+            j=large.pop()
+            self.prob[i]=scaled[i]
+            self.alias[i]=j
+            scaled[j]+=scaled[i]-1
+            if scaled[j]<1:
+                small.append(j)
+            else:
+                large.append(j)
+
+    def draw(self,size=None):
+        i=numpy.random.randint(0,len(self.prob),size=size)
+        i=numpy.where(numpy.random.uniform(size=size)<self.prob[i],i,self.alias[i])
+        return self.values[i]
+
+def cnv_lengths(size=None,cnvl_dist=None,cnvl_beta=None,cnvl_max=None):
+    '''
+    Draw the lengths of size cnvs, from the bins in cnvl_dist or an exponential distribution.
+    '''
     if cnvl_dist:
-        index=numpy.random.choice(cnvl_dist['index'],p=cnvl_dist['prob'])
-        low,high=cnvl_dist['bins'][index]
-        cnvl=numpy.random.randint(low,high)
+        bins=cnvl_dist['alias'].draw(size=size)
+        return numpy.random.randint(bins[:,0],bins[:,1]) if size else numpy.zeros(0,dtype=int)
     else:
-        cnvl=round(numpy.random.exponential(cnvl_beta))
-        if cnvl>cnvl_max:
-            cnvl=cnvl_max
-    return cnvl
+        return numpy.minimum(numpy.round(numpy.random.exponential(cnvl_beta,size=size)).astype(int),cnvl_max)
 
-def merge_two_all_alt_count(dict1=None,dict2=None):
+def branch_events(span=None,rate=None,snv_prob=None,start=None,end=None,del_prob=None,tandem_prob=None,
+                  cnv_length_beta=None,cnv_length_max=None,cn_dist_cfg=None,tstv_dist_cfg=None,cnvl_dist=None):
     '''
-    Each dict has the structure: {pos:{'mutation':,'alt_count':},...}.
-    I will generate a new dict, which contains all pos in dict1 and dict2,
-    And for those pos have record in both dict1 and dict2, the vale of 
-    'mutation' will be keep, and the value of 'alt_count' is the sum of value
-    in dict1 and dict2.
+    Draw all the mutation events on a branch of length span in the sequence [start,end) with a few numpy calls.
+    Return a dictionary of:
+        time:   the sorted times of all events (a Poisson process with the rate)
+        is_snv: whether each event is a SNV (otherwise it is a CNV)
+        snv_pos/snv_form: the position and the mutation form of each SNV
+        cnv_start/cnv_end/cnv_del/cnv_copy/cnv_target: the region, whether it is a deletion, the copy number
+            and the list of targets (None for tandem amplifications) of each CNV.
+            The cnv_start of a CNV not shorter than the sequence (after 10 retries) is -1.
     '''
-    if dict1==None:
-        dict1={}
-    if dict2==None:
-        dict2={}
-    new_dict=dict1.copy()
-    for key in dict2:
-        if key in new_dict:
-            new_dict[key]['alt_count']+=dict2[key]['alt_count']
-        else:
-            new_dict[key]=dict2[key]
-    return new_dict
-    
-def merge_two_dict_set(dict1=None,dict2=None):
+    n=numpy.random.poisson(span*rate)
+    time=numpy.sort(numpy.random.uniform(0,span,size=n))
+    is_snv=numpy.random.uniform(size=n)<snv_prob
+    n_snv=int(is_snv.sum())
+    n_cnv=n-n_snv
+    snv_pos=numpy.random.randint(start,end,size=n_snv)
+    snv_form=tstv_dist_cfg['alias'].draw(size=n_snv)
+    length=cnv_lengths(size=n_cnv,cnvl_dist=cnvl_dist,cnvl_beta=cnv_length_beta,cnvl_max=cnv_length_max)
+#redraw the cnvs not shorter than the sequence at most 10 times
+    for i in range(10):
+        too_long=numpy.flatnonzero(length>=end-start)
+        if len(too_long)==0:
+            break
+        length[too_long]=cnv_lengths(size=len(too_long),cnvl_dist=cnvl_dist,cnvl_beta=cnv_length_beta,cnvl_max=cnv_length_max)
+    too_long=length>=end-start
+    cnv_start=numpy.random.randint(start,numpy.where(too_long,start+1,end-length),size=n_cnv)
+    cnv_del=numpy.random.uniform(size=n_cnv)<del_prob
+    cnv_copy=cn_dist_cfg['alias'].draw(size=n_cnv)
+    tandem=numpy.random.uniform(size=n_cnv)<tandem_prob
+    targets=numpy.random.randint(start,end,size=int(cnv_copy[~tandem].sum())).tolist()
+    cnv_target=[None]*n_cnv
+    offset=0
+    for i in numpy.flatnonzero(~tandem):
+        cnv_target[i]=targets[offset:offset+cnv_copy[i]]
+        offset+=cnv_copy[i]
+    events={'time':time.tolist(),
+            'is_snv':is_snv.tolist(),
+            'snv_pos':snv_pos.tolist(),
+            'snv_form':snv_form.tolist(),
+            'cnv_start':numpy.where(too_long,-1,cnv_start).tolist(),
+            'cnv_end':(cnv_start+length).tolist(),
+            'cnv_del':cnv_del.tolist(),
+            'cnv_copy':cnv_copy.tolist(),
+            'cnv_target':cnv_target}
+    return events
+
+def sectors_summary(sectors=None,summary=None,parental=None,start=0,end=None):
     '''
-    It's similiar with dict.update, but for the key in both dicts,
-    its new value equal the union of dict1[key] and dict2[key].
+    Build the true frequency of SNVs, the CNVs and the CNV profile of each sector in sectors
+    (info['snvs_alt_total'], info['cnvs'] and info['cnv_profile']) from the summary returned by
+    Tree.snvs_freq_cnvs_profile for the sequence [start,end).
+    info['snvs_alt_total'] is {'pos':positions,'mutation':mutations,'alt':alt_counts,'total':total_dosages} of arrays.
     '''
-    if dict1==None:
-        dict1={}
-    if dict2==None:
-        dict2={}
-    new_dict=dict1.copy()
-    for key in dict2:
-        if key in new_dict:
-            new_dict[key].update(dict2[key])
-        else:
-            new_dict[key]=dict2[key]
-    return new_dict
-    
-def cnvs2pos_changes(cnvs=None,length=None,background=None):
+    for sector,info in sectors.items():
+        j=summary['sectors'].index(sector)
+        sector_cnvs=[]
+        for cnv,leaves_count in zip(summary['cnvs'],summary['cnv_counts'][:,j].tolist()):
+            cnv_cp=cnv.copy()
+            cnv_cp['leaves_count']=leaves_count
+            sector_cnvs.append(cnv_cp)
+
+        sector_background=[0,0]
+        for hap in parental:
+            sector_background[int(hap)]+=len(info['members'])
+        sector_cnvs_pos_changes=cnvs2pos_changes(cnvs=sector_cnvs,length=end,background=sector_background,start=start)
+        sector_cnv_profile=pos_changes2region_profile(sector_cnvs_pos_changes)
+        sector_total_dosage=info['normal_dosage']+pos_changes2local_copy(pos_changes=sector_cnvs_pos_changes,
+                                                                         positions=summary['pos'])
+        info['snvs_alt_total']={'pos':summary['pos'],'mutation':summary['mutation'],
+                                'alt':summary['alt_count'][:,j],'total':sector_total_dosage}
+        info['cnvs']=sector_cnvs
+        info['cnv_profile']=sector_cnv_profile
+
+def cnvs2pos_changes(cnvs=None,length=None,background=None,start=0):
     '''
-    Return a list of lists. Each sublist contain three elements. The first is the position, and the second 
-    is the copy number CHANGES across all the samples between that positon and the next position.
+    Return an array (sorted by position) of three columns. The first is the position, and the others
+    are the copy number CHANGES across all the samples between that positon and the next position.
     [[pos,parental0_relative_copy_number_change,parental1_relative_copy_number_change],...]
+    The background copy number covers the sequence [start,length).
     '''
-    pos_changes=[[0,background[0],background[1]],[length,-background[0],-background[1]]]
-    for cnv in cnvs:
-        change=cnv['copy']*cnv['leaves_count']
-        if cnv['parental']=='0':
-            pos_changes.extend([[cnv['start'],change,0],[cnv['end'],-change,0]])
-        else:
-            pos_changes.extend([[cnv['start'],0,change],[cnv['end'],0,-change]])
-    pos_changes.sort(key=lambda pos: pos[0])
-    return pos_changes
+    n=len(cnvs)
+    pos_changes=numpy.zeros((2*n+2,3),dtype=numpy.int64)
+    pos_changes[0]=[start,background[0],background[1]]
+    pos_changes[1]=[length,-background[0],-background[1]]
+    if n>0:
+        starts=numpy.fromiter((cnv['start'] for cnv in cnvs),dtype=numpy.int64,count=n)
+        ends=numpy.fromiter((cnv['end'] for cnv in cnvs),dtype=numpy.int64,count=n)
+        changes=numpy.fromiter((cnv['copy']*cnv['leaves_count'] for cnv in cnvs),dtype=numpy.int64,count=n)
+        parental1=numpy.fromiter((cnv['parental']!='0' for cnv in cnvs),dtype=bool,count=n)
+        pos_changes[2::2,0]=starts
+        pos_changes[3::2,0]=ends
+        pos_changes[2::2,1]=numpy.where(parental1,0,changes)
+        pos_changes[2::2,2]=numpy.where(parental1,changes,0)
+        pos_changes[3::2,1:]=-pos_changes[2::2,1:]
+    return pos_changes[numpy.argsort(pos_changes[:,0],kind='stable')]
 
 def pos_changes2region_profile(pos_changes):
     '''
     Convert [[pos,parental0_change,parental1_change]...] to [[start,end,parental0_current,parental1_current,total_current]...]
     '''
-    pos_changes_copy=pos_changes[:]
-    profile=[]
-    (current0,current1,current_total)=(0,0,0)
-    while pos_changes_copy:
-        pos,change0,change1=pos_changes_copy.pop(0)
-        start=pos
-        current0+=change0
-        current1+=change1
-        current_total+=change0+change1
-        if pos_changes_copy:
-            end=pos_changes_copy[0][0]
-            if start!=end:
-                profile.append([start,end,current0,current1,current_total])
-    return profile
+    current=numpy.cumsum(pos_changes[:,1:],axis=0)
+#the regions between two different positions, the current copy number of a region is the one after its last change
+    regions=numpy.flatnonzero(pos_changes[:-1,0]!=pos_changes[1:,0])
+    profile=numpy.column_stack((pos_changes[regions,0],pos_changes[regions+1,0],
+                                current[regions],current[regions].sum(axis=1)))
+    return profile.tolist()
+
+def pos_changes2local_copy(pos_changes=None,positions=None):
+    '''
+    Return the total copy number (of all parental copies) at each position in positions (sorted),
+    i.e. the sum of all the changes at or before the position.
+    '''
+    current=numpy.concatenate(([0],numpy.cumsum(pos_changes[:,1:].sum(axis=1))))
+    return current[numpy.searchsorted(pos_changes[:,0],positions,side='right')]
 
 def node_id():
     i=0
@@ -937,46 +1027,612 @@ def node_id():
         i+=1
         yield 'node'+str(i)
 
-#@profile
-def newick2tree(newick=None):
-    leaf_name_re=re.compile('^\w+:')
-    lens_re=re.compile('^:[0-9.eE-]+')
-    brushwood=newick.split(',')
-    node_id_gen=node_id()
-    for branch in brushwood:
-        while branch != '':
-            if lens_re.match(branch):
-                m=lens_re.match(branch)
-                index=m.span()
-                lens=branch[1:index[1]]
-                branch=branch[index[1]:]
-                mytree.lens=float(lens)
-            elif branch.startswith(')'):
-                branch=branch[1:]
-                mytree=mytree.top
-            elif branch.startswith('('):
-                if 'mytree' in vars():
-                    mytree=mytree.add_node(Tree(nodeid=node_id_gen.__next__()))
-                else:
-                    mytree=Tree(nodeid=node_id_gen.__next__())
-                branch=branch[1:]
-            elif leaf_name_re.match(branch):
-                m=leaf_name_re.match(branch)
-                index=m.span()
-                leaf_name=branch[:index[1]-1]
-                branch=branch[index[1]-1:]
-                mytree=mytree.add_node(Tree(name=leaf_name,nodeid=node_id_gen.__next__()))
-            elif branch==';':
+def bisect_var(variants=None,pos=None):
+    '''
+    Return the index of the first variant with start>=pos in the list variants sorted by (start,end).
+    '''
+    lo=0
+    hi=len(variants)
+    while lo<hi:
+        mid=(lo+hi)//2
+        if variants[mid]['start']<pos:
+            lo=mid+1
+        else:
+            hi=mid
+    return lo
+
+def insort_tail(variants=None,sorted_count=None):
+    '''
+    Insert the variants after the first sorted_count ones (which are sorted by (start,end)) into the sorted ones,
+    which is the same as a stable sort of variants by (start,end). Return the length of variants.
+    '''
+    tail=variants[sorted_count:]
+    del variants[sorted_count:]
+    for var in tail:
+        insort_var(variants=variants,var=var)
+    return len(variants)
+
+def insort_var(variants=None,var=None):
+    '''
+    Insert var into the list variants sorted by (start,end), after the variants with the same start and end.
+    '''
+    key=(var['start'],var['end'])
+    lo=0
+    hi=len(variants)
+    while lo<hi:
+        mid=(lo+hi)//2
+        if key<(variants[mid]['start'],variants[mid]['end']):
+            hi=mid
+        else:
+            lo=mid+1
+    variants.insert(lo,var)
+
+class Intervals:
+    '''
+    Sorted and non-overlapping intervals [start,end), e.g. the deletions on a lineage.
+    The overlapping intervals are merged when added.
+    '''
+    def __init__(self,starts=None,ends=None):
+        self.starts=[] if starts==None else starts
+        self.ends=[] if ends==None else ends
+
+    def __str__(self):
+        return str([[start,end] for start,end in zip(self.starts,self.ends)])
+
+    def copy(self):
+        return Intervals(starts=self.starts[:],ends=self.ends[:])
+
+    def covers(self,pos=None):
+        '''
+        Whether pos locates in one of the intervals.
+        '''
+        i=bisect.bisect_right(self.starts,pos)-1
+        return i>=0 and pos<self.ends[i]
+
+    def add(self,start=None,end=None):
+        lo=bisect.bisect_left(self.ends,start)
+        hi=bisect.bisect_right(self.starts,end)
+        if lo<hi:
+            start=min(start,self.starts[lo])
+            end=max(end,self.ends[hi-1])
+        self.starts[lo:hi]=[start]
+        self.ends[lo:hi]=[end]
+
+    def subtract(self,start=None,end=None):
+        '''
+        Return the regions ([[start1,end1],[start2,end2],...]) in [start,end) which are not in any interval.
+        An empty region [start,start] is returned as it is, unless start is in or at the end of an interval.
+        '''
+        if start==end:
+            i=bisect.bisect_right(self.starts,start)-1
+            if i>=0 and start<=self.ends[i]:
+                return []
+            return [[start,end]]
+        regions=[]
+        i=bisect.bisect_right(self.ends,start)
+        while i<len(self.starts) and self.starts[i]<end:
+            if start<self.starts[i]:
+                regions.append([start,self.starts[i]])
+            start=max(start,self.ends[i])
+            i+=1
+        if start<end:
+            regions.append([start,end])
+        return regions
+
+class SnvPositions:
+    '''
+    The positions taken by SNVs in one chromosome (all its haplotypes), to make sure
+    at most one SNV on each position. One instance is owned by each chromosome simulation,
+    so that different chromosomes do not share any state.
+    '''
+    def __init__(self,positions=None):
+        self.used=set() if positions==None else set(positions)
+
+    def __contains__(self,pos):
+        return pos in self.used
+
+    def add(self,pos=None):
+        self.used.add(pos)
+
+    def draw(self,start=None,end=None,tries=100):
+        '''
+        Draw a position uniformly from the free positions in [start,end).
+        Try rejection sampling first, which is fast unless [start,end) is nearly full,
+        then fall back to pick the k-th free position exactly.
+        '''
+        for i in range(tries):
+            pos=numpy.random.randint(start,end)
+            if pos not in self.used:
+                return pos
+        used=numpy.array(sorted(pos for pos in self.used if start<=pos<end),dtype=numpy.int64)
+        free=end-start-len(used)
+        if free<=0:
+            raise NoFreePositionError('No free position for a new SNV in [{},{})'.format(start,end))
+        k=numpy.random.randint(free)
+#the number of free positions before each used position
+        free_before=used-start-numpy.arange(len(used))
+        return start+k+int(numpy.searchsorted(free_before,k,side='right'))
+
+class AltCounts:
+    '''
+    Collect the (pos, mutation, alt_count delta) records of SNVs in flat lists,
+    and sum up the deltas of each position at once in summary().
+    The alt_count delta of a record is an array with one element for each sector.
+    '''
+    def __init__(self):
+        self.pos=[]
+        self.mutation=[]
+        self.group=[]
+        self.alt_counts=[]
+
+    def add(self,snvs=None,alt_count=None):
+        '''
+        Add alt_count to each SNV in snvs.
+        '''
+        self.pos.extend([snv['start'] for snv in snvs])
+        self.mutation.extend([snv['mutation'] for snv in snvs])
+        self.group.extend([len(self.alt_counts)]*len(snvs))
+        self.alt_counts.append(alt_count)
+
+    def summary(self,sectors_number=None):
+        '''
+        Return {'pos':positions,'mutation':mutations,'alt_count':alt_counts}, sorted by position,
+        with one element (one row of sectors_number columns for alt_count) for each position.
+        For a position seen more than once, the mutation of its first record is kept
+        and its alt_count is the sum of all its records.
+        '''
+        pos=numpy.array(self.pos,dtype=numpy.int64)
+        uniq_pos,first,inverse=numpy.unique(pos,return_index=True,return_inverse=True)
+        alt_count=numpy.zeros((len(uniq_pos),sectors_number),dtype=numpy.int64)
+        if self.alt_counts:
+            alt_counts=numpy.array(self.alt_counts,dtype=numpy.int64).reshape(len(self.alt_counts),sectors_number)
+            numpy.add.at(alt_count,inverse,alt_counts[numpy.array(self.group,dtype=numpy.int64)])
+        return {'pos':uniq_pos,
+                'mutation':numpy.array(self.mutation,dtype=numpy.int64)[first],
+                'alt_count':alt_count}
+
+class SnvGenotypes:
+    '''
+    The genotypes of all SNVs of a chromosome in each tipnode: the count of the alternative alleles
+    of each SNV and the local copy number (for the count of the reference alleles).
+    The tipnodes under a node are next to each other in DFS order (tipnodes), so the change made by
+    a node is the same for a range of tipnodes [lo,hi). Only the changes at the bounds of the ranges
+    are stored, as a sparse matrix (one row per SNV) in CSR format (indptr, indices, data) by finish().
+    The genotypes of a SNV in all tipnodes are the cumulative sum of its row, built when it is written.
+    '''
+    def __init__(self,tipnodes=None,ploidy=None):
+        self.tipnodes=tipnodes
+        self.tipnode_index={tipnode:i for i,tipnode in enumerate(tipnodes)}
+        self.ploidy=ploidy
+        self.snv_pos=[]
+        self.snv_lo=[]
+        self.snv_hi=[]
+        self.snv_delta=[]
+        self.cnv_pos=[]
+        self.cnv_lo=[]
+        self.cnv_hi=[]
+        self.cnv_change=[]
+
+    def add_snvs(self,snvs=None,lo=None,hi=None,delta=None):
+        self.snv_pos.extend([snv['start'] for snv in snvs])
+        self.snv_lo.extend([lo]*len(snvs))
+        self.snv_hi.extend([hi]*len(snvs))
+        self.snv_delta.extend([delta]*len(snvs))
+
+    def add_cnv(self,cnv=None,lo=None,hi=None):
+        self.cnv_pos.extend([cnv['start'],cnv['end']])
+        self.cnv_lo.extend([lo,lo])
+        self.cnv_hi.extend([hi,hi])
+        self.cnv_change.extend([cnv['copy'],-cnv['copy']])
+
+    def finish(self,pos=None,mutation=None):
+        '''
+        Build the sparse matrix of the changes of alt counts for the SNVs at pos (sorted).
+        '''
+        self.pos=pos
+        self.mutation=mutation
+        width=len(self.tipnodes)+1
+        rows=numpy.searchsorted(numpy.array(pos,dtype=numpy.int64),numpy.array(self.snv_pos,dtype=numpy.int64))
+        delta=numpy.array(self.snv_delta,dtype=numpy.int64)
+        keys=numpy.concatenate((rows*width+numpy.array(self.snv_lo,dtype=numpy.int64),
+                                rows*width+numpy.array(self.snv_hi,dtype=numpy.int64)))
+        keys,inverse=numpy.unique(keys,return_inverse=True)
+        data=numpy.zeros(len(keys),dtype=numpy.int64)
+        numpy.add.at(data,inverse,numpy.concatenate((delta,-delta)))
+#the changes at the end of all tipnodes and the ones cancelled out are dropped
+        keep=(data!=0)&(keys%width!=width-1)
+        keys=keys[keep]
+        data=data[keep]
+        self.indptr=numpy.searchsorted(keys//width,numpy.arange(len(pos)+1))
+        self.indices=keys%width
+        dtype=numpy.int8 if len(data)==0 or numpy.abs(data).max()<=numpy.iinfo(numpy.int8).max else numpy.int16
+        self.data=data.astype(dtype)
+        for attr in ('snv_pos','snv_lo','snv_hi','snv_delta'):
+            setattr(self,attr,None)
+
+    def arrays(self):
+        '''
+        Return the finished genotypes as a dictionary of arrays, which can be saved by numpy.savez and restored by load_arrays.
+        '''
+        return {'tipnodes':numpy.array(self.tipnodes,dtype=str),
+                'ploidy':numpy.array(self.ploidy,dtype=numpy.int64),
+                'pos':numpy.array(self.pos,dtype=numpy.int64),
+                'mutation':numpy.array(self.mutation,dtype=numpy.int64),
+                'indptr':self.indptr,
+                'indices':self.indices,
+                'data':self.data,
+                'cnv_pos':numpy.array(self.cnv_pos,dtype=numpy.int64),
+                'cnv_lo':numpy.array(self.cnv_lo,dtype=numpy.int64),
+                'cnv_hi':numpy.array(self.cnv_hi,dtype=numpy.int64),
+                'cnv_change':numpy.array(self.cnv_change,dtype=numpy.int64)}
+
+    def load_arrays(self,arrays=None):
+        '''
+        Restore the finished genotypes from the arrays returned by arrays().
+        '''
+        self.pos=arrays['pos'].tolist()
+        self.mutation=arrays['mutation'].tolist()
+        for attr in ('indptr','indices','data','cnv_pos','cnv_lo','cnv_hi','cnv_change'):
+            setattr(self,attr,arrays[attr])
+        for attr in ('snv_pos','snv_lo','snv_hi','snv_delta'):
+            setattr(self,attr,None)
+
+    def blocks(self,tipnodes=None,max_size=1<<22):
+        '''
+        Yield (pos,mutation,alt_counts,ref_counts) for the SNVs block by block, the counts are matrices
+        (SNVs x tipnodes, in the order of tipnodes) of at most max_size elements. There is no CNV breakpoint
+        between the SNVs in a block, so their local copy numbers are the same.
+        '''
+        size=len(self.tipnodes)
+        columns=numpy.array([self.tipnode_index[tipnode] for tipnode in tipnodes],dtype=numpy.int64)
+        order=numpy.argsort(numpy.array(self.cnv_pos,dtype=numpy.int64),kind='stable')
+        cnv_pos=numpy.array(self.cnv_pos,dtype=numpy.int64)[order]
+        cnv_lo=numpy.array(self.cnv_lo,dtype=numpy.int64)[order]
+        cnv_hi=numpy.array(self.cnv_hi,dtype=numpy.int64)[order]
+        cnv_change=numpy.array(self.cnv_change,dtype=numpy.int64)[order]
+        copy_changes=numpy.zeros(size+1,dtype=numpy.int64)
+        copy_number=numpy.full(size,self.ploidy,dtype=numpy.int64)
+        pos=numpy.array(self.pos,dtype=numpy.int64)
+        mutation=numpy.array(self.mutation,dtype=numpy.int64)
+#the CNVs at or before the position of a SNV change its local copy number
+        bounds=numpy.searchsorted(pos,cnv_pos,side='left').tolist()
+        step=max(1,max_size//max(size,1))
+        bounds=sorted(set(bounds+list(range(0,len(pos),step))+[len(pos)]))
+        cnv_i=0
+        for row_start,row_end in zip(bounds[:-1],bounds[1:]):
+            cnv_j=int(numpy.searchsorted(cnv_pos,pos[row_start],side='right'))
+            if cnv_j>cnv_i:
+                numpy.add.at(copy_changes,cnv_lo[cnv_i:cnv_j],cnv_change[cnv_i:cnv_j])
+                numpy.subtract.at(copy_changes,cnv_hi[cnv_i:cnv_j],cnv_change[cnv_i:cnv_j])
+                copy_number=self.ploidy+numpy.cumsum(copy_changes[:-1])
+                cnv_i=cnv_j
+            alt_changes=numpy.zeros((row_end-row_start,size),dtype=numpy.int64)
+            start,end=self.indptr[row_start],self.indptr[row_end]
+            rows=numpy.repeat(numpy.arange(row_end-row_start),numpy.diff(self.indptr[row_start:row_end+1]))
+            alt_changes[rows,self.indices[start:end]]=self.data[start:end]
+            alt_counts=numpy.cumsum(alt_changes,axis=1)
+            ref_counts=copy_number-alt_counts
+            yield pos[row_start:row_end],mutation[row_start:row_end],alt_counts[:,columns],ref_counts[:,columns]
+
+    def format_block(self,chroms=None,pos=None,mutation=None,alt_counts=None,ref_counts=None):
+        '''
+        Return the lines of the genotypes (alt_count:ref_count) of the SNVs in a block (see blocks).
+        '''
+#look up the genotype strings of all (alt_count,ref_count) pairs in the block
+        alt_min=int(alt_counts.min())
+        ref_min=int(ref_counts.min())
+        ref_span=int(ref_counts.max())-ref_min+1
+        table=numpy.array(['{}:{}'.format(alt,ref) for alt in range(alt_min,int(alt_counts.max())+1)
+                           for ref in range(ref_min,ref_min+ref_span)])
+        genotypes=table[(alt_counts-alt_min)*ref_span+ref_counts-ref_min]
+        return psite.writer.format_lines([chroms,pos,pos+1,mutation,['\t'.join(row) for row in genotypes.tolist()]])
+
+    def write(self,output=None,chroms=None,tipnodes=None):
+        '''
+        Write the genotypes (alt_count:ref_count) of each SNV in the tipnodes (in this order) block by block.
+        '''
+        for pos,mutation,alt_counts,ref_counts in self.blocks(tipnodes=tipnodes):
+            output.write(self.format_block(chroms=chroms,pos=pos,mutation=mutation,alt_counts=alt_counts,ref_counts=ref_counts))
+
+class VariantTable:
+    '''
+    The SNVs/CNVs on each node, with one record of integers for each variant:
+    (node number, chromosome rank, haplotype, start, end, type, var)
+    The chromosomes are ranked by their names, and type is the index in VariantTable.TYPES.
+    var is the mutation form of a SNV, or the copy of a CNV (+int for amplifications and -1 for deletions).
+    The same variant added more than once on a node is kept once.
+    '''
+    TYPES=('SNV','AMP','DEL')
+
+    def __init__(self):
+        self.chroms_names=[]
+        self.chroms_code={}
+        self.records=[]
+        self.table=None
+
+    def add(self,node=None,chroms=None,hap=None,start=None,end=None,var_type=None,var=None):
+        if chroms not in self.chroms_code:
+            self.chroms_code[chroms]=len(self.chroms_names)
+            self.chroms_names.append(chroms)
+#node is in the format of 'nodeX'
+        self.records.append((int(node[4:]),self.chroms_code[chroms],int(hap),start,end,self.TYPES.index(var_type),var))
+        self.table=None
+
+    def update(self,other=None):
+        '''
+        Add all variants of another VariantTable (e.g. the variants of a chromosome simulated in another process).
+        '''
+        for chroms in other.chroms_names:
+            if chroms not in self.chroms_code:
+                self.chroms_code[chroms]=len(self.chroms_names)
+                self.chroms_names.append(chroms)
+        code=[self.chroms_code[chroms] for chroms in other.chroms_names]
+        self.records.extend((record[0],code[record[1]])+record[2:] for record in other.records)
+        self.table=None
+
+    def arrays(self):
+        '''
+        Return the records as a dictionary of arrays, which can be saved by numpy.savez and restored by load_arrays.
+        '''
+        return {'chroms_names':numpy.array(self.chroms_names,dtype=str),
+                'records':numpy.array(self.records,dtype=numpy.int64).reshape(len(self.records),7)}
+
+    def load_arrays(self,arrays=None):
+        '''
+        Add the records in the arrays returned by arrays().
+        '''
+        other=VariantTable()
+        other.chroms_names=arrays['chroms_names'].tolist()
+        other.records=[tuple(record) for record in arrays['records'].tolist()]
+        self.update(other=other)
+
+    def sorted_table(self):
+        '''
+        Return the unique records as an array sorted by node, chromosome name, start and end.
+        '''
+        if self.table is None:
+            table=numpy.array(self.records,dtype=numpy.int64).reshape(len(self.records),7)
+            self.chroms_names_sorted=sorted(self.chroms_names)
+            rank=numpy.array([self.chroms_names_sorted.index(chroms) for chroms in self.chroms_names],dtype=numpy.int64)
+            if len(table):
+                table[:,1]=rank[table[:,1]]
+            table=numpy.unique(table[:,[0,1,3,4,2,5,6]],axis=0)
+            self.table=table[:,[0,1,4,2,3,5,6]]
+        return self.table
+
+    def counts(self):
+        '''
+        Return {var_type:{node:count,...},...}, the number of each type of variants on each node.
+        '''
+        table=self.sorted_table()
+        nodes=numpy.unique(table[:,0])
+        counts={}
+        for code,var_type in enumerate(self.TYPES):
+            type_counts=numpy.bincount(numpy.searchsorted(nodes,table[table[:,5]==code,0]),minlength=len(nodes))
+            counts[var_type]={'node{}'.format(node):count for node,count in zip(nodes.tolist(),type_counts.tolist())}
+        return counts
+
+    def strings(self,table=None):
+        '''
+        Yield (node,[chroms,hap,start,end,var]) for each variant (in table, the rows of sorted_table() by default),
+        with every element formatted as a string.
+        '''
+        if table is None:
+            table=self.sorted_table()
+        for node,chroms,hap,start,end,var_type,var in table.tolist():
+            if var_type==1:
+                var='+{}'.format(var)
+            yield 'node{}'.format(node),[self.chroms_names_sorted[chroms],str(hap),str(start),str(end),str(var)]
+
+    def nodes_rows(self):
+        '''
+        Return {node:(first,last),...}, the range of the lines (counted from 0) of the variants on each node written by write().
+        '''
+        table=self.sorted_table()
+        nodes,first,counts=numpy.unique(table[:,0],return_index=True,return_counts=True)
+        return {'node{}'.format(node):(start,start+count-1) for node,start,count in zip(nodes.tolist(),first.tolist(),counts.tolist())}
+
+    def nodes_vars(self,skip=None):
+        '''
+        Return {node1:{var1,var2,...},node2:{var3,var4,...},...}, each variant is in the format 'chr#hap#start#end#var'.
+        The nodes in skip are left out.
+        '''
+        table=self.sorted_table()
+        if skip:
+            table=table[~numpy.isin(table[:,0],[int(node[4:]) for node in skip])]
+        nodes_vars={}
+        for node,var in self.strings(table=table):
+            if node not in nodes_vars:
+                nodes_vars[node]=set()
+            nodes_vars[node].add('#'.join(var))
+        return nodes_vars
+
+    def write(self,output=None):
+        '''
+        Write the variants on each node (node,chr,hap,start,end,var) line by line.
+        '''
+        for node,var in self.strings():
+            output.write('{}\t{}\n'.format(node,'\t'.join(var)))
+
+class MutationTrace:
+    '''
+    Write every new SNV/CNV as a JSON object per line, together with the chromosome
+    and haplotype set by context(), e.g.
+    {"chr": "1", "hap": 0, "seg": [0, 1000], "node": "node3", "time": 0.01, "type": "SNV", "start": 5, "end": 6, "var": 1}
+    seg is the sequence the variant is simulated on (an amplified segment for the variants on its new copies),
+    time is the position of the event on the branch leading to the node.
+    '''
+    def __init__(self,output=None):
+        self.output=output
+        self.chroms=None
+        self.hap=None
+
+    def context(self,chroms=None,hap=None):
+        self.chroms=chroms
+        self.hap=hap
+
+    def write(self,**event):
+        record={'chr':self.chroms,'hap':self.hap}
+        record.update(event)
+        self.output.write(json.dumps(record)+'\n')
+
+class TreeBuilder:
+    '''
+    Build a Tree node by node, in the order the nodes appear in a newick string.
+    '''
+    def __init__(self):
+        self.root=None
+        self.current=None
+        self.node_id_gen=node_id()
+
+    def add(self,name=None):
+        '''
+        Add a new child to the current node and move to it.
+        '''
+        node=Tree(name=name,nodeid=self.node_id_gen.__next__())
+        if self.current==None:
+            self.root=node
+            self.current=node
+        else:
+            self.current=self.current.add_node(node)
+
+    def up(self):
+        '''
+        Move back to the ancestor of the current node.
+        '''
+        self.current=self.current.top
+
+    def set_lens(self,lens=None):
+        self.current.lens=lens
+
+    def finish(self):
+        return self.root
+
+#A token in newick format: punctuation, branch length, comment, quoted label or unquoted label
+NEWICK_TOKEN_RE=re.compile(r"\s*(?:([(),;])|:\s*([^\s()\[\]',;:]+)|\[([^\]]*)\]|'((?:[^']|'')*)'|([^\s()\[\]',;:]+))")
+
+def tree_builder(compact=False):
+    '''
+    With compact=True, return a psite.topology.TopologyBuilder, otherwise a TreeBuilder.
+    '''
+    if compact:
+        import psite.topology
+        return psite.topology.TopologyBuilder()
+    else:
+        return TreeBuilder()
+
+def parse_newick(chunks=None,builder=None):
+    '''
+    Build a tree with the builder from a newick string in a single pass, and return the root.
+    The newick string can be given in pieces: chunks is an iterable of consecutive substrings of it,
+    e.g. the blocks read from a file, so the whole string never needs to be in memory.
+    Labels can be quoted with \' (\'\' is an escaped quote in a quoted label).
+    Comments in [], e.g. the [&&NHX...] attributes, and the labels of inner nodes are ignored.
+    '''
+    match=NEWICK_TOKEN_RE.match
+    buf=''
+    depth=0
+#expect_node is True after '(' or ',', when a leaf or a subtree should come next
+    expect_node=True
+    after_close=False
+    eof=False
+    chunks=iter(chunks)
+    while not eof:
+        chunk=next(chunks,None)
+        if chunk==None:
+            eof=True
+        else:
+            buf+=chunk
+        pos=0
+        n=len(buf)
+        while pos<n:
+            m=match(buf,pos)
+#a token reaching the end of buf may continue in the next chunk
+            if m==None or (m.end()==n and not eof):
                 break
+            pos=m.end()
+            punct,lens,comment,quoted,label=m.groups()
+            if punct=='(':
+                if not expect_node:
+                    raise NewickFormatError('Unexpected "(" in the newick tree!')
+                builder.add()
+                depth+=1
+            elif punct==',' or punct==')':
+                if expect_node:
+                    raise NewickFormatError('Missing a node before "{}" in the newick tree!'.format(punct))
+                if depth==0:
+                    raise NewickFormatError('Unbalanced parentheses in the newick tree!')
+                builder.up()
+                if punct==',':
+                    expect_node=True
+                else:
+                    depth-=1
+                    after_close=True
+                    continue
+            elif punct==';':
+                if depth!=0 or expect_node:
+                    raise NewickFormatError('The newick tree ends before all its nodes are closed!')
+                return builder.finish()
+            elif lens!=None:
+                if expect_node:
+                    raise NewickFormatError('Missing a node before ":{}" in the newick tree!'.format(lens))
+                try:
+                    builder.set_lens(float(lens))
+                except ValueError:
+                    raise NewickFormatError('Invalid branch length in the newick tree: {}'.format(lens))
+            elif comment!=None:
+                continue
             else:
-                raise ShouldNotBeHereError('Check your newick tree! Or maybe there are something I do not know about newick!')
-        else:
-            mytree=mytree.top
-    return mytree
-    
+                if quoted!=None:
+                    label=quoted.replace("''","'")
+                if expect_node:
+                    builder.add(name=label)
+                    expect_node=False
+                elif not after_close:
+                    raise NewickFormatError('Unexpected label in the newick tree: {}'.format(label))
+            after_close=False
+        buf=buf[pos:]
+    if buf.strip():
+        raise NewickFormatError('Can not parse the newick tree from: {}'.format(buf[:50]))
+    if depth!=0 or expect_node:
+        raise NewickFormatError('The newick tree ends before all its nodes are closed!')
+    return builder.finish()
+
+def newick2tree(newick=None,compact=False):
+    '''
+    Build a tree from a string in newick format.
+    With compact=True, the tree is stored in a psite.topology.Topology and the root Node is returned.
+    '''
+    return parse_newick(chunks=[newick],builder=tree_builder(compact=compact))
+
+def read_chunks(filename=None,chunk_size=1<<20):
+    '''
+    Read a (gzipped) text file block by block.
+    '''
+    with open(filename,'rb') as input:
+        gzipped=input.read(2)==b'\x1f\x8b'
+    if gzipped:
+        input=gzip.open(filename,'rt')
+    else:
+        input=open(filename)
+    with input:
+        while True:
+            chunk=input.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def newick_file2tree(filename=None,compact=False):
+    '''
+    Build a tree from a (gzipped) file containing ONE tree in newick format.
+    The file is parsed while it is being read, so a large tree never exists as a whole string in memory.
+    '''
+    return parse_newick(chunks=read_chunks(filename=filename),builder=tree_builder(compact=compact))
+
 def simulate_sequence_coverage(mean_coverage=None,baf=None):
     '''
-    Simulate the coverage of B allele and the total coverage
+    Simulate the coverage of B allele and the total coverage of a batch of sites,
+    mean_coverage and baf are arrays (or numbers) with one element for each site.
     '''
     coverage=numpy.random.poisson(mean_coverage)
     b_allele_coverage=numpy.random.binomial(n=coverage,p=baf)
@@ -984,20 +1640,23 @@ def simulate_sequence_coverage(mean_coverage=None,baf=None):
 
 def simulate_cnv_rc(mean_coverage=None,parental0_cn=None,parental1_cn=None,seg_length=None,read_length=150):
     '''
-    Simulate the coverage of each parental copy in each genome segment
+    Simulate the coverage of each parental copy in a batch of genome segments, the arguments (except read_length)
+    are arrays with one element for each segment. Return [total_rc,parental0_rc,parental1_rc] (arrays).
     I will set the standard deviation to be 0.025*mean_coverage for the simulation, so 95% of the simulated
-    depth will in the range (mean_coverage-0.025*mean_coverage,mean_coverage+0.025*mean_coverage)
+    depth will in the range (mean_coverage-0.05*mean_coverage,mean_coverage+0.05*mean_coverage).
+    The depth is sampled from the normal distribution truncated at 0, i.e. the negative ones are sampled again.
     '''
+    mean_coverage=numpy.asarray(mean_coverage,dtype=float)
     local_coverage=numpy.random.normal(mean_coverage,0.025*mean_coverage)
-    while local_coverage<0:
-        local_coverage=numpy.random.normal(mean_coverage,0.025*mean_coverage)
-    total_rc=round(local_coverage*seg_length/read_length)
-    if total_rc==0:
-        parental0_rc=0
-        parental1_rc=0
-    else:
-        parental0_rc=numpy.random.binomial(n=total_rc,p=parental0_cn/(parental0_cn+parental1_cn))
-        parental1_rc=total_rc-parental0_rc
+    negative=numpy.flatnonzero(local_coverage<0)
+    while len(negative)>0:
+        local_coverage[negative]=numpy.random.normal(mean_coverage[negative],0.025*mean_coverage[negative])
+        negative=negative[local_coverage[negative]<0]
+    total_rc=numpy.round(local_coverage*seg_length/read_length).astype(numpy.int64)
+    parental0_cn=numpy.asarray(parental0_cn)
+    copy=parental0_cn+numpy.asarray(parental1_cn)
+    parental0_rc=numpy.random.binomial(n=total_rc,p=numpy.where(copy==0,0,parental0_cn/numpy.where(copy==0,1,copy)))
+    parental1_rc=total_rc-parental0_rc
     return [total_rc,parental0_rc,parental1_rc]
 
 def hap_local_leaves(positions=None,haps_cnvs=None,length=None,background=None,ploidy=None):
@@ -1010,19 +1669,12 @@ def hap_local_leaves(positions=None,haps_cnvs=None,length=None,background=None,p
     ...
     local_copy_on_hapN
     '''
-    all_pos_local_copy=[]
-    hap_cnvs_pos_changes=[]
-    hap_local_copy=[]
+    all_pos_local_copy=[[pos] for pos in positions]
     for i in range(ploidy):
-        haps_cnvs[i].sort(key=lambda cnv: cnv['start'])
-        hap_cnvs_pos_changes.append(cnvs2pos_changes(cnvs=haps_cnvs[i],length=length,background=background))
-        hap_local_copy.append(0)
-    for pos in positions:
-        all_pos_local_copy.append([pos])
-        for i in range(ploidy):
-            while pos>=hap_cnvs_pos_changes[i][0][0]:
-                hap_local_copy[i]+=sum(hap_cnvs_pos_changes[i].pop(0)[1:])
-            all_pos_local_copy[-1].append(hap_local_copy[i])
+        hap_cnvs_pos_changes=cnvs2pos_changes(cnvs=haps_cnvs[i],length=length,background=background)
+        hap_local_copy=pos_changes2local_copy(pos_changes=hap_cnvs_pos_changes,positions=positions)
+        for pos_local_copy,local_copy in zip(all_pos_local_copy,hap_local_copy.tolist()):
+            pos_local_copy.append(local_copy)
     return all_pos_local_copy
 
 def output_tipnode_hap(tipnode_hap=None,directory=None,chroms=None,haplotype=None,parental=None):
@@ -1088,7 +1740,7 @@ def build_line(elements=None):
     '''
     return '{}\n'.format('\t'.join([str(x) for x in elements]))
 
-class TooManyHitsOnSamePosError(Exception):
+class NoFreePositionError(Exception):
     pass
 
 class ShouldNotBeHereError(Exception):
@@ -1096,3 +1748,6 @@ class ShouldNotBeHereError(Exception):
 
 class TreePruneError(Exception):
     pass
+
+class NewickFormatError(Exception):
+    pass
@@ -8,7 +8,6 @@
 #########################################################################
 
 import logging
-import copy as cp
 
 def classify_vars(vars_file,chroms_cfg,leaves_number,tree):
     '''
@@ -104,7 +103,7 @@ def classify_vars(vars_file,chroms_cfg,leaves_number,tree):
                                 raise TrunkVarError('The target of the amplification below is out of range:\n{}'.format(line))
                     cnvs[chroms][hap][-1]['target']=target
                     for i in range(copy): 
-                        segment=cp.deepcopy(tree)
+                        segment=tree.new_copy(lens=tree.lens)
                         cnvs[chroms][hap][-1]['new_copies'].append(segment)
                         cnvs[chroms][hap][-1]['pre_snvs'][i+1]=[]
                 else:
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# Author: Hechuan Yang
+# Created Time: 2026-10-17 09:12:40
+# File Name: writer.py
+# Description: buffered writers of the text outputs
+#########################################################################
+
+import struct
+import zlib
+import queue
+import threading
+import numpy
+
+def format_lines(columns=None):
+    '''
+    Return the lines of the columns (separated by tabs), each column is a list (or an array) with one element
+    for each line, or a string repeated in every line.
+    '''
+    length=None
+    for column in columns:
+        if not isinstance(column,str):
+            length=len(column)
+            break
+    if not length:
+        return ''
+    strings=[]
+    for column in columns:
+        if isinstance(column,str):
+            strings.append([column]*length)
+        elif isinstance(column,numpy.ndarray):
+            strings.append(list(map(str,column.tolist())))
+        else:
+            strings.append(list(map(str,column)))
+    return '\n'.join(map('\t'.join,zip(*strings)))+'\n'
+
+class BgzfFile:
+    '''
+    A binary file compressed in BGZF format (the format of bgzip), i.e. a series of gzip blocks
+    with at most 64KB of data in each, which can be indexed by tabix (if the lines are sorted).
+    '''
+    BLOCK_SIZE=65280
+#the empty block at the end of every BGZF file
+    EOF=bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+    def __init__(self,filename=None):
+        self.handle=open(filename,'wb')
+        self.buffer=bytearray()
+
+    def write(self,data=None):
+        self.buffer.extend(data)
+        while len(self.buffer)>=self.BLOCK_SIZE:
+            self.write_block(bytes(self.buffer[:self.BLOCK_SIZE]))
+            del self.buffer[:self.BLOCK_SIZE]
+
+    def write_block(self,data=None):
+        compressor=zlib.compressobj(6,zlib.DEFLATED,-15)
+        compressed=compressor.compress(data)+compressor.flush()
+#the gzip header with the extra field BC, which is the size of the whole block minus 1
+        header=struct.pack('<BBBBIBBHBBHH',31,139,8,4,0,0,255,6,66,67,2,len(compressed)+25)
+        self.handle.write(header+compressed+struct.pack('<II',zlib.crc32(data),len(data)))
+
+    def close(self):
+        if self.buffer:
+            self.write_block(bytes(self.buffer))
+            self.buffer=bytearray()
+        self.handle.write(self.EOF)
+        self.handle.close()
+
+class WriterThread(threading.Thread):
+    '''
+    A background thread running the writes of OutputFile in order, so that the I/O (and the compression)
+    overlaps with the formatting and the simulation in the main thread.
+    '''
+    def __init__(self,maxsize=64):
+        threading.Thread.__init__(self,daemon=True)
+        self.tasks=queue.Queue(maxsize=maxsize)
+        self.error=None
+        self.start()
+
+    def run(self):
+        while True:
+            task=self.tasks.get()
+            if task==None:
+                break
+            function,args=task
+#after an error, the remaining tasks are skipped and the error is raised by put/close
+            if self.error==None:
+                try:
+                    function(*args)
+                except Exception as error:
+                    self.error=error
+
+    def put(self,function=None,*args):
+        if self.error!=None:
+            raise self.error
+        self.tasks.put((function,args))
+
+    def close(self):
+        '''
+        Wait for all the writes to finish.
+        '''
+        self.tasks.put(None)
+        self.join()
+        if self.error!=None:
+            raise self.error
+
+class OutputFile:
+    '''
+    A text output file, which collects the text written to it and writes it in chunks of BUFFER_SIZE,
+    through writer (a WriterThread) if it's not None. With bgzip, the file is compressed in BGZF format.
+    '''
+    BUFFER_SIZE=1<<20
+
+    def __init__(self,filename=None,bgzip=False,writer=None):
+        if bgzip:
+            self.handle=BgzfFile(filename)
+        else:
+            self.handle=open(filename,'wb')
+        self.writer=writer
+        self.buffer=[]
+        self.size=0
+
+    def write(self,text=None):
+        self.buffer.append(text)
+        self.size+=len(text)
+        if self.size>=self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            data=''.join(self.buffer).encode()
+            self.buffer=[]
+            self.size=0
+            if self.writer!=None:
+                self.writer.put(self.handle.write,data)
+            else:
+                self.handle.write(data)
+
+    def close(self):
+        self.flush()
+        if self.writer!=None:
+            self.writer.put(self.handle.close)
+        else:
+            self.handle.close()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+#########################################################################
+# Author: Hechuan Yang
+# Created Time: 2026-10-17 14:02:10
+# File Name: test_phylovar.py
+# Description: regression tests of the outputs of phylovar
+#########################################################################
+
+import os
+import sys
+import subprocess
+import pytest
+import psite.tree
+import psite.phylovar
+
+PACKAGE=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TREE='((((c1:0.3,c2:0.2):0.4,(c3:0.1,c4:0.5):0.3):0.6,((c5:0.2,c6:0.4):0.1,c7:0.7):0.5):0.3,'+\
+     '(((c8:0.3,c9:0.3):0.2,(c10:0.6,c11:0.1):0.4):0.5,(c12:0.4,(c13:0.2,c14:0.3):0.6):0.2):0.4);\n'
+#a CNV-heavy simulation, in which many tandem amplifications share their targets
+CNV_ARGS=['-r','5','-R','80','--length','400000','-l','5000','-L','100000','--tandem_prob','1','-d','0.3']
+
+def read_dir(directory=None):
+    outputs={}
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory,name),'r') as input_file:
+            outputs[name]=input_file.read()
+    return outputs
+
+def run_phylovar(directory=None,args=None,monkeypatch=None):
+    '''
+    Run phylovar with args in directory (in this process).
+    '''
+    os.makedirs(directory)
+    with open(os.path.join(directory,'tree.nwk'),'w') as output:
+        output.write(TREE)
+    monkeypatch.chdir(directory)
+    monkeypatch.setattr(sys,'argv',['psite.py','-t','tree.nwk']+args)
+    psite.phylovar.main(progname='psite.py phylovar')
+
+def old_insort_tail(variants=None,sorted_count=None):
+    '''
+    The previous way to order accumulated_cnvs: sort all of them by (start,end) before each new cnv.
+    '''
+    variants.sort(key=lambda cnv:(cnv['start'],cnv['end']))
+    return len(variants)
+
+@pytest.mark.parametrize('seed',['1','2','3'])
+def test_chain_same_as_sorting_all_cnvs(tmp_path,monkeypatch,seed):
+    args=CNV_ARGS+['--random_seed',seed,'--chain','chain']
+    run_phylovar(directory=tmp_path/'new',args=args,monkeypatch=monkeypatch)
+    with monkeypatch.context() as patch:
+        patch.setattr(psite.tree,'insort_tail',old_insort_tail)
+        run_phylovar(directory=tmp_path/'old',args=args,monkeypatch=monkeypatch)
+    new=read_dir(tmp_path/'new'/'chain')
+    assert new
+    assert new==read_dir(tmp_path/'old'/'chain')
+
+def test_nhx_same_with_any_cores(tmp_path):
+    '''
+    The NHX trees should be the same no matter how many cores are used (and how the strings are hashed).
+    '''
+    with open(tmp_path/'tree.nwk','w') as output:
+        output.write(TREE)
+    outputs=[]
+    for cores,hash_seed in (('1','1'),('3','2')):
+        directory=tmp_path/'cores{}'.format(cores)
+        os.mkdir(directory)
+        env=dict(os.environ,PYTHONHASHSEED=hash_seed)
+        subprocess.run([sys.executable,os.path.join(PACKAGE,'psite.py'),'phylovar','-t',str(tmp_path/'tree.nwk'),
+                        '-r','50','-R','10','--length','2000000','-l','50000','-L','300000','--random_seed','7','--cores',cores,
+                        '--nhx','t.nhx','--NHX','T.nhx'],cwd=directory,env=env,check=True,stdout=subprocess.DEVNULL)
+        with open(directory/'t.nhx','r') as nhx,open(directory/'T.nhx','r') as NHX:
+            outputs.append((nhx.read(),NHX.read()))
+    assert 'vars=' in outputs[0][0]
+    assert outputs[0]==outputs[1]